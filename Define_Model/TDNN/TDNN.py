@@ -14,12 +14,12 @@ https://github.com/jonasvdd/TDNN/blob/master/tdnn.py
 """
 
 import math
+from functools import reduce
 import numpy as np
 import torch
 from torch import Tensor
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 from Define_Model.FilterLayer import L2_Norm, Mean_Norm, TimeMaskLayer, FreqMaskLayer
 from Define_Model.FilterLayer import fDLR, fBLayer, fBPLayer, fLLayer
@@ -42,6 +42,24 @@ def channel_shuffle(x: Tensor, groups: int) -> Tensor:
     return x
 
 
+def context_conv1d(x, weight, bias, context):
+    """
+    Time-delay affine transform with an arbitrary context as one conv1d:
+    out[:, :, t] = sum_k weight[:, :, k] @ x[:, :, t + context[k] - context[0]] + bias, for every t with a full context.
+    x: [batch_size, input_dim, length], weight: [output_dim, input_dim, len(context)], context: increasing frame offsets.
+    The context is a dilated convolution with the gcd of its offsets, the kernel is scattered over the taps of the
+    context span when the context skips some of them (zeros elsewhere).
+    """
+    offsets = [int(c) - int(context[0]) for c in context]
+    dilation = reduce(math.gcd, offsets[1:], 0) or 1
+    taps = offsets[-1] // dilation + 1
+    if taps != len(offsets):
+        kernel = weight.new_zeros(weight.shape[0], weight.shape[1], taps)
+        kernel[:, :, [o // dilation for o in offsets]] = weight
+        weight = kernel
+    return F.conv1d(x, weight, bias, dilation=dilation)
+
+
 """Time Delay Neural Network as mentioned in the 1989 paper by Waibel et al. (Hinton) and the 2015 paper by Peddinti et al. (Povey)"""
 
 
@@ -57,6 +75,7 @@ class TimeDelayLayer_v1(nn.Module):
         self.check_valid_context(context)
         self.kernel_width, context = self.get_kernel_width(context, full_context)
         self.register_buffer('context',torch.LongTensor(context))
+        self.context_offsets = list(context)
         self.full_context = full_context
         stdv = 1./math.sqrt(input_dim)
         self.kernel = nn.Parameter(torch.Tensor(output_dim, input_dim, self.kernel_width).normal_(0,stdv))
@@ -79,34 +98,21 @@ class TimeDelayLayer_v1(nn.Module):
 
     def special_convolution(self, x, kernel, context, bias):
         """
-        This function performs the weight multiplication given an arbitrary context. Cannot directly use convolution because in case of only particular frames of context, one needs to select only those frames and perform a convolution across all batch items and all output dimensions of the kernel.
+        This function performs the weight multiplication given an arbitrary context, for all valid steps at once:
+        the frames of the context of every step are read by a single (dilated) convolution, see context_conv1d.
         """
-        # pdb.set_trace()
         x = x.squeeze(1)
         input_size = x.size()
 
         assert len(input_size) == 3, 'Input tensor dimensionality is incorrect. Should be a 3D tensor'
         [batch_size, input_dim, input_sequence_length] = input_size
-        #x = x.transpose(1,2).contiguous() # [batch_size, input_dim, input_length]
 
-        # Allocate memory for output
-        valid_steps = self.get_valid_steps(self.context, input_sequence_length)
-        #xs = torch.Tensor(self.bias.data.new(batch_size, kernel.size()[0], len(valid_steps)))
-        xs = torch.zeros((batch_size, kernel.size()[0], len(valid_steps)))
+        valid_steps = self.get_valid_steps(self.context_offsets, input_sequence_length)
+        # the first valid step reads frame valid_steps[0] + context[0]
+        first = valid_steps.start + self.context_offsets[0]
+        xs = context_conv1d(x[:, :, first:], kernel, bias, self.context_offsets)
 
-        if torch.cuda.is_available():
-            xs = Variable(xs.cuda())
-        # Perform the convolution with relevant input frames
-        # pdb.set_trace()
-        for c, i in enumerate(valid_steps):
-            features = torch.index_select(x, 2, Variable(context+i))
-            # torch.index_selec:
-            # Returns a new tensor which indexes the input tensor along dimension dim using the entries in index which is a LongTensor.
-            # The returned tensor has the same number of dimensions as the original tensor (input). The dim th dimension has the same
-            # size as the length of index; other dimensions have the same size as in the original tensor.
-            xs[:,:,c] = F.conv1d(features, kernel, bias=bias)[:,:,0]
-
-        return xs
+        return xs[:, :, :len(valid_steps)]
 
     @staticmethod
     def check_valid_context(context): #检查context是否合理
@@ -186,19 +192,12 @@ class TimeDelayLayer_v2(nn.Module):
         _, _, d = x.shape
         assert (d == self.input_dim), 'Input dimension was wrong. Expected ({}), got ({}) in ({})'.format(
             self.input_dim, d, str(x.shape))
-        x = x.unsqueeze(1)
-
-        # Unfold input into smaller temporal contexts
-        x = F.unfold(
-            x,
-            (self.context_size, self.input_dim),
-            stride=(1, self.input_dim),
-            dilation=(self.dilation, 1)
-        )
 
-        # N, output_dim*context_size, new_t = x.shape
+        # the Linear layer over the unfolded temporal contexts as one dilated convolution, its weight columns are
+        # ordered (context frame, input feature)
+        weight = self.kernel.weight.view(self.output_dim, self.context_size, self.input_dim).transpose(1, 2)
+        x = F.conv1d(x.transpose(1, 2), weight, self.kernel.bias, dilation=self.dilation)
         x = x.transpose(1, 2)
-        x = self.kernel(x)
 
         x = self.nonlinearity(x)
 
@@ -235,6 +234,7 @@ class TimeDelayLayer_v3(nn.Module):
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.context = torch.tensor(context) + int((context_size - 1) / 2)
+        self.context_offsets = self.context.tolist()
         self.dropout_p = dropout_p
         self.batch_norm = batch_norm
 
@@ -264,24 +264,12 @@ class TimeDelayLayer_v3(nn.Module):
         b, l, d = x.shape
         assert (d == self.input_dim), 'Input dimension was wrong. Expected ({}), got ({}) in ({})'.format(
             self.input_dim, d, str(x.shape))
-        x = x.unsqueeze(1)
-
-        # Unfold input into smaller temporal contexts
-        x = F.unfold(
-            x,
-            (self.context_size, self.input_dim),
-            stride=(1, self.input_dim),
-            dilation=(1, 1)
-        )
-        if self.context.shape[0] != self.context_size:
-            _, _, new_t = x.shape
-
-            x = x.view(b, new_t, -1, self.context_size, 1)
-            x = x.index_select(3, self.context)
-            x = x.view(b, -1, new_t)
 
-        x = x.transpose(1, 2)
-        x = self.kernel(x)
+        # the Linear layer over the context frames of every window of context_size frames as one convolution,
+        # its weight columns are ordered (context frame, input feature)
+        weight = self.kernel.weight.view(self.output_dim, len(self.context_offsets), self.input_dim).transpose(1, 2)
+        x = context_conv1d(x.transpose(1, 2)[:, :, self.context_offsets[0]:], weight, self.kernel.bias, self.context_offsets)
+        x = x[:, :, :l - self.context_size + 1].transpose(1, 2)
 
         x = self.nonlinearity(x)
 
@@ -7,9 +7,10 @@ This model is modified and combined based on the following three projects:
 
 '''
 
-import math, torch, torchaudio
+import torch, torchaudio
 import torch.nn as nn
 import torch.nn.functional as F
+from model import AttentiveStatsPool, Bottle2neck
 
 class SEModule(nn.Module):
     def __init__(self, channels, bottleneck=128):
@@ -27,57 +28,6 @@ class SEModule(nn.Module):
         x = self.se(input)
         return input * x
 
-class Bottle2neck(nn.Module):
-
-    def __init__(self, inplanes, planes, kernel_size=None, dilation=None, scale = 8):
-        super(Bottle2neck, self).__init__()
-        width       = int(math.floor(planes / scale))
-        self.conv1  = nn.Conv1d(inplanes, width*scale, kernel_size=1)
-        self.bn1    = nn.BatchNorm1d(width*scale)
-        self.nums   = scale -1
-        convs       = []
-        bns         = []
-        num_pad = math.floor(kernel_size/2)*dilation
-        for i in range(self.nums):
-            convs.append(nn.Conv1d(width, width, kernel_size=kernel_size, dilation=dilation, padding=num_pad))
-            bns.append(nn.BatchNorm1d(width))
-        self.convs  = nn.ModuleList(convs)
-        self.bns    = nn.ModuleList(bns)
-        self.conv3  = nn.Conv1d(width*scale, planes, kernel_size=1)
-        self.bn3    = nn.BatchNorm1d(planes)
-        self.relu   = nn.ReLU()
-        self.width  = width
-        self.se     = SEModule(planes)
-
-    def forward(self, x):
-        residual = x
-        out = self.conv1(x)
-        out = self.relu(out)
-        out = self.bn1(out)
-
-        spx = torch.split(out, self.width, 1)
-        for i in range(self.nums):
-          if i==0:
-            sp = spx[i]
-          else:
-            sp = sp + spx[i]
-          sp = self.convs[i](sp)
-          sp = self.relu(sp)
-          sp = self.bns[i](sp)
-          if i==0:
-            out = sp
-          else:
-            out = torch.cat((out, sp), 1)
-        out = torch.cat((out, spx[self.nums]),1)
-
-        out = self.conv3(out)
-        out = self.relu(out)
-        out = self.bn3(out)
-        
-        out = self.se(out)
-        out += residual
-        return out 
-
 class PreEmphasis(torch.nn.Module):
 
     def __init__(self, coef: float = 0.97):
@@ -164,14 +114,7 @@ class ECAPA_TDNN(nn.Module):
         self.layer3 = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=8)
         # I fixed the shape of the output from MFA layer, that is close to the setting from ECAPA paper.
         self.layer4 = nn.Conv1d(3*C, 1536, kernel_size=1)
-        self.attention = nn.Sequential(
-            nn.Conv1d(4608, 256, kernel_size=1),
-            nn.ReLU(),
-            nn.BatchNorm1d(256),
-            nn.Tanh(), # I add this layer
-            nn.Conv1d(256, 1536, kernel_size=1),
-            nn.Softmax(dim=2),
-            )
+        self.attention = AttentiveStatsPool(1536, 256)
         self.bn5 = nn.BatchNorm1d(3072)
         self.fc6 = nn.Linear(3072, 192)
         self.bn6 = nn.BatchNorm1d(192)
@@ -202,16 +145,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -248,16 +182,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -10,6 +10,7 @@ This model is modified and combined based on the following three projects:
 import math, torch, torchaudio
 import torch.nn as nn
 import torch.nn.functional as F
+from model import AttentiveStatsPool
 
 class SEModule(nn.Module):
     def __init__(self, channels, bottleneck=128):
@@ -233,14 +234,7 @@ class ECAPA_TDNN(nn.Module):
         self.layer4 = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=1, add_f=add_f, add_tf=add_tf)
         # I fixed the shape of the output from MFA layer, that is close to the setting from ECAPA paper.
         self.layer5 = nn.Conv1d(4*C, 1536, kernel_size=1)
-        self.attention = nn.Sequential(
-            nn.Conv1d(4608, 256, kernel_size=1),
-            nn.ReLU(),
-            nn.BatchNorm1d(256),
-            nn.Tanh(), # I add this layer
-            nn.Conv1d(256, 1536, kernel_size=1),
-            nn.Softmax(dim=2),
-            )
+        self.attention = AttentiveStatsPool(1536, 256)
         self.bn5 = nn.BatchNorm1d(3072)
         self.fc6 = nn.Linear(3072, 192)
         self.bn6 = nn.BatchNorm1d(192)
@@ -274,16 +268,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer5(torch.cat((x1,x2,x3,x4),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -317,16 +302,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -7,9 +7,10 @@ This model is modified and combined based on the following three projects:
 
 '''
 
-import math, torch, torchaudio
+import copy, re, torch, torchaudio
 import torch.nn as nn
 import torch.nn.functional as F
+from model import AttentiveStatsPool, Bottle2neck, TDNN, FRONT_ENDS, make_torchfbank, compute_log_fbank
 
 class SEModule(nn.Module):
     def __init__(self, channels, bottleneck=128):
@@ -27,57 +28,6 @@ class SEModule(nn.Module):
         x = self.se(input)
         return input * x
 
-class Bottle2neck(nn.Module):
-
-    def __init__(self, inplanes, planes, kernel_size=None, dilation=None, scale = 8):
-        super(Bottle2neck, self).__init__()
-        width       = int(math.floor(planes / scale))
-        self.conv1  = nn.Conv1d(inplanes, width*scale, kernel_size=1)
-        self.bn1    = nn.BatchNorm1d(width*scale)
-        self.nums   = scale -1
-        convs       = []
-        bns         = []
-        num_pad = math.floor(kernel_size/2)*dilation
-        for i in range(self.nums):
-            convs.append(nn.Conv1d(width, width, kernel_size=kernel_size, dilation=dilation, padding=num_pad))
-            bns.append(nn.BatchNorm1d(width))
-        self.convs  = nn.ModuleList(convs)
-        self.bns    = nn.ModuleList(bns)
-        self.conv3  = nn.Conv1d(width*scale, planes, kernel_size=1)
-        self.bn3    = nn.BatchNorm1d(planes)
-        self.relu   = nn.ReLU()
-        self.width  = width
-        self.se     = SEModule(planes)
-
-    def forward(self, x):
-        residual = x
-        out = self.conv1(x)
-        out = self.relu(out)
-        out = self.bn1(out)
-
-        spx = torch.split(out, self.width, 1)
-        for i in range(self.nums):
-          if i==0:
-            sp = spx[i]
-          else:
-            sp = sp + spx[i]
-          sp = self.convs[i](sp)
-          sp = self.relu(sp)
-          sp = self.bns[i](sp)
-          if i==0:
-            out = sp
-          else:
-            out = torch.cat((out, sp), 1)
-        out = torch.cat((out, spx[self.nums]),1)
-
-        out = self.conv3(out)
-        out = self.relu(out)
-        out = self.bn3(out)
-        
-        out = self.se(out)
-        out += residual
-        return out 
-
 class PreEmphasis(torch.nn.Module):
 
     def __init__(self, coef: float = 0.97):
@@ -174,14 +124,7 @@ class ECAPA_TDNN(nn.Module):
         self.layer3 = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=8)
         # I fixed the shape of the output from MFA layer, that is close to the setting from ECAPA paper.
         self.layer4 = nn.Conv1d(3*C, 1536, kernel_size=1)
-        self.attention = nn.Sequential(
-            nn.Conv1d(4608, 256, kernel_size=1),
-            nn.ReLU(),
-            nn.BatchNorm1d(256),
-            nn.Tanh(), # I add this layer
-            nn.Conv1d(256, 1536, kernel_size=1),
-            nn.Softmax(dim=2),
-            )
+        self.attention = AttentiveStatsPool(1536, 256)
         self.bn5 = nn.BatchNorm1d(3072)
         self.fc6 = nn.Linear(3072, 192)
         self.bn6 = nn.BatchNorm1d(192)
@@ -209,16 +152,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -252,16 +186,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         y = self.bn5(x)
         x = self.fc6(y)
         x = self.bn6(x)
@@ -269,6 +194,201 @@ class ECAPA_TDNN(nn.Module):
         return x
 
     
+AUDIO, PIEZO = 0, 1
+
+class ModalityBatchNorm1d(nn.Module):
+    '''
+    One BatchNorm1d per modality, for batches stacked by modality. segments, set by DualModalityEncoder before every
+    pass, lists the (modality, number of samples) of the consecutive parts of the batch. In training every part is
+    normalized with the batch statistics of its own modality; in eval the running statistics of the modality of every
+    sample are applied to the whole batch as one per-sample scale / shift.
+    '''
+    def __init__(self, bn, n_modalities=2):
+        super(ModalityBatchNorm1d, self).__init__()
+        self.modality = nn.ModuleList([copy.deepcopy(bn) for _ in range(n_modalities)])
+        self.segments = None
+
+    def forward(self, x):
+        if len(self.segments) == 1:
+            return self.modality[self.segments[0][0]](x)
+        if self.training:
+            parts = x.split([n for _, n in self.segments])
+            return torch.cat([self.modality[m](part) for (m, _), part in zip(self.segments, parts)], dim=0)
+        scale = torch.stack([bn.weight / torch.sqrt(bn.running_var + bn.eps) for bn in self.modality])
+        shift = torch.stack([bn.bias - bn.running_mean * s for bn, s in zip(self.modality, scale)])
+        index = torch.cat([torch.full((n,), m, dtype=torch.long) for m, n in self.segments]).to(x.device)
+        scale, shift = scale[index], shift[index]
+        if x.dim() == 3:
+            scale, shift = scale.unsqueeze(2), shift.unsqueeze(2)
+        return torch.addcmul(shift, scale, x)
+
+def modality_batchnorm(module, n_modalities=2):
+    # replace, in place, every BatchNorm1d of module by a ModalityBatchNorm1d starting from it for every modality
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm1d):
+            setattr(module, name, ModalityBatchNorm1d(child, n_modalities))
+        else:
+            modality_batchnorm(child, n_modalities)
+    return module
+
+class ModalityAdapter(nn.Module):
+    '''
+    Residual bottleneck adapter, x + up(relu(down(x))) with the adapter of the modality of every part of the batch.
+    The up-projections start at zero, so a converted encoder starts with the behaviour of its trunk.
+    '''
+    def __init__(self, channels, dim, n_modalities=2):
+        super(ModalityAdapter, self).__init__()
+        self.modality = nn.ModuleList([nn.Sequential(nn.Conv1d(channels, dim, kernel_size=1), nn.ReLU(), nn.Conv1d(dim, channels, kernel_size=1))
+                                       for _ in range(n_modalities)])
+        for adapter in self.modality:
+            nn.init.zeros_(adapter[2].weight)
+            nn.init.zeros_(adapter[2].bias)
+        self.segments = None
+
+    def forward(self, x):
+        parts = x.split([n for _, n in self.segments])
+        return x + torch.cat([self.modality[m](part) for (m, _), part in zip(self.segments, parts)], dim=0)
+
+class DualModalityEncoder(nn.Module):
+    '''
+    The ECAPA_TDNN of model.py (same layers and names) shared by the audio and the piezo channel. The features of both
+    modalities are stacked along the batch and go through the trunk in a single pass. Per modality are the front-end
+    (front_ends: keys of model.FRONT_ENDS with the same number of mels, e.g. 'band' for the piezo as the is_audio=False
+    bank above), every BatchNorm (ModalityBatchNorm1d) and, with adapter_dim > 0, an adapter after every Res2Net block.
+    view(modality) is one modality with the interface of model.ECAPA_TDNN, used by PiezoBudsModel as encoder_a / encoder_p.
+    '''
+    def __init__(self, C, front_ends=('full', 'full'), adapter_dim=0):
+        super(DualModalityEncoder, self).__init__()
+        n_mels = set(FRONT_ENDS[front_end]['n_mels'] for front_end in front_ends)
+        if len(n_mels) != 1:
+            raise ValueError('The front-ends %s cannot share a trunk, they have different numbers of mels' % (list(front_ends),))
+        self.front_ends = list(front_ends)
+        self.n_mels = n_mels.pop()
+        self.torchfbanks = nn.ModuleList([make_torchfbank(**FRONT_ENDS[front_end]) for front_end in front_ends])
+        self.fbank_cache = None # FbankCache, see fbank_cache.py
+
+        self.specaug = FbankAug() # Spec augmentation
+        self.relu   = nn.ReLU()
+
+        self.tdnn1 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=8)
+        self.layer1 = Bottle2neck(C, C, kernel_size=3, dilation=2, scale=8)
+        self.tdnn2 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=4)
+        self.layer2 = Bottle2neck(C, C, kernel_size=3, dilation=3, scale=4)
+        self.tdnn3 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=2)
+        self.layer3 = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=2)
+        self.layer4 = nn.Conv1d(3*C, 1536, kernel_size=1)
+        self.attention = AttentiveStatsPool(1536, 256)
+        self.bn5 = nn.BatchNorm1d(3072)
+        self.fc6 = nn.Linear(3072, 192)
+        self.bn6 = nn.BatchNorm1d(192)
+        modality_batchnorm(self, len(front_ends))
+        self.adapters = nn.ModuleList([ModalityAdapter(C, adapter_dim, len(front_ends)) for _ in range(3)]) if adapter_dim > 0 else None
+
+    def view(self, modality):
+        return ModalityEncoder(self, modality)
+
+    def log_fbank(self, x, modality):
+        return compute_log_fbank(self.torchfbanks[modality], x)
+
+    def fbank(self, x, modality, aug=True):
+        # model.ECAPA_TDNN.fbank with the front-end of modality
+        with torch.no_grad():
+            if x.dim() == 3:
+                if x.shape[1] != self.n_mels:
+                    raise ValueError('%d-band features given to an encoder with %d mels' % (x.shape[1], self.n_mels))
+                x = x.float()
+            elif self.fbank_cache is not None:
+                x = self.fbank_cache.get(x, lambda x: self.log_fbank(x, modality), self.front_ends[modality])
+            else:
+                x = self.log_fbank(x, modality)
+            if aug == True:
+                x = self.specaug(x.clone())
+        return x
+
+    def forward(self, xs, aug=True):
+        # [audio clips, piezo clips] -> [audio embeddings, piezo embeddings], in one pass of the trunk
+        features = [self.fbank(x, m, aug) for m, x in enumerate(xs)]
+        x = self.forward_features(torch.cat(features, dim=0), [(m, f.shape[0]) for m, f in enumerate(features)])
+        return list(x.split([f.shape[0] for f in features]))
+
+    def forward_features(self, x, segments):
+        # x: features stacked by modality, segments: the (modality, number of samples) of its consecutive parts
+        segments = [(m, n) for m, n in segments if n > 0]
+        for module in self.modules():
+            if isinstance(module, (ModalityBatchNorm1d, ModalityAdapter)):
+                module.segments = segments
+
+        x1 = self.tdnn1(x)
+        x1 = self.adapt(0, self.layer1(x1))
+        x2 = self.tdnn2(x)
+        x2 = self.adapt(1, self.layer2(x2 + x1))
+        x3 = self.tdnn3(x)
+        x3 = self.adapt(2, self.layer3(x3 + x2 + x1))
+
+        x = self.layer4(torch.cat((x1,x2,x3),dim=1))
+        x = self.relu(x)
+
+        x = self.attention(x)
+        x = self.bn5(x)
+        x = self.fc6(x)
+        x = self.bn6(x)
+        return x
+
+    def adapt(self, i, x):
+        return x if self.adapters is None else self.adapters[i](x)
+
+class ModalityEncoder(nn.Module):
+    '''
+    One modality of a DualModalityEncoder with the interface of model.ECAPA_TDNN (fbank, forward, forward_features,
+    log_fbank, torchfbank, front_end), for the code written for two encoders. The parameters are those of the encoder.
+    '''
+    def __init__(self, encoder, modality):
+        super(ModalityEncoder, self).__init__()
+        self.encoder = encoder
+        self.modality = modality
+        self.front_end = encoder.front_ends[modality]
+        self.n_mels = encoder.n_mels
+
+    @property
+    def torchfbank(self):
+        return self.encoder.torchfbanks[self.modality]
+
+    def log_fbank(self, x):
+        return self.encoder.log_fbank(x, self.modality)
+
+    def fbank(self, x, aug=True):
+        return self.encoder.fbank(x, self.modality, aug)
+
+    def forward(self, x, aug=True):
+        return self.forward_features(self.fbank(x, aug))
+
+    def forward_features(self, x):
+        return self.encoder.forward_features(x, [(self.modality, x.shape[0])])
+
+def convert_two_encoder_state(state_a, state_p, target, shared_init='mean'):
+    '''
+    State dict of a DualModalityEncoder from the state dicts of two model.ECAPA_TDNN of the same C. Every modality takes
+    the BatchNorms of its own encoder; the shared layers take the mean of the two encoders (shared_init 'mean') or
+    those of one of them ('audio', 'piezo'). Front-ends and adapters keep the tensors of target (a state dict of the
+    DualModalityEncoder), they have no counterpart.
+    '''
+    sources = [state_a, state_p]
+    for name in state_a:
+        if name in state_p and state_a[name].shape != state_p[name].shape:
+            raise ValueError('%s: %s and %s, the encoders must have the same C to share a trunk' % (name, tuple(state_a[name].shape), tuple(state_p[name].shape)))
+    state = {}
+    for name, value in target.items():
+        match = re.match(r'(.*)\.modality\.(\d+)\.(\w+)$', name)
+        if name.startswith('torchfbanks.') or name.startswith('adapters.'):
+            state[name] = value.clone()
+        elif match:
+            state[name] = sources[int(match.group(2))][match.group(1) + '.' + match.group(3)].clone()
+        elif shared_init == 'mean' and value.is_floating_point():
+            state[name] = (state_a[name] + state_p[name]) / 2
+        else:
+            state[name] = sources[PIEZO if shared_init == 'piezo' else AUDIO][name].clone()
+    return state
+
 if __name__=='__main__':
     model = ECAPA_TDNN(1024, False)
     input = torch.rand(10, 8000)
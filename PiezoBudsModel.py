@@ -7,12 +7,17 @@ import torch.nn as nn
 from tools import *
 from loss import AAMsoftmax, AAMsoftmax576
 from model import ECAPA_TDNN
+from ECAPA_TDNN_w_Modality import DualModalityEncoder, AUDIO, PIEZO
 import random
 from biGlow import *
 from utils import *
 from dataLoader import *
 from sklearn.metrics.pairwise import cosine_similarity
 from my_models import GE2ELoss_ori
+from fbank_cache import FbankCache
+from split_manifest import read_list
+from distributed import gather_users, is_main_process, broadcast_object
+from eval_engine import EmbeddingTable, MonteCarloEvaluator, summarize
 
 def compute_ASR(sim_matrix, threshold):
     """
@@ -41,15 +46,28 @@ def compute_ASR(sim_matrix, threshold):
 
 
 class PiezoBudsModel(nn.Module):
-	def __init__(self, lr, lr_decay, C , n_class, m, s, test_step, device, num_frames, **kwargs):
+	def __init__(self, lr, lr_decay, C , n_class, m, s, test_step, device, num_frames, C_p = 0, piezo_front_end = 'full', shared_encoder = False, adapter_dim = 0, **kwargs):
 		super(PiezoBudsModel, self).__init__()
 		self.device = device
 		self.user_list = [i for i in range(n_class)]
 		self.num_frames = num_frames
-
-		## Extractor
-		self.encoder_a = ECAPA_TDNN(C = C).to(device)
-		self.encoder_p = ECAPA_TDNN(C = C).to(device)
+		self.augment_bank = AugmentBank()
+
+		## Extractor, the piezo encoder can be narrower (C_p) and use the decimated front-end of model.FRONT_ENDS
+		self.shared_encoder = shared_encoder
+		if shared_encoder:
+			## one trunk for both modalities (ECAPA_TDNN_w_Modality.DualModalityEncoder), run once on the stacked batch where both are embedded;
+			## encoder_a / encoder_p are views of it and are not registered, the parameters are saved once as encoder.*
+			if C_p not in (0, C):
+				raise ValueError('The shared encoder has one channel size C, C_p %d is not supported' % C_p)
+			self.encoder = DualModalityEncoder(C, front_ends = ('full', piezo_front_end), adapter_dim = adapter_dim).to(device)
+			object.__setattr__(self, 'encoder_a', self.encoder.view(AUDIO))
+			object.__setattr__(self, 'encoder_p', self.encoder.view(PIEZO))
+			self.fbank_cache = FbankCache().attach(self.encoder)
+		else:
+			self.encoder_a = ECAPA_TDNN(C = C).to(device)
+			self.encoder_p = ECAPA_TDNN(C = C_p or C, front_end = piezo_front_end).to(device)
+			self.fbank_cache = FbankCache().attach(self.encoder_a, self.encoder_p)
 
 		## Converter
 		self.converter = conditionGlow(in_channel=3, n_flow=2, n_block=3).to(device)
@@ -70,7 +88,8 @@ class PiezoBudsModel(nn.Module):
 
 		self.optim           = torch.optim.Adam(self.parameters(), lr = lr, weight_decay = 2e-5)
 		self.scheduler       = torch.optim.lr_scheduler.StepLR(self.optim, step_size = test_step, gamma=lr_decay)
-		para_num = sum(param.numel() for param in self.encoder_a.parameters()) * 2 + sum(param.numel() for param in self.converter.parameters())
+		encoder_params = {id(param): param for encoder in (self.encoder_a, self.encoder_p) for param in encoder.parameters()}
+		para_num = sum(param.numel() for param in encoder_params.values()) + sum(param.numel() for param in self.converter.parameters())
 		print(time.strftime("%m-%d %H:%M:%S") + " Model para number = %.2f"%((para_num) / 1024 / 1024))
 
 	def infer_embedding(self, audio, piezo, labels):
@@ -79,9 +98,10 @@ class PiezoBudsModel(nn.Module):
 		if len(audio.shape) < 3:
 			audio = audio.unsqueeze(1)
 			piezo = piezo.unsqueeze(1)
-		b, u, _ = audio.shape
-		audio = audio.contiguous().view(b * u, -1)
-		piezo = piezo.contiguous().view(b * u, -1)
+		b, u = audio.shape[:2]
+		# waveforms (b, u, samples) or persisted log-mel features (b, u, 80, frames)
+		audio = audio.contiguous().view(b * u, *audio.shape[2:])
+		piezo = piezo.contiguous().view(b * u, *piezo.shape[2:])
 
 		# if labels != None:
 		# 	tmp_labesl = labels.detach().cpu().numpy()
@@ -154,9 +174,42 @@ class PiezoBudsModel(nn.Module):
 		# return embeddings_audio, embeddings_piezo, self.bn1(self.relu(embeddings_conv)), self.bn2(self.relu(embeddings_cat)), embeddings_piezo_centriods_expand
 		return embeddings_audio, embeddings_piezo, embeddings_conv, F.normalize(embeddings_cat, p=2, dim=-1)
 
+	def infer_training_embeddings(self, audio, piezo, audio_extra, noise):
+		"""
+		The four infer_embedding passes of a training step (real, non-concurrent, audio-audio, audio-white noise)
+		with every unique batch embedded once: encoder_a runs on [audio, audio_extra], encoder_p on [piezo, audio, noise]
+		and the converter on the four (piezo side, audio side) pairs in a single pass.
+		Returns the audio, piezo and converted embeddings of the real pairs and the three other conversions, each (b * u, 192).
+		"""
+		b, u = audio.shape[:2]
+		n = b * u
+		audio, piezo, audio_extra, noise = [x.float().contiguous().view(n, *x.shape[2:]) for x in (audio, piezo, audio_extra, noise)]
+
+		# one fbank per input (specaug is drawn for each one as before), one encoder pass per modality, or one in all with the shared encoder
+		features_a = [self.encoder_a.fbank(x) for x in (audio, audio_extra)]
+		features_p = [self.encoder_p.fbank(x) for x in (piezo, audio, noise)]
+		if self.shared_encoder:
+			embeddings_a, embeddings_p = self.encoder.forward_features(torch.cat(features_a + features_p, dim=0), [(AUDIO, 2 * n), (PIEZO, 3 * n)]).split([2 * n, 3 * n])
+		else:
+			embeddings_a = self.encoder_a.forward_features(torch.cat(features_a, dim=0))
+			embeddings_p = self.encoder_p.forward_features(torch.cat(features_p, dim=0))
+		embeddings_audio, embeddings_audio_extra = embeddings_a.split(n)
+		embeddings_piezo, embeddings_audio_p, embeddings_noise_p = embeddings_p.split(n)
+
+		piezo_side = torch.cat([embeddings_piezo, embeddings_piezo, embeddings_audio_p, embeddings_noise_p], dim=0)
+		audio_side = torch.cat([embeddings_audio, embeddings_audio_extra, embeddings_audio, embeddings_audio], dim=0)
+		log_p_sum, logdet, z_outs = self.converter.forward(piezo_side.contiguous().view(4 * n, 3, 8, 8), audio_side.contiguous().view(4 * n, 3, 8, 8))
+		z_out = self.converter.reverse(z_outs, reconstruct=True)
+		embeddings_conv, non_concurrent_conv, fake_conv_audio_audio, fake_conv_audio_white = z_out.contiguous().view(4 * n, -1).split(n)
+		return embeddings_audio, embeddings_piezo, embeddings_conv, non_concurrent_conv, fake_conv_audio_audio, fake_conv_audio_white
+
 
 
-	def train_network(self, epoch, loader):
+	def train_network(self, epoch, loader, step = None):
+		"""
+		One training epoch. step(audio, piezo, audio_extra, noise, labels) returns the loss of a batch, training_loss
+		by default; distributed training passes its DistributedDataParallel wrapper (distributed.wrap_training_step).
+		"""
 		self.train()
 		## Update the learning rate based on the current epcoh
 		self.scheduler.step(epoch - 1)
@@ -165,60 +218,14 @@ class PiezoBudsModel(nn.Module):
 		for num, (audio, piezo, audio_extra, noise, labels) in enumerate(loader, start = 1):
 			self.zero_grad()
 			labels = torch.LongTensor(labels).to(self.device)
-			b, u = labels.shape
-			labels = labels.contiguous().view(b * u)
-			embedding_audio, embedding_piezo, embedding_conv, embeddings_cat = self.infer_embedding(audio.to(self.device), piezo.to(self.device), labels)
-			_, _, non_concurrent_conv, _ = self.infer_embedding(audio_extra.to(self.device), piezo.to(self.device), None)
-			_, _, fake_conv_audio_audio, _ = self.infer_embedding(audio.to(self.device), audio.to(self.device), None)
-			_, embedding_white_noise, fake_conv_audio_white, _ = self.infer_embedding(audio.to(self.device), noise.to(self.device).float(), None)
-			nloss_a, prec_a       = self.speaker_loss.forward(embedding_audio, labels)
-			nloss_p, prec_p       = self.speaker_loss.forward(embedding_piezo, labels)	
-			# nloss_c, prec_c       = self.speaker_loss.forward(embedding_conv, labels)	
-			# nloss_cat, prec_cat   = self.speaker_loss576.forward(embeddings_cat, labels)
-			# nloss_huber           = self.huber(embedding_piezo, embedding_conv)
-			# nloss_a = self.ge2e_a.forward(embedding_audio.contiguous().view(b, u, -1))
-			
-			# nloss_p = self.ge2e_p.forward(embedding_piezo.contiguous().view(b, u, -1))
-			# nloss_z = self.ge2e_c.forward(embedding_conv.contiguous().view(b, u, -1))
-			embedding_piezo = embedding_piezo.contiguous().view(b, u, -1)
-			embedding_conv = embedding_conv.contiguous().view(b, u, -1)
-			embedding_audio = embedding_audio.contiguous().view(b, u, -1)
-			non_concurrent_conv = non_concurrent_conv.contiguous().view(b, u, -1)
-			fake_conv_audio_audio = fake_conv_audio_audio.contiguous().view(b, u, -1)
-			fake_conv_audio_white = fake_conv_audio_white.contiguous().view(b, u, -1)
-
-			# nloss_apz = self.ge2e_a.forward(torch.concat(
-			# 	[# embedding_piezo, 
-	 		# 	 embedding_conv,
-			# 	 embedding_audio,
-			# 	 ], dim=0
-			# ))
-
-			nloss_apzff = self.ge2e_c.forward(torch.concat(
-				[
-				 # embedding_audio,
-				 # embedding_piezo,
-	 			 embedding_conv,
-				 non_concurrent_conv,
-				 fake_conv_audio_audio,
-				 fake_conv_audio_white
-				], dim=0
-			))
-
-			# nloss_defense = 0.0
-			# for i in range(b):
-			# 	nloss_defense += self.ge2e_c.forward(torch.concat([
-			# 		embedding_conv[i].unsqueeze(0),
-			# 		fake_conv_audio_audio[i].unsqueeze(0),
-			# 		fake_conv_audio_white[i].unsqueeze(0)
-			# 	], dim=0))
-
-
-			# nloss = nloss_a + nloss_p + nloss_cat + nloss_huber
-			nloss = nloss_a + nloss_p + nloss_apzff
+			nloss = (step or self.training_loss)(audio, piezo, audio_extra, noise, labels)
 			nloss.backward()
-			torch.nn.utils.clip_grad_norm_(self.encoder_a.parameters(), 3.0)
-			torch.nn.utils.clip_grad_norm_(self.encoder_p.parameters(), 3.0)
+			if self.shared_encoder:
+				# encoder_a / encoder_p are views of the same trunk: clip it once, so one 3.0 budget covers both modalities
+				torch.nn.utils.clip_grad_norm_(self.encoder.parameters(), 3.0)
+			else:
+				torch.nn.utils.clip_grad_norm_(self.encoder_a.parameters(), 3.0)
+				torch.nn.utils.clip_grad_norm_(self.encoder_p.parameters(), 3.0)
 			torch.nn.utils.clip_grad_norm_(self.converter.parameters(), 3.0)
 			torch.nn.utils.clip_grad_norm_(self.ge2e_a.parameters(), 3.0)
 			torch.nn.utils.clip_grad_norm_(self.ge2e_p.parameters(), 3.0)
@@ -228,18 +235,96 @@ class PiezoBudsModel(nn.Module):
 			# top1 += prec_cat
 			top1 += 0
 			loss += nloss.detach().cpu().numpy()
-			sys.stderr.write(time.strftime("%m-%d %H:%M:%S") + \
-			" [%2d] Lr: %5f, Training: %.2f%%, "    %(epoch, lr, 100 * (num / loader.__len__())) + \
-			" Loss: %.5f, ACC: %2.2f%% \r"        %(loss/(num), top1/index*len(labels)))
-			sys.stderr.flush()
-		sys.stdout.write("\n")
+			if is_main_process():
+				sys.stderr.write(time.strftime("%m-%d %H:%M:%S") + \
+				" [%2d] Lr: %5f, Training: %.2f%%, "    %(epoch, lr, 100 * (num / loader.__len__())) + \
+				" Loss: %.5f, ACC: %2.2f%% \r"        %(loss/(num), top1/index*len(labels)))
+				sys.stderr.flush()
+		if is_main_process():
+			sys.stdout.write("\n")
 		return loss/num, lr, top1/index*len(labels)
+
+	def training_loss(self, audio, piezo, audio_extra, noise, labels):
+		# loss of one batch of (b, u) clips, labels on self.device
+		b, u = labels.shape
+		labels = labels.contiguous().view(b * u)
+		# move every input once, the fbank cache then computes the features of audio once for both encoders
+		audio, piezo, audio_extra, noise = audio.to(self.device), piezo.to(self.device), audio_extra.to(self.device), noise.to(self.device).float()
+		with self.fbank_cache.step():
+			embedding_audio, embedding_piezo, embedding_conv, non_concurrent_conv, fake_conv_audio_audio, fake_conv_audio_white = \
+				self.infer_training_embeddings(audio, piezo, audio_extra, noise)
+		nloss_a, prec_a       = self.speaker_loss.forward(embedding_audio, labels)
+		nloss_p, prec_p       = self.speaker_loss.forward(embedding_piezo, labels)	
+		# nloss_c, prec_c       = self.speaker_loss.forward(embedding_conv, labels)	
+		# nloss_cat, prec_cat   = self.speaker_loss576.forward(embeddings_cat, labels)
+		# nloss_huber           = self.huber(embedding_piezo, embedding_conv)
+		# nloss_a = self.ge2e_a.forward(embedding_audio.contiguous().view(b, u, -1))
+		
+		# nloss_p = self.ge2e_p.forward(embedding_piezo.contiguous().view(b, u, -1))
+		# nloss_z = self.ge2e_c.forward(embedding_conv.contiguous().view(b, u, -1))
+		embedding_piezo = embedding_piezo.contiguous().view(b, u, -1)
+		embedding_conv = embedding_conv.contiguous().view(b, u, -1)
+		embedding_audio = embedding_audio.contiguous().view(b, u, -1)
+		non_concurrent_conv = non_concurrent_conv.contiguous().view(b, u, -1)
+		fake_conv_audio_audio = fake_conv_audio_audio.contiguous().view(b, u, -1)
+		fake_conv_audio_white = fake_conv_audio_white.contiguous().view(b, u, -1)
+
+		# nloss_apz = self.ge2e_a.forward(torch.concat(
+		# 	[# embedding_piezo, 
+ 		# 	 embedding_conv,
+		# 	 embedding_audio,
+		# 	 ], dim=0
+		# ))
+
+		# gather_users puts the users of every rank in the GE2E batch of distributed training, a no-op otherwise
+		nloss_apzff = self.ge2e_c.forward(torch.concat(
+			[
+			 # embedding_audio,
+			 # embedding_piezo,
+ 			 gather_users(embedding_conv),
+			 gather_users(non_concurrent_conv),
+			 gather_users(fake_conv_audio_audio),
+			 gather_users(fake_conv_audio_white)
+			], dim=0
+		))
+
+		# nloss_defense = 0.0
+		# for i in range(b):
+		# 	nloss_defense += self.ge2e_c.forward(torch.concat([
+		# 		embedding_conv[i].unsqueeze(0),
+		# 		fake_conv_audio_audio[i].unsqueeze(0),
+		# 		fake_conv_audio_white[i].unsqueeze(0)
+		# 	], dim=0))
+
+
+		# nloss = nloss_a + nloss_p + nloss_cat + nloss_huber
+		nloss = nloss_a + nloss_p + nloss_apzff
+		return nloss
 	
 	def eval_network(self, eval_list, eval_path, eval_user_total,
 				  eval_user, eval_uttr_enroll, eval_uttr_verify, veri_usr_lst,
 				  eval_noise_type, eval_noise_path, 
 				  eval_motion_type, eval_motion_path,
-				  eval_times=10):
+				  eval_times=10, embed_once=True, eval_draws=1, replay_pool=50):
+		users = [i for i in range(81)]
+		users_list = random.sample(users, eval_user_total)
+		if embed_once:
+			# the same users and rounds on every rank of distributed training, which embed a share of the users each
+			users_list = broadcast_object(users_list)
+			# embed every clip of the evaluated users once and run all rounds over the embedding table
+			noise_types = ['', 'whitenoise', 'conversation', 'cafe', 'restaurant', 'construction']
+			motion_types = ['', 'turn', 'tap', 'clap', 'walk']
+			noise_file = os.path.join(eval_noise_path, noise_types[eval_noise_type] + '.wav') if eval_noise_type != 0 else None
+			motion_file = os.path.join(eval_motion_path, motion_types[eval_motion_type] + '.wav') if eval_motion_type != 0 else None
+			table = EmbeddingTable(self, eval_list, eval_path, users_list, noise_file, motion_file,
+						  draws=eval_draws, replay_pool=max(replay_pool, eval_uttr_verify))
+			evaluator = MonteCarloEvaluator(table, device=self.device, seed=broadcast_object(random.randrange(2 ** 63)))
+			results = evaluator.run(eval_user, eval_uttr_enroll, eval_uttr_verify, eval_times)
+			if is_main_process():
+				for name, m in [('sim_matrix_a.txt', 0), ('sim_matrix_p.txt', 1), ('sim_matrix_z.txt', 2)]:
+					np.savetxt(name, evaluator.last_replay[:, m].cpu().numpy())
+			return summarize(results)
+
 		EERs = []
 		thresholds = []
 		EER_FARs = []
@@ -250,8 +335,6 @@ class PiezoBudsModel(nn.Module):
 		thres_audios = []
 		thres_piezos = []
 		thres_convs = []
-		users = [i for i in range(81)]
-		users_list = random.sample(users, eval_user_total)
 		for i in range(eval_times):
 			EER, EER_FAR, EER_FRR, threshold, FAR_replay, EER_audio, EER_piezo, thres_audio, thres_piezo, thres_conv = self.eval_network_one_time(eval_list, eval_path, eval_user, eval_uttr_enroll, eval_uttr_verify, users_list,
 																			 eval_noise_type, eval_noise_path, 
@@ -280,11 +363,8 @@ class PiezoBudsModel(nn.Module):
 		del piezos
 		torch.cuda.empty_cache()
 		embeddings_audio = embeddings_audio.contiguous()
-		log_p_sum, logdet, z_outs = self.converter.forward(embeddings_piezo.contiguous().view(u, 3, 8, 8), 
-													embeddings_audio.contiguous().view(u, 3, 8, 8))
-		z_out = self.converter.reverse(z_outs, reconstruct=True)
-		# only applicable to biGlow model
-		embeddings_conv = z_out.contiguous().view(u, -1)
+		# forward + reverse(reconstruct=True), on the frozen fast path in eval mode
+		embeddings_conv = self.converter.convert(embeddings_piezo, embeddings_audio)
 		# embeddings_conv = self.bn1(self.fc(embeddings_conv))
 		embeddings_conv = embeddings_conv.contiguous().view(1, u, -1)
 
@@ -295,6 +375,96 @@ class PiezoBudsModel(nn.Module):
 		embeddings_cat = F.normalize(embeddings_cat, p=2, dim=-1)
 		return embeddings_cat, embeddings_conv, embeddings_audio, embeddings_piezo
 
+	def embed_batch(self, audio, piezo, aug=False):
+		"""
+		Embed a (n, samples) batch of audio/piezo clips in a single pass through both encoders and the converter.
+		Returns the audio, piezo and converted embeddings, each of shape (n, 192).
+		No specaug by default, so that enrollment and verification are deterministic.
+		"""
+		return self.embed_features(self.encoder_a.fbank(audio, aug), self.encoder_p.fbank(piezo, aug))
+
+	def embed_features(self, fbank_audio, fbank_piezo):
+		# same as embed_batch, from log-mel features that were already computed (e.g. by streaming.IncrementalFbank)
+		if self.shared_encoder:
+			n = fbank_audio.shape[0]
+			embeddings_audio, embeddings_piezo = self.encoder.forward_features(torch.cat([fbank_audio, fbank_piezo], dim=0), [(AUDIO, n), (PIEZO, fbank_piezo.shape[0])]).split([n, fbank_piezo.shape[0]])
+		else:
+			embeddings_audio = self.encoder_a.forward_features(fbank_audio)
+			embeddings_piezo = self.encoder_p.forward_features(fbank_piezo)
+		embeddings_conv = self.converter.convert(embeddings_piezo, embeddings_audio)
+		return embeddings_audio, embeddings_piezo, embeddings_conv
+
+	def verify_batch(self, audio, piezo, claimed_ids, store, threshold=0.56147, chunk_size=64):
+		"""
+		Verify many attempts, possibly from many users, against the centroids of an EnrollmentStore.
+
+		Args:
+		- audio, piezo: clips of shape (num of attempts, num_frames * 160 + 240), tensor or array
+		- claimed_ids: the user id claimed by every attempt
+		- threshold: threshold on the fused score
+		- chunk_size: attempts are packed into forward passes of exactly this size, the last one is padded
+
+		Returns:
+		- scores (torch.Tensor): fused score (audio + piezo + conv) / 3 of every attempt
+		- decisions (torch.Tensor): scores > threshold
+		- sim_audio, sim_piezo, sim_conv (torch.Tensor): the per-modality scores
+		"""
+		self.eval()
+		audio = torch.as_tensor(numpy.asarray(audio)).float()
+		piezo = torch.as_tensor(numpy.asarray(piezo)).float()
+		n = audio.shape[0]
+		n_pad = (chunk_size - n % chunk_size) % chunk_size
+		if n_pad > 0:
+			audio = torch.cat([audio, audio[-1:].expand(n_pad, -1)], dim=0)
+			piezo = torch.cat([piezo, piezo[-1:].expand(n_pad, -1)], dim=0)
+
+		embeddings = []
+		with torch.no_grad():
+			for start in range(0, n + n_pad, chunk_size):
+				embeddings.append(self.embed_batch(audio[start:start + chunk_size].to(self.device),
+									   piezo[start:start + chunk_size].to(self.device)))
+		embeddings_audio, embeddings_piezo, embeddings_conv = [torch.cat(x, dim=0)[:n] for x in zip(*embeddings)]
+
+		centroids = store.get_centroids(list(claimed_ids), device=self.device).float()
+		sim_audio = F.cosine_similarity(embeddings_audio, centroids[:, 0], dim=-1) + 1e-6
+		sim_piezo = F.cosine_similarity(embeddings_piezo, centroids[:, 1], dim=-1) + 1e-6
+		sim_conv  = F.cosine_similarity(embeddings_conv, centroids[:, 2], dim=-1) + 1e-6
+		scores = (sim_conv + sim_audio + sim_piezo) / 3
+		return scores, scores > threshold, sim_audio, sim_piezo, sim_conv
+
+	def enroll_user(self, store, id, audios, piezos):
+		"""
+		Embed the enrollment clips of user id and add them to an EnrollmentStore.
+		The user's earlier clips are not re-embedded, only the running sums of the store are updated.
+		The clips are embedded like the attempts of verify_batch (embed_batch, no specaug).
+		"""
+		self.eval()
+		with torch.no_grad():
+			audios = torch.from_numpy(numpy.array(audios)).float().to(self.device)
+			piezos = torch.from_numpy(numpy.array(piezos)).float().to(self.device)
+			embeddings_audio, embeddings_piezo, embeddings_conv = self.embed_batch(audios, piezos)
+		store.add(id, embeddings_audio, embeddings_piezo, embeddings_conv)
+		store.flush()
+
+	def enroll_from_list(self, store, eval_list, eval_path, users, eval_uttr_enroll):
+		"""
+		Enroll eval_uttr_enroll random clips of every user in users, skipping users already in the store.
+		"""
+		eval_dict = {}
+		for line in read_list(eval_list, 'test'):
+			id, file_path = int(line.split()[0]), eval_path + line.split()[1]
+			eval_dict.setdefault(id, []).append(file_path)
+		for id in users:
+			if store.is_enrolled(id):
+				continue
+			audios, piezos = [], []
+			for file in random.sample(eval_dict[id], eval_uttr_enroll):
+				audio, _  = soundfile.read(os.path.join(eval_path, file))
+				piezo, _  = soundfile.read(os.path.join(eval_path, file).replace('audio', 'piezo'))
+				audios.append(self.process_wav(audio)[0])
+				piezos.append(self.process_wav(piezo)[0])
+			self.enroll_user(store, id, audios, piezos)
+
 	def eval_network_one_time(self, eval_list, eval_path, eval_user, eval_uttr_enroll, eval_uttr_verify, veri_user_list,
 						   		eval_noise_type, eval_noise_path, 
 				  				eval_motion_type, eval_motion_path):
@@ -302,7 +472,7 @@ class PiezoBudsModel(nn.Module):
 		files = []
 		embeddings = {}
 		eval_dict = {}
-		lines = open(eval_list).read().splitlines()
+		lines = read_list(eval_list, 'test')
 		# lines = random.sample(lines, 4000)
 		for line in lines:
 			id, file_path = int(line.split()[0]), eval_path + line.split()[1]
@@ -333,8 +503,6 @@ class PiezoBudsModel(nn.Module):
 			# data for evaluating network
 			audios = []
 			piezos = []
-			noises = []
-			motions = []
 
 			id_file_list = random.sample(eval_dict[id], total_uttr)
 			for file in id_file_list:
@@ -348,25 +516,19 @@ class PiezoBudsModel(nn.Module):
 				audios.append(audio)
 				piezos.append(piezo)
 
-				if eval_noise_type != 0:
-					noise_types = ['', 'whitenoise', 'conversation', 'cafe', 'restaurant', 'construction']
-					noise_file = os.path.join(eval_noise_path, noise_types[eval_noise_type] + '.wav')
-					noise, _ = soundfile.read(noise_file)
-					noise = self.process_wav(noise)[0]
-					noises.append(noise)
-				if eval_motion_type != 0:
-					motion_types = ['', 'turn', 'tap', 'clap', 'walk']
-					motion_file = os.path.join(eval_motion_path, motion_types[eval_motion_type] + '.wav')
-					motion, _ = soundfile.read(motion_file)
-					motion = self.process_wav(motion)[0]
-					motions.append(motion)
-
+			# one crop of the noise/motion recording per utterance, served from memory by the augmentation bank
+			length = self.num_frames * 160 + 240
 			if eval_noise_type != 0:
+				noise_types = ['', 'whitenoise', 'conversation', 'cafe', 'restaurant', 'construction']
+				noise_file = os.path.join(eval_noise_path, noise_types[eval_noise_type] + '.wav')
+				noises = self.augment_bank.crops(noise_file, total_uttr, length)
 				# audios = (2 * np.array(audios) + np.array(noises)) / 3
 				noises = np.array(noises) / np.max(np.abs(noises))
 				audios = self.add_noise(np.array(audios), noises, 0, 1)
 			if eval_motion_type != 0:
-				motions = np.array(motions)
+				motion_types = ['', 'turn', 'tap', 'clap', 'walk']
+				motion_file = os.path.join(eval_motion_path, motion_types[eval_motion_type] + '.wav')
+				motions = self.augment_bank.crops(motion_file, total_uttr, length)
 				motions = motions / np.max(np.abs(motions))
 				# piezos = (np.array(piezos) + np.array(motions) * 0.5) / 2
 				piezos = self.add_noise(np.array(piezos), np.array(motions), 0, 1)
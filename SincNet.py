@@ -25,6 +25,42 @@ def sinc(band,t_right):
     return y
     
 
+# conv_mode='auto' uses fft_conv1d when kernel_size >= FFT_MIN_KERNEL_SIZE * stride and the waveforms have at least
+# FFT_MIN_SAMPLES samples, where it measured faster than F.conv1d on CPU (80 filters, 0.5 s - 2 s waveforms)
+FFT_MIN_KERNEL_SIZE = 400
+FFT_MIN_SAMPLES = 8000
+
+
+def fft_length(n):
+    # smallest 2^a 3^b 5^c >= n, a fast transform length
+    best = 1 << (n - 1).bit_length()
+    p3 = 1
+    while p3 < best:
+        p35 = p3
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 5
+        p3 *= 3
+    return best
+
+
+def fft_conv1d(waveforms, filters, stride=1, padding=0):
+    """
+    F.conv1d(waveforms, filters, stride=stride, padding=padding) of (batch_size, 1, n_samples) waveforms with
+    (out_channels, 1, kernel_size) filters through the real FFT, O(n log n) instead of O(n * kernel_size) per filter.
+    """
+    if padding > 0:
+        waveforms = F.pad(waveforms, (padding, padding))
+    n, k = waveforms.shape[-1], filters.shape[-1]
+    n_fft = fft_length(n)
+    # cross-correlation, the first n - k + 1 lags of the circular correlation do not wrap around
+    spec = torch.fft.rfft(waveforms, n=n_fft) * torch.fft.rfft(filters[:, 0], n=n_fft).conj()
+    return torch.fft.irfft(spec, n=n_fft)[..., :n - k + 1:stride].contiguous()
+
+
 class SincConv_fast(nn.Module):
     """Sinc-based convolution
     Parameters
@@ -56,7 +92,7 @@ class SincConv_fast(nn.Module):
         return 700 * (10 ** (mel / 2595) - 1)
 
     def __init__(self, out_channels, kernel_size, sample_rate=16000, in_channels=1,
-                 stride=1, padding=0, dilation=1, bias=False, groups=1, min_low_hz=50, min_band_hz=50):
+                 stride=1, padding=0, dilation=1, bias=False, groups=1, min_low_hz=50, min_band_hz=50, conv_mode='auto'):
 
         super(SincConv_fast,self).__init__()
 
@@ -102,18 +138,52 @@ class SincConv_fast(nn.Module):
         # filter frequency band (out_channels, 1)
         self.band_hz_ = nn.Parameter(torch.Tensor(np.diff(hz)).view(-1, 1))
 
-        # Hamming window
-        #self.window_ = torch.hamming_window(self.kernel_size)
-        n_lin=torch.linspace(0, (self.kernel_size/2)-1, steps=int((self.kernel_size/2))) # computing only half of the window
-        self.window_=0.54-0.46*torch.cos(2*math.pi*n_lin/self.kernel_size);
+        # Hamming window, only half of it is computed (non-persistent buffers: they follow .to() and are not in checkpoints)
+        n_lin = torch.linspace(0, (self.kernel_size / 2) - 1, steps=int((self.kernel_size / 2)))
+        self.register_buffer('window_', 0.54 - 0.46 * torch.cos(2 * math.pi * n_lin / self.kernel_size), persistent=False)
 
-
-        # (1, kernel_size/2)
+        # (1, kernel_size/2), due to symmetry only half of the time axis is needed
         n = (self.kernel_size - 1) / 2.0
-        self.n_ = 2*math.pi*torch.arange(-n, 0).view(1, -1) / self.sample_rate # Due to symmetry, I only need half of the time axes
+        self.register_buffer('n_', 2 * math.pi * torch.arange(-n, 0).view(1, -1) / self.sample_rate, persistent=False)
+
+        # 'direct': F.conv1d, 'fft': fft_conv1d, 'auto': fft_conv1d for long kernels on long waveforms
+        if conv_mode not in ('auto', 'direct', 'fft'):
+            raise ValueError('Unknown conv_mode %s' % conv_mode)
+        self.conv_mode = conv_mode
+        self._filters, self._filters_key = None, None
 
- 
+    def build_filters(self):
+        low = self.min_low_hz + torch.abs(self.low_hz_)
+        high = torch.clamp(low + self.min_band_hz + torch.abs(self.band_hz_), self.min_low_hz, self.sample_rate / 2)
+        band = (high - low)[:, 0]
 
+        f_times_t_low = torch.matmul(low, self.n_)
+        f_times_t_high = torch.matmul(high, self.n_)
+
+        band_pass_left = ((torch.sin(f_times_t_high) - torch.sin(f_times_t_low)) / (self.n_ / 2)) * self.window_  # Equivalent of Eq.4 of the reference paper (SPEAKER RECOGNITION FROM RAW WAVEFORM WITH SINCNET). I just have expanded the sinc and simplified the terms. This way I avoid several useless computations.
+        band_pass_center = 2 * band.view(-1, 1)
+        band_pass_right = torch.flip(band_pass_left, dims=[1])
+
+        band_pass = torch.cat([band_pass_left, band_pass_center, band_pass_right], dim=1)
+        band_pass = band_pass / (2 * band[:, None])
+
+        return band_pass.view(self.out_channels, 1, self.kernel_size)
+
+    def get_filters(self):
+        """
+        The filter bank. In inference (eval mode, and no gradient of low_hz_ / band_hz_ needed) it is built once and
+        reused until the parameters change: optimizer steps and load_state_dict bump their versions, .to() moves them.
+        """
+        params = (self.low_hz_, self.band_hz_)
+        if self.training or (torch.is_grad_enabled() and any(p.requires_grad for p in params)):
+            return self.build_filters()
+        key = tuple((p._version, p.data_ptr(), p.device, p.dtype) for p in params)
+        if self._filters_key != key:
+            # a normal tensor even under torch.inference_mode, so it can be used outside of it
+            with torch.inference_mode(False), torch.no_grad():
+                self._filters = self.build_filters()
+            self._filters_key = key
+        return self._filters
 
     def forward(self, waveforms):
         """
@@ -126,40 +196,18 @@ class SincConv_fast(nn.Module):
         features : `torch.Tensor` (batch_size, out_channels, n_samples_out)
             Batch of sinc filters activations.
         """
+        self.filters = self.get_filters()
 
-        self.n_ = self.n_.to(waveforms.device)
-
-        self.window_ = self.window_.to(waveforms.device)
-
-        low = self.min_low_hz  + torch.abs(self.low_hz_)
-        
-        high = torch.clamp(low + self.min_band_hz + torch.abs(self.band_hz_),self.min_low_hz,self.sample_rate/2)
-        band=(high-low)[:,0]
-        
-        f_times_t_low = torch.matmul(low, self.n_)
-        f_times_t_high = torch.matmul(high, self.n_)
-
-        band_pass_left=((torch.sin(f_times_t_high)-torch.sin(f_times_t_low))/(self.n_/2))*self.window_ # Equivalent of Eq.4 of the reference paper (SPEAKER RECOGNITION FROM RAW WAVEFORM WITH SINCNET). I just have expanded the sinc and simplified the terms. This way I avoid several useless computations. 
-        band_pass_center = 2*band.view(-1,1)
-        band_pass_right= torch.flip(band_pass_left,dims=[1])
-        
-        
-        band_pass=torch.cat([band_pass_left,band_pass_center,band_pass_right],dim=1)
-
-        
-        band_pass = band_pass / (2*band[:,None])
-        
-
-        self.filters = (band_pass).view(
-            self.out_channels, 1, self.kernel_size)
-
+        # long kernels on long waveforms are convolved through the FFT
+        use_fft = self.conv_mode == 'fft' or (self.conv_mode == 'auto' and self.kernel_size >= FFT_MIN_KERNEL_SIZE * self.stride
+                                              and waveforms.shape[-1] >= FFT_MIN_SAMPLES)
+        if use_fft and self.dilation == 1 and isinstance(self.padding, int):
+            return fft_conv1d(waveforms, self.filters, stride=self.stride, padding=self.padding)
         return F.conv1d(waveforms, self.filters, stride=self.stride,
                         padding=self.padding, dilation=self.dilation,
-                         bias=None, groups=1) 
+                        bias=None, groups=1)
 
 
-        
-        
 class sinc_conv(nn.Module):
 
     def __init__(self, N_filt,Filt_dim,fs):
@@ -0,0 +1,67 @@
+'''
+Microbenchmark of the Res2Net block (Bottle2neck) of model.py.
+
+Compares, for the three blocks of ECAPA_TDNN and several batch sizes, the former forward (branch outputs grown with
+torch.cat, every BatchNorm applied), the forward with the preallocated branch buffer and the inference forward with
+the BatchNorms folded, checks that the outputs match and prints the inference times and speedups.
+'''
+
+import argparse, time
+import torch
+from model import Bottle2neck
+
+
+def concat_forward(block, x):
+    # the former Bottle2neck.forward
+    residual = x
+    out = block.bn1(block.relu(block.conv1(x)))
+    spx = torch.split(out, block.width, 1)
+    for i in range(block.nums):
+        sp = spx[i] if i == 0 else sp + spx[i]
+        sp = block.bns[i](block.relu(block.convs[i](sp)))
+        out = sp if i == 0 else torch.cat((out, sp), 1)
+    out = torch.cat((out, spx[block.nums]), 1)
+    out = block.se(block.bn3(block.relu(block.conv3(out))))
+    out += residual
+    return out
+
+
+def timed_ms(fn, runs):
+    # fastest of runs calls, less sensitive than the mean to other load on the machine
+    times = []
+    with torch.no_grad():
+        out = fn()
+        for _ in range(runs):
+            tic = time.time()
+            fn()
+            times.append(time.time() - tic)
+    return min(times) * 1000, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Bottle2neck blocks of ECAPA_TDNN')
+    parser.add_argument('--C',           type=int, default=1024)
+    parser.add_argument('--frames',      type=int, default=202, help='Frames of the block input, 202 for num_frames=200')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 64])
+    parser.add_argument('--runs',        type=int, default=10)
+    parser.add_argument('--threads',     type=int, default=0, help='CPU threads, 0 for the torch default')
+    parser.add_argument('--device',      type=str, default='cpu')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    print('%-18s %5s %12s %12s %12s %8s %10s' % ('block', 'batch', 'before (ms)', 'buffer (ms)', 'fused (ms)', 'speedup', 'max diff'))
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, args.C, args.frames, device=args.device)
+        for name, dilation in [('layer1', 2), ('layer2', 3), ('layer3', 4)]:
+            block = Bottle2neck(args.C, args.C, kernel_size=3, dilation=dilation, scale=8).to(args.device)
+            # non-trivial running statistics, so that the folding is exercised
+            with torch.no_grad():
+                for _ in range(3):
+                    block(torch.randn_like(x) * 2 + 1)
+            block.eval()
+            before, ref = timed_ms(lambda: concat_forward(block, x), args.runs)
+            buffer, _ = timed_ms(lambda: block.forward_reference(x), args.runs)
+            after, out = timed_ms(lambda: block(x), args.runs)
+            print('%-18s %5d %12.2f %12.2f %12.2f %7.2fx %10.2e' % ('%s dilation %d' % (name, dilation), batch_size,
+                                                                    before, buffer, after, before / after, (out - ref).abs().max()))
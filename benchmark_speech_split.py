@@ -0,0 +1,139 @@
+'''
+Regression check and benchmark of the VAD and clip slicing of speech_split.py / extract_feature.py.
+
+Runs the former per-frame-list apply_vad, split_audio_to_utterances and concatenate-based slice_audio next to
+the current ones on a synthetic recording (silence, noise and voiced bursts of random lengths), checks that the
+labels (min_rms pre-gate off), utterances and clips are identical and prints their times. It then counts, per VAD
+mode, the labels that the opt-in min_rms pre-gate changes on the frames it still passes to webrtcvad, which
+webrtcvad's hangover state makes non-zero.
+'''
+
+import argparse, time
+import numpy as np
+import webrtcvad
+from speech_split import apply_vad, split_audio_to_utterances
+from extract_feature import slice_audio
+
+
+def old_apply_vad(audio, sr, vad_level=3, frame_duration=30):
+    # the former speech_split.apply_vad
+    vad = webrtcvad.Vad()
+    vad.set_mode(vad_level)
+
+    frame_samples = int(sr * frame_duration / 1000)
+    num_frames = len(audio) // frame_samples
+    audio_frames = [audio[i:i + frame_samples] for i in range(0, len(audio), frame_samples)]
+    audio_frames = audio_frames[:num_frames]
+    audio_frames = [np.round(frame * 32767).astype(np.int16) for frame in audio_frames]
+    return [vad.is_speech(audio_frames[i].tobytes(), sample_rate=sr) for i in range(num_frames)]
+
+
+def old_split_audio_to_utterances(audio, sr, speech_labels, frame_duration=30, min_speech_duration=500):
+    # the former speech_split.split_audio_to_utterances
+    frame_samples = int(sr * frame_duration / 1000)
+    speech_starts = np.where(np.diff(np.array([0] + speech_labels + [0])) == 1)[0]
+    speech_ends = np.where(np.diff(np.array([0] + speech_labels + [0])) == -1)[0]
+    min_speech_samples = int(sr * min_speech_duration / 1000)
+    speech_utterances = []
+    for start, end in zip(speech_starts, speech_ends):
+        if (end - start) * frame_samples >= min_speech_samples:
+            speech_utterances.append((start * frame_samples, end * frame_samples))
+    return speech_utterances
+
+
+def old_slice_audio(audio_data, sample_rate, window_size_ms):
+    # the former extract_feature.slice_audio
+    window_size_samples = int((window_size_ms / 1000) * sample_rate)
+    num_clips = int(np.ceil(len(audio_data) / window_size_samples))
+    audio_clips = []
+    for i in range(num_clips):
+        start_index = i * window_size_samples
+        end_index = start_index + window_size_samples
+        if end_index > len(audio_data):
+            last_clip = audio_data[start_index:]
+            padding_needed = window_size_samples - len(last_clip)
+            audio_clips.append(np.concatenate((audio_data[-(padding_needed + len(last_clip)):-len(last_clip)], last_clip)))
+        else:
+            audio_clips.append(audio_data[start_index:end_index])
+    return audio_clips
+
+
+def synthetic_recording(seconds, sr, rng):
+    # alternating silence, low noise and voiced bursts (harmonics of a random pitch with a syllable envelope)
+    pieces, total = [], 0
+    while total < seconds * sr:
+        n = int(rng.uniform(0.2, 3.0) * sr)
+        kind = rng.integers(3)
+        if kind == 0:
+            piece = np.zeros(n)
+        elif kind == 1:
+            piece = rng.standard_normal(n) * rng.uniform(1e-5, 1e-3)
+        else:
+            t = np.arange(n) / sr
+            f0 = rng.uniform(90, 300)
+            piece = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in range(1, 8))
+            piece *= np.abs(np.sin(2 * np.pi * rng.uniform(2, 6) * t)) * rng.uniform(0.05, 0.3)
+            piece += rng.standard_normal(n) * 1e-3
+        pieces.append(piece)
+        total += n
+    return np.clip(np.concatenate(pieces)[:seconds * sr], -1, 1)
+
+
+def timed_ms(fn, runs):
+    out = fn()
+    tic = time.time()
+    for _ in range(runs):
+        fn()
+    return (time.time() - tic) / runs * 1000, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and benchmark speech_split.apply_vad and extract_feature.slice_audio')
+    parser.add_argument('--seconds',        type=int,   default=600, help='Length of the synthetic recording')
+    parser.add_argument('--frame_duration', type=int,   default=30)
+    parser.add_argument('--min_rms',        type=float, default=2.0, help='Pre-gate (16-bit units) whose label changes are counted')
+    parser.add_argument('--runs',           type=int,   default=3)
+    parser.add_argument('--seed',           type=int,   default=0)
+    args = parser.parse_args()
+
+    sr = 16000
+    audio = synthetic_recording(args.seconds, sr, np.random.default_rng(args.seed))
+    identical = True
+
+    print('%-28s %12s %12s %8s %10s' % ('function', 'before (ms)', 'after (ms)', 'speedup', 'identical'))
+    for mode in range(4):
+        before, ref = timed_ms(lambda: old_apply_vad(audio, sr, mode, args.frame_duration), args.runs)
+        after, out = timed_ms(lambda: apply_vad(audio, sr, mode, args.frame_duration), args.runs)
+        same = out.tolist() == ref
+        print('%-28s %12.2f %12.2f %7.1fx %10s' % ('apply_vad mode %d' % mode, before, after, before / after, same))
+        for min_speech_duration in [500, 1000]:
+            utterances_ref = old_split_audio_to_utterances(audio, sr, ref, args.frame_duration, min_speech_duration)
+            utterances = split_audio_to_utterances(audio, sr, out, args.frame_duration, min_speech_duration)
+            same_utterances = utterances == utterances_ref
+            print('%-28s %12s %12s %8s %10s' % ('  utterances >= %d ms' % min_speech_duration, '', '', '', same_utterances))
+            same = same and same_utterances
+        identical = identical and same
+
+    # whole windows, a short last clip, and pieces shorter than one window
+    for length in [len(audio), len(audio) - 1234, 8000 * 3 + 17, 5000]:
+        piece = audio[:length]
+        before, ref = timed_ms(lambda: old_slice_audio(piece, sr, 500), args.runs)
+        after, out = timed_ms(lambda: slice_audio(piece, sr, 500), args.runs)
+        same = len(out) == len(ref) and all(a.shape == b.shape and (a == b).all() for a, b in zip(out, ref))
+        print('%-28s %12.2f %12.2f %7.1fx %10s' % ('slice_audio %d samples' % length, before, after, before / after, same))
+        identical = identical and same
+
+    # frames at most min_rms are silence by design; among the frames still passed to webrtcvad, a changed label
+    # comes from the hangover state of the frames the gate skipped
+    print('\nmin_rms %.1f pre-gate against the ungated VAD:' % args.min_rms)
+    frame_samples = int(sr * args.frame_duration / 1000)
+    pcm = np.round(audio[:len(audio) // frame_samples * frame_samples] * 32767).reshape(-1, frame_samples)
+    gated_out = np.sqrt((pcm ** 2).mean(axis=1)) <= args.min_rms
+    for mode in range(4):
+        ungated = apply_vad(audio, sr, mode, args.frame_duration)
+        gated = apply_vad(audio, sr, mode, args.frame_duration, args.min_rms)
+        print('  mode %d: %d of %d frames gated out (%d of them speech without the gate), %d labels changed among the others' % (
+            mode, gated_out.sum(), len(ungated), ungated[gated_out].sum(), (gated != ungated)[~gated_out].sum()))
+
+    if not identical:
+        raise SystemExit('The current implementations differ from the former ones')
@@ -0,0 +1,71 @@
+'''
+Microbenchmark of the time-delay layers of Define_Model/TDNN/TDNN.py.
+
+Compares, for several contexts and utterance lengths, the former per-step loop of TimeDelayLayer_v1
+(index_select + conv1d per valid step) and the former unfold + Linear of TimeDelayLayer_v2 with the single
+convolution they now use, checks that the outputs match and prints the forward times and speedups.
+'''
+
+import argparse, time
+import torch
+import torch.nn.functional as F
+from Define_Model.TDNN.TDNN import TimeDelayLayer_v1, TimeDelayLayer_v2
+
+
+def loop_v1(layer, x):
+    # the former TimeDelayLayer_v1.special_convolution
+    x = x.squeeze(1)
+    valid_steps = layer.get_valid_steps(layer.context_offsets, x.shape[2])
+    xs = x.new_zeros(x.shape[0], layer.kernel.shape[0], len(valid_steps))
+    for c, i in enumerate(valid_steps):
+        features = torch.index_select(x, 2, layer.context + i)
+        xs[:, :, c] = F.conv1d(features, layer.kernel, bias=layer.bias)[:, :, 0]
+    return xs
+
+
+def unfold_v2(layer, x):
+    # the former affine part of TimeDelayLayer_v2.forward
+    x = F.unfold(x.unsqueeze(1), (layer.context_size, layer.input_dim), stride=(1, layer.input_dim), dilation=(layer.dilation, 1))
+    return layer.kernel(x.transpose(1, 2))
+
+
+def affine_v2(layer, x):
+    weight = layer.kernel.weight.view(layer.output_dim, layer.context_size, layer.input_dim).transpose(1, 2)
+    return F.conv1d(x.transpose(1, 2), weight, layer.kernel.bias, dilation=layer.dilation).transpose(1, 2)
+
+
+def timed_ms(fn, runs):
+    with torch.no_grad():
+        out = fn()
+        tic = time.time()
+        for _ in range(runs):
+            fn()
+    return (time.time() - tic) / runs * 1000, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the time-delay layers of Define_Model/TDNN')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--input_dim',  type=int, default=64)
+    parser.add_argument('--output_dim', type=int, default=512)
+    parser.add_argument('--lengths',    type=int, nargs='+', default=[200, 1000])
+    parser.add_argument('--runs',       type=int, default=5)
+    parser.add_argument('--device',     type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print('%-28s %6s %12s %12s %8s %10s' % ('layer / context', 'frames', 'before (ms)', 'after (ms)', 'speedup', 'max diff'))
+    for length in args.lengths:
+        x = torch.randn(args.batch_size, 1, args.input_dim, length, device=args.device)
+        for context, full in [([-2, 2], True), ([-3, 0, 3], False), ([-7, 7], True), ([-4, -1, 0, 3, 7], False)]:
+            layer = TimeDelayLayer_v1(context, args.input_dim, args.output_dim, full).to(args.device)
+            before, ref = timed_ms(lambda: loop_v1(layer, x), args.runs)
+            after, out = timed_ms(lambda: layer(x), args.runs)
+            print('%-28s %6d %12.2f %12.2f %7.1fx %10.2e' % ('v1 %s%s' % (context, ' full' if full else ''), length,
+                                                            before, after, before / after, (out - ref).abs().max()))
+        x = torch.randn(args.batch_size, length, args.input_dim, device=args.device)
+        for context_size, dilation in [(5, 1), (3, 2), (3, 4), (1, 1)]:
+            layer = TimeDelayLayer_v2(args.input_dim, args.output_dim, context_size, dilation=dilation).to(args.device)
+            before, ref = timed_ms(lambda: unfold_v2(layer, x), args.runs)
+            after, out = timed_ms(lambda: affine_v2(layer, x), args.runs)
+            print('%-28s %6d %12.2f %12.2f %7.1fx %10.2e' % ('v2 size %d dilation %d' % (context_size, dilation), length,
+                                                            before, after, before / after, (out - ref).abs().max()))
@@ -186,7 +186,7 @@ class AffineCoupling(nn.Module):
         self.net[2].weight.data.normal_(0, 0.05)
         self.net[2].bias.data.zero_()
 
-    def forward(self, input):
+    def forward(self, input, with_logdet=True):
         if self.condition_size != None:
             input, condition = input
         
@@ -216,7 +216,7 @@ class AffineCoupling(nn.Module):
             # out_a = s * in_a + t
             out_b = (in_b + t) * s
 
-            logdet = torch.sum(torch.log(s).view(input.shape[0], -1), 1)
+            logdet = torch.sum(torch.log(s).view(input.shape[0], -1), 1) if with_logdet else None
 
         else:
             if self.condition_size != None:
@@ -314,6 +314,40 @@ class Flow(nn.Module):
 
         return input
 
+    def freeze(self):
+        # fold ActNorm into the 1x1 convolution and cache its inverse, for forward_fast and reverse_fast
+        with torch.no_grad():
+            if isinstance(self.invconv, InvConv2dLU):
+                weight = self.invconv.calc_weight().squeeze(3).squeeze(2)
+            else:
+                weight = self.invconv.weight.squeeze(3).squeeze(2)
+            scale = self.actnorm.scale.view(-1)
+            loc = self.actnorm.loc.view(-1)
+            # W (scale * (x + loc)) = (W diag(scale)) x + W (scale * loc)
+            self.frozen_weight = (weight * scale.unsqueeze(0)).unsqueeze(2).unsqueeze(3)
+            self.frozen_bias = weight @ (scale * loc)
+            # actnorm.reverse(invconv.reverse(y)) = diag(1 / (scale - loc + 1e-8)) W^-1 y
+            self.frozen_weight_inv = (weight.inverse() / (scale - loc + 1e-8).unsqueeze(1)).unsqueeze(2).unsqueeze(3)
+
+    def forward_fast(self, input):
+        # forward with the weights cached by freeze, without logdet
+        if self.condition_size != None:
+            input, condition = input
+        out = F.conv2d(input, self.frozen_weight, self.frozen_bias)
+        if self.condition_size != None:
+            out, _ = self.coupling((out, condition), with_logdet=False)
+        else:
+            out, _ = self.coupling(out, with_logdet=False)
+        return out
+
+    def reverse_fast(self, output):
+        if self.condition_size != None:
+            output, condition = output
+            input = self.coupling.reverse((output, condition))
+        else:
+            input = self.coupling.reverse(output)
+        return F.conv2d(input, self.frozen_weight_inv)
+
 
 def gaussian_log_p(x, mean, log_sd):
     return -0.5 * log(2 * pi) - log_sd - 0.5 * (x - mean) ** 2 / (torch.exp(2 * log_sd) + 1e-5)
@@ -376,6 +410,45 @@ class Block(nn.Module):
 
         return out, logdet, log_p, z_new
 
+    def forward_fast(self, input):
+        # forward without logdet and log_p (no prior), for Flow.freeze-d flows
+        if self.condition_size != None:
+            input, condition = input
+
+        b_size, n_channel, height, width = input.shape
+        squeezed = input.view(b_size, n_channel, height // 2, 2, width // 2, 2)
+        squeezed = squeezed.permute(0, 1, 3, 5, 2, 4)
+        out = squeezed.reshape(b_size, n_channel * 4, height // 2, width // 2)
+
+        for flow in self.flows:
+            if self.condition_size != None:
+                out = flow.forward_fast((out, condition))
+            else:
+                out = flow.forward_fast(out)
+
+        if self.split:
+            out, z_new = out.chunk(2, 1)
+        else:
+            z_new = out
+        return out, z_new
+
+    def reverse_fast(self, output, eps):
+        # reverse(output, eps, reconstruct=True) for Flow.freeze-d flows
+        if self.condition_size != None:
+            output, condition = output
+
+        input = torch.cat([output, eps], 1) if self.split else eps
+        for flow in self.flows[::-1]:
+            if self.condition_size != None:
+                input = flow.reverse_fast((input, condition))
+            else:
+                input = flow.reverse_fast(input)
+
+        b_size, n_channel, height, width = input.shape
+        unsqueezed = input.view(b_size, n_channel // 4, 2, 2, height, width)
+        unsqueezed = unsqueezed.permute(0, 1, 4, 2, 5, 3)
+        return unsqueezed.reshape(b_size, n_channel // 4, height * 2, width * 2)
+
     def reverse(self, output, eps=None, reconstruct=False):
         if self.condition_size != None:
             output, condition = output
@@ -416,11 +489,53 @@ class Block(nn.Module):
 
         return unsqueezed
 
-class conditionGlow(nn.Module):
+class FrozenInference(object):
+    '''
+    Frozen inference for conditionGlow / biGlow. In eval mode convert() runs forward + reverse(reconstruct=True)
+    with the folded weights and inverses cached by Flow.freeze, without logdet / log_p and without the ActNorm
+    initialization check (a device sync on every call). The cache is rebuilt when a parameter changed in place
+    (optimizer step, load_state_dict) or the model moved to another device; in train mode convert() uses the
+    reference forward / reverse so that gradients flow.
+    '''
+    frozen_key = None
+
+    def _frozen_key(self):
+        return [p._version for p in self.parameters()], next(self.parameters()).device
+
+    def freeze(self):
+        if not all(m.initialized.item() for m in self.modules() if isinstance(m, ActNorm)):
+            # ActNorm still has to initialize itself on the first batch, stay on the reference path
+            return False
+        for m in self.modules():
+            if isinstance(m, Flow):
+                m.freeze()
+        self.frozen_key = self._frozen_key()
+        return True
+
+    def unfreeze(self):
+        self.frozen_key = None
+
+    def frozen_ready(self):
+        if self.training:
+            return False
+        if self.frozen_key is None or self.frozen_key != self._frozen_key():
+            return self.freeze()
+        return True
+
+    def as_image(self, x):
+        # (n, dim) embeddings -> (n, in_channel, side, side)
+        if x.dim() == 4:
+            return x
+        side = int(round((int(x.shape[1]) // self.in_channel) ** 0.5))
+        return x.reshape(x.shape[0], self.in_channel, side, side)
+
+
+class conditionGlow(FrozenInference, nn.Module):
     def __init__(
         self, in_channel, n_flow, n_block, affine=True, conv_lu=True, use_bi_flow=False
     ):
         super().__init__()
+        self.in_channel = in_channel
         self.blocks_input = nn.ModuleList()
         self.blocks_condition = nn.ModuleList()
         self.n_block = n_block
@@ -473,12 +588,39 @@ class conditionGlow(nn.Module):
                 input = block.reverse((input, condition_list[-(i + 1)]), z_list[-(i + 1)], reconstruct=reconstruct)
         
         return input
+
+    def convert(self, input, condition):
+        '''
+        reverse(forward(input, condition), reconstruct=True) in a single call, e.g. convert(piezo_emb, audio_emb).
+        Takes (n, dim) or (n, c, h, w) embeddings and returns (n, dim).
+        '''
+        n = input.shape[0]
+        input, condition = self.as_image(input), self.as_image(condition)
+        if not self.frozen_ready():
+            _, _, z_outs = self.forward(input, condition)
+            return self.reverse(z_outs, reconstruct=True).contiguous().view(n, -1)
+
+        out_i, out_c = input, condition
+        z_outs_i, z_outs_c = [], []
+        for i in range(self.n_block):
+            out_c, z_new_c = self.blocks_condition[i].forward_fast(out_c)
+            out_i, z_new_i = self.blocks_input[i].forward_fast((out_i, z_new_c))
+            z_outs_i.append(z_new_i)
+            z_outs_c.append(z_new_c)
+
+        for i, block in enumerate(self.blocks_input[::-1]):
+            if i == 0:
+                out = block.reverse_fast((z_outs_i[-1], z_outs_c[-1]), z_outs_i[-1])
+            else:
+                out = block.reverse_fast((out, z_outs_c[-(i + 1)]), z_outs_i[-(i + 1)])
+        return out.reshape(n, -1)
     
-class biGlow(nn.Module):
+class biGlow(FrozenInference, nn.Module):
     def __init__(
         self, in_channel, n_flow, n_block, affine=True, conv_lu=True, use_bi_flow=True
     ):
         super().__init__()
+        self.in_channel = in_channel
         self.blocks_input = nn.ModuleList()
         self.blocks_condition = nn.ModuleList()
         self.n_block = n_block
@@ -543,6 +685,26 @@ class biGlow(nn.Module):
         
         return (input_i, input_c)
 
+    def convert(self, input, condition):
+        '''
+        reverse(forward(input, condition), reconstruct=True) in a single call.
+        Takes (n, dim) or (n, c, h, w) embeddings and returns the two reconstructions as (n, dim).
+        '''
+        n = input.shape[0]
+        input, condition = self.as_image(input), self.as_image(condition)
+        if not self.frozen_ready():
+            _, _, z_outs = self.forward(input, condition)
+            input_i, input_c = self.reverse(z_outs, reconstruct=True)
+            return input_i.contiguous().view(n, -1), input_c.contiguous().view(n, -1)
+
+        # reverse() overwrites its result in every iteration and returns the one of the first blocks,
+        # which only depends on their own z, so the other blocks do not contribute to the output
+        _, z_i = self.blocks_input[0].forward_fast(input)
+        _, z_c = self.blocks_condition[0].forward_fast(condition)
+        input_i = self.blocks_input[0].reverse_fast(z_i, z_i)
+        input_c = self.blocks_condition[0].reverse_fast(z_c, z_c)
+        return input_i.contiguous().view(n, -1), input_c.contiguous().view(n, -1)
+
 if __name__=='__main__':
     input = torch.rand((10, 3, 8, 8))
     target = torch.rand((10, 3, 8, 8))
@@ -0,0 +1,223 @@
+'''
+Cascaded early-exit verification for PiezoBuds.
+
+eval_network_one_time accepts an attempt only if its piezo, converted and audio scores are all above their thresholds,
+and verify_batch computes all three embeddings, the converter pass included, for every attempt. CascadedVerifier
+evaluates the modalities one stage at a time, in a configurable order, and only for the attempts that are still
+unresolved:
+- an attempt whose score of the stage is not above the reject threshold of the stage is rejected there
+- an attempt whose score is at or above the accept threshold of the stage (if any) is accepted there
+- the attempts that pass the reject threshold of the last stage are accepted
+With the default thresholds (those of eval_network_one_time) and no accept thresholds the decisions are those of the
+AND rule; most impostor and replay attempts are rejected by the piezo stage without running encoder_a or the
+converter. An accept threshold skips the remaining checks, so it only belongs on a stage that replay cannot pass.
+
+Attempts are embedded like the enrollment clips of PiezoBudsModel.enroll_user and the attempts of verify_batch
+(embed_batch: the fbank of every encoder without specaug, then forward_features), so the scores are those of
+verify_batch. Run as a script, it enrolls the users of an eval list into an EnrollmentStore, builds genuine, impostor
+and replay attempts (as eval_network_one_time) and reports, per attempt type, the fraction resolved at every stage,
+the agreement with the AND rule on the three scores of verify_batch and the time of both.
+'''
+
+import argparse, os, random, tempfile, time
+import numpy as np
+import soundfile
+import torch
+import torch.nn.functional as F
+from enrollment_store import EnrollmentStore, MODALITIES
+from split_manifest import read_list
+
+# thresholds of the AND rule of eval_network_one_time
+REJECT_THRESHOLDS = {'audio': 0.5190, 'piezo': 0.60798, 'conv': 0.68924}
+# embeddings every stage needs, the converter maps the piezo embedding with the audio one
+STAGE_INPUTS = {'audio': ['audio'], 'piezo': ['piezo'], 'conv': ['audio', 'piezo']}
+
+
+class CascadedVerifier(object):
+    """
+    Early-exit verification of a PiezoBudsModel against the centroids of an EnrollmentStore.
+
+    - stages: modalities in the order they are checked, any order of a subset of 'audio', 'piezo', 'conv'
+    - reject: {modality: threshold}, rejected if the score is not above it, REJECT_THRESHOLDS for the missing ones
+    - accept: {modality: threshold}, accepted if the score is at or above it, no early accept for the missing ones
+    """
+    def __init__(self, s, store, stages=('piezo', 'audio', 'conv'), reject=None, accept=None, chunk_size=64):
+        for stage in stages:
+            if stage not in STAGE_INPUTS:
+                raise ValueError('Unknown stage %s, stages are %s' % (stage, list(STAGE_INPUTS)))
+        if len(set(stages)) != len(stages) or len(stages) == 0:
+            raise ValueError('Stages must be distinct and not empty, got %s' % list(stages))
+        self.s = s
+        self.store = store
+        self.stages = list(stages)
+        self.reject = dict(REJECT_THRESHOLDS, **(reject or {}))
+        self.accept = dict(accept or {})
+        self.chunk_size = chunk_size
+
+    def embed(self, modality, x):
+        # one modality of PiezoBudsModel.embed_batch
+        encoder = self.s.encoder_a if modality == 'audio' else self.s.encoder_p
+        return torch.cat([encoder.forward_features(encoder.fbank(x[start:start + self.chunk_size].to(self.s.device), aug=False))
+                          for start in range(0, x.shape[0], self.chunk_size)], dim=0)
+
+    def verify(self, audio, piezo, claimed_ids):
+        """
+        Args:
+        - audio, piezo: clips of shape (num of attempts, num_frames * 160 + 240), tensor or array
+        - claimed_ids: the user id claimed by every attempt
+
+        Returns:
+        - decisions (torch.Tensor): bool, accepted attempts
+        - resolved (torch.Tensor): index in stages of the stage that decided every attempt
+        - sims (torch.Tensor): (num of attempts, 3) audio / piezo / conv scores, nan where not computed
+        """
+        self.s.eval()
+        inputs = {'audio': torch.as_tensor(np.asarray(audio)).float(), 'piezo': torch.as_tensor(np.asarray(piezo)).float()}
+        n = inputs['audio'].shape[0]
+        centroids = self.store.get_centroids(list(claimed_ids), device=self.s.device).float()
+        embeddings = {m: torch.zeros(n, centroids.shape[-1], device=self.s.device) for m in MODALITIES}
+        computed = {m: torch.zeros(n, dtype=torch.bool) for m in MODALITIES}
+        sims = torch.full((n, 3), float('nan'))
+        decisions = torch.zeros(n, dtype=torch.bool)
+        resolved = torch.full((n,), len(self.stages) - 1, dtype=torch.long)
+        active = torch.arange(n)
+        with torch.no_grad():
+            for k, stage in enumerate(self.stages):
+                if len(active) == 0:
+                    break
+                # embed the active attempts for the inputs of the stage that earlier stages did not embed
+                for modality in STAGE_INPUTS[stage]:
+                    missing = active[~computed[modality][active]]
+                    if len(missing) > 0:
+                        embeddings[modality][missing] = self.embed(modality, inputs[modality][missing])
+                        computed[modality][missing] = True
+                if stage == 'conv':
+                    embeddings['conv'][active] = self.s.converter.convert(embeddings['piezo'][active], embeddings['audio'][active])
+                m = MODALITIES.index(stage)
+                sim = (F.cosine_similarity(embeddings[stage][active], centroids[active, m], dim=-1) + 1e-6).cpu()
+                sims[active, m] = sim
+                rejected = sim <= self.reject[stage]
+                if k == len(self.stages) - 1:
+                    accepted = ~rejected
+                else:
+                    accepted = ~rejected & (sim >= self.accept.get(stage, float('inf')))
+                decisions[active[accepted]] = True
+                resolved[active[rejected | accepted]] = k
+                active = active[~(rejected | accepted)]
+        return decisions, resolved, sims
+
+    def resolved_fractions(self, resolved):
+        # fraction of the attempts decided at every stage
+        counts = torch.bincount(resolved, minlength=len(self.stages)).float()
+        return (counts / max(len(resolved), 1)).tolist()
+
+
+def full_verify(s, store, audio, piezo, claimed_ids, reject=None, chunk_size=64):
+    # the three scores of verify_batch for every attempt and the AND rule of eval_network_one_time, the reference of the cascade
+    reject = dict(REJECT_THRESHOLDS, **(reject or {}))
+    # no padding of a set smaller than a chunk, which would only slow the reference down
+    chunk_size = max(1, min(chunk_size, len(claimed_ids)))
+    _, _, sim_audio, sim_piezo, sim_conv = s.verify_batch(audio, piezo, claimed_ids, store, chunk_size=chunk_size)
+    sims = torch.stack([sim_audio, sim_piezo, sim_conv], dim=1).cpu()
+    thresholds = torch.tensor([reject[m] for m in MODALITIES])
+    return (sims > thresholds).all(dim=1), sims
+
+
+def parse_thresholds(items):
+    # ['piezo=0.6', ...] -> {'piezo': 0.6}
+    thresholds = {}
+    for item in items:
+        modality, value = item.split('=')
+        if modality not in STAGE_INPUTS:
+            raise ValueError('Unknown modality %s in %s' % (modality, item))
+        thresholds[modality] = float(value)
+    return thresholds
+
+
+def build_attempts(s, store, eval_list, eval_path, n_users, eval_uttr_enroll, eval_uttr_verify):
+    # enroll eval_uttr_enroll clips of every user (enroll_user, embedded as verify_batch embeds the attempts), the next
+    # eval_uttr_verify clips are the genuine attempts, the same clips claiming another user the impostor ones, and
+    # mixtures of two clips of the user in both channels the replay ones
+    eval_dict = {}
+    for line in read_list(eval_list, 'test'):
+        eval_dict.setdefault(int(line.split()[0]), []).append(os.path.join(eval_path, line.split()[1]))
+    users = sorted(eval_dict)
+    users = random.sample(users, min(n_users, len(users)))
+    read = lambda path: s.process_wav(soundfile.read(path)[0])[0]
+    attempts = {'genuine': ([], [], []), 'impostor': ([], [], []), 'replay': ([], [], [])}
+    for id in users:
+        files = random.sample(eval_dict[id], eval_uttr_enroll + eval_uttr_verify)
+        audios = [read(file) for file in files]
+        piezos = [read(file.replace('audio', 'piezo')) for file in files]
+        s.enroll_user(store, id, audios[:eval_uttr_enroll], piezos[:eval_uttr_enroll])
+        others = [u for u in users if u != id]
+        for i in range(eval_uttr_enroll, len(files)):
+            replay = audios[i] + audios[random.choice([j for j in range(len(files)) if j != i])]
+            replay = replay / np.max(np.abs(replay))
+            for name, audio, piezo, claimed in [('genuine', audios[i], piezos[i], id), ('impostor', audios[i], piezos[i], random.choice(others)),
+                                                ('replay', replay, replay, id)]:
+                attempts[name][0].append(audio)
+                attempts[name][1].append(piezo)
+                attempts[name][2].append(claimed)
+    return {name: (torch.from_numpy(np.array(a)).float(), torch.from_numpy(np.array(p)).float(), ids) for name, (a, p, ids) in attempts.items()}
+
+
+if __name__ == '__main__':
+    from PiezoBudsModel import PiezoBudsModel
+
+    parser = argparse.ArgumentParser(description='Cascaded early-exit verification: stage mix, agreement with the AND rule and time')
+    parser.add_argument('--initial_model',    type=str,   required=True, help='Path of the PiezoBuds model')
+    parser.add_argument('--eval_list',        type=str,   required=True)
+    parser.add_argument('--eval_path',        type=str,   default='')
+    parser.add_argument('--store_path',       type=str,   default='', help='EnrollmentStore of the run, a temporary directory if empty')
+    parser.add_argument('--stages',           type=str,   nargs='+', default=['piezo', 'audio', 'conv'], choices=list(STAGE_INPUTS))
+    parser.add_argument('--reject',           type=str,   nargs='*', default=[], help='Reject thresholds as modality=value, those of eval_network_one_time otherwise')
+    parser.add_argument('--accept',           type=str,   nargs='*', default=[], help='Early accept thresholds as modality=value, none otherwise')
+    parser.add_argument('--eval_user',        type=int,   default=10)
+    parser.add_argument('--eval_uttr_enroll', type=int,   default=8)
+    parser.add_argument('--eval_uttr_verify', type=int,   default=4)
+    parser.add_argument('--chunk_size',       type=int,   default=64)
+    parser.add_argument('--num_frames',       type=int,   default=50)
+    parser.add_argument('--C',                type=int,   default=1024)
+    parser.add_argument('--C_p',              type=int,   default=0, help='Channel size of the piezo encoder, 0 for C')
+    parser.add_argument('--piezo_front_end',  type=str,   default='full', choices=['full', 'piezo', 'band'])
+    parser.add_argument('--shared_encoder',   dest='shared_encoder', action='store_true', help='The model has one trunk for both modalities')
+    parser.add_argument('--adapter_dim',      type=int,   default=0)
+    parser.add_argument('--n_class',          type=int,   default=81)
+    parser.add_argument('--threads',          type=int,   default=0, help='CPU threads of the timing, 0 for the torch default')
+    parser.add_argument('--seed',             type=int,   default=0)
+    parser.add_argument('--device',           type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    s = PiezoBudsModel(lr=0.001, lr_decay=0.97, C=args.C, n_class=args.n_class, m=0.2, s=30, test_step=50,
+                       device=args.device, num_frames=args.num_frames, C_p=args.C_p, piezo_front_end=args.piezo_front_end,
+                       shared_encoder=args.shared_encoder, adapter_dim=args.adapter_dim)
+    s.load_parameters(args.initial_model)
+    store = EnrollmentStore(args.store_path or tempfile.mkdtemp(prefix='cascade_store_'))
+    attempts = build_attempts(s, store, args.eval_list, args.eval_path, args.eval_user, args.eval_uttr_enroll, args.eval_uttr_verify)
+    reject, accept = parse_thresholds(args.reject), parse_thresholds(args.accept)
+    verifier = CascadedVerifier(s, store, args.stages, reject, accept, args.chunk_size)
+
+    print('Stages %s, reject %s, accept %s' % (' -> '.join(verifier.stages), {m: verifier.reject[m] for m in verifier.stages},
+                                                {m: verifier.accept[m] for m in verifier.stages if m in verifier.accept}))
+    print('%-9s %6s %s %9s %10s %10s %11s %8s' % ('attempts', 'n', ' '.join('%9s' % ('@' + m) for m in verifier.stages),
+                                                 'accepted', 'agreement', 'full (ms)', 'cascade (ms)', 'speedup'))
+    # warm-up, so that the first timing does not pay for it
+    audio, piezo, claimed_ids = attempts['genuine']
+    full_verify(s, store, audio[:1], piezo[:1], claimed_ids[:1], reject, args.chunk_size)
+    verifier.verify(audio[:1], piezo[:1], claimed_ids[:1])
+    for name, (audio, piezo, claimed_ids) in attempts.items():
+        tic = time.time()
+        reference, _ = full_verify(s, store, audio, piezo, claimed_ids, reject, args.chunk_size)
+        full = time.time() - tic
+        tic = time.time()
+        decisions, resolved, _ = verifier.verify(audio, piezo, claimed_ids)
+        cascade = time.time() - tic
+        print('%-9s %6d %s %8.2f%% %9.2f%% %10.1f %11.1f %7.2fx' % (
+            name, len(claimed_ids), ' '.join('%8.2f%%' % (f * 100) for f in verifier.resolved_fractions(resolved)),
+            decisions.float().mean() * 100, (decisions == reference).float().mean() * 100, full * 1000, cascade * 1000, full / cascade))
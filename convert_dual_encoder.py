@@ -0,0 +1,127 @@
+'''
+Convert a two-encoder PiezoBuds model (encoder_a, encoder_p) into one with the shared DualModalityEncoder of
+ECAPA_TDNN_w_Modality.py, and compare the two.
+
+Every modality keeps the BatchNorms of its encoder; the shared layers start from the mean of the two encoders
+(--shared_init mean, both encoders are initialized from the same pretrained extractor in trainPiezoBudsModel.py) or from
+one of them. The converter and the rest of the model are copied. One trunk cannot reproduce two different encoders
+exactly, so the converted model is meant to be fine-tuned:
+  trainPiezoBudsModel.py --shared_encoder --initial_model <out> ...
+
+The comparison reports the cosine between the embeddings of both models per modality, the EER of both with
+eval_network if an eval list is given (same users and rounds), and the time to embed a batch of (audio, piezo) clips
+with the two encoders back to back against the single stacked pass of the shared encoder.
+'''
+
+import argparse, os, random, time
+import torch
+import torch.nn.functional as F
+from PiezoBudsModel import PiezoBudsModel
+from ECAPA_TDNN_w_Modality import convert_two_encoder_state
+from export_verifier import load_clips
+
+
+def strip_state(state, prefix):
+    return {name[len(prefix):]: value for name, value in state.items() if name.startswith(prefix)}
+
+
+def convert(s, d, shared_init='mean'):
+    # load the encoders of the two-encoder model s, and everything else it has, into the shared-encoder model d
+    state = s.state_dict()
+    target = d.state_dict()
+    encoder = convert_two_encoder_state(strip_state(state, 'encoder_a.'), strip_state(state, 'encoder_p.'), strip_state(target, 'encoder.'), shared_init)
+    for name, value in state.items():
+        if name in target and not name.startswith(('encoder_a.', 'encoder_p.')):
+            target[name] = value
+    target.update({'encoder.' + name: value for name, value in encoder.items()})
+    d.load_state_dict(target)
+    return d
+
+
+def batch_ms(fn, runs):
+    # fastest of runs calls
+    times = []
+    with torch.no_grad():
+        fn()
+        for _ in range(runs):
+            tic = time.time()
+            fn()
+            times.append(time.time() - tic)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a two-encoder PiezoBuds model to the shared dual-modality encoder and compare them')
+    parser.add_argument('--initial_model',    type=str,   required=True, help='Path of the two-encoder PiezoBuds model')
+    parser.add_argument('--out',              type=str,   default='exps/shared_encoder/model_0000.model', help='Path of the converted model')
+    parser.add_argument('--dual_model',       type=str,   default='', help='Compare with this (e.g. fine-tuned) shared-encoder model instead of converting')
+    parser.add_argument('--shared_init',      type=str,   default='mean', choices=['mean', 'audio', 'piezo'], help='Initial shared layers')
+    parser.add_argument('--piezo_front_end',  type=str,   default='full', choices=['full', 'band'], help='Front-end of the piezo modality of the shared encoder')
+    parser.add_argument('--adapter_dim',      type=int,   default=0,  help='Per-modality adapters of this width, 0 for none')
+    parser.add_argument('--C',                type=int,   default=1024)
+    parser.add_argument('--n_class',          type=int,   default=81)
+    parser.add_argument('--num_frames',       type=int,   default=50)
+    parser.add_argument('--eval_list',        type=str,   default='', help='Clips of the comparison, random signals (and no EER) if empty')
+    parser.add_argument('--eval_path',        type=str,   default='')
+    parser.add_argument('--eval_user_total',  type=int,   default=81)
+    parser.add_argument('--eval_user',        type=int,   default=10)
+    parser.add_argument('--eval_uttr_enroll', type=int,   default=8)
+    parser.add_argument('--eval_uttr_verify', type=int,   default=4)
+    parser.add_argument('--eval_times',       type=int,   default=1000)
+    parser.add_argument('--n_clips',          type=int,   default=64, help='Clips of the embedding comparison')
+    parser.add_argument('--batch_sizes',      type=int,   nargs='+', default=[1, 16, 64])
+    parser.add_argument('--runs',             type=int,   default=5)
+    parser.add_argument('--threads',          type=int,   default=0, help='CPU threads of the timing, 0 for the torch default')
+    parser.add_argument('--seed',             type=int,   default=0)
+    parser.add_argument('--device',           type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    common = dict(lr=0.001, lr_decay=0.97, C=args.C, n_class=args.n_class, m=0.2, s=30, test_step=50,
+                  device=args.device, num_frames=args.num_frames)
+    s = PiezoBudsModel(**common)
+    s.load_parameters(args.initial_model)
+    d = PiezoBudsModel(shared_encoder=True, piezo_front_end=args.piezo_front_end, adapter_dim=args.adapter_dim, **common)
+    if args.dual_model != '':
+        d.load_parameters(args.dual_model)
+    else:
+        convert(s, d, args.shared_init)
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        d.save_parameters(args.out)
+        print('Converted %s (shared layers: %s) to %s' % (args.initial_model, args.shared_init, args.out))
+    s.eval()
+    d.eval()
+
+    # embeddings of both models
+    length = args.num_frames * 160 + 240
+    if args.eval_list != '':
+        audio, piezo = load_clips(args.eval_list, args.eval_path, args.n_clips, length)
+    else:
+        audio, piezo = torch.randn(args.n_clips, length) * 0.1, torch.randn(args.n_clips, length) * 0.1
+    audio, piezo = audio.to(args.device), piezo.to(args.device)
+    with torch.no_grad():
+        embeddings = s.embed_batch(audio, piezo)
+        cos = [F.cosine_similarity(e, f, dim=-1).mean().item() for e, f in zip(embeddings, d.embed_batch(audio, piezo))]
+    print('Cosine of the shared-encoder embeddings to the two-encoder ones: audio %.4f, piezo %.4f, conv %.4f' % tuple(cos))
+
+    if args.eval_list != '':
+        for name, model in [('two encoders', s), ('shared encoder', d)]:
+            random.seed(args.seed)
+            EER, minDCF, thres, FAR_replay, EER_audio, EER_piezo = model.eval_network(
+                eval_list=args.eval_list, eval_path=args.eval_path, eval_user_total=args.eval_user_total, eval_user=args.eval_user,
+                eval_uttr_enroll=args.eval_uttr_enroll, eval_uttr_verify=args.eval_uttr_verify, veri_usr_lst=None,
+                eval_noise_type=0, eval_noise_path='', eval_motion_type=0, eval_motion_path='', eval_times=args.eval_times)[:6]
+            print('%-15s EER %2.2f%%, minDCF %.4f, FAR_replay %.6f, EER audio %2.2f%%, EER piezo %2.2f%%' % (
+                name, EER * 100, minDCF, FAR_replay, EER_audio * 100, EER_piezo * 100))
+
+    # encoder parameters and throughput
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    count = lambda model: sum(p.numel() for p in {id(p): p for e in (model.encoder_a, model.encoder_p) for p in e.parameters()}.values())
+    print('Encoder parameters: two encoders %.2fM, shared encoder %.2fM' % (count(s) / 1e6, count(d) / 1e6))
+    print('%5s %22s %22s %8s' % ('batch', 'two encoders (ms)', 'shared encoder (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        a = audio[:batch_size].repeat(-(-batch_size // audio.shape[0]), 1)[:batch_size]
+        p = piezo[:batch_size].repeat(-(-batch_size // piezo.shape[0]), 1)[:batch_size]
+        before = batch_ms(lambda: s.embed_batch(a, p), args.runs)
+        after = batch_ms(lambda: d.embed_batch(a, p), args.runs)
+        print('%5d %22.2f %22.2f %7.2fx' % (batch_size, before, after, before / after))
@@ -2,15 +2,77 @@
 DataLoader for training
 '''
 
-import glob, numpy, os, random, soundfile, torch
+import glob, numpy, os, random, soundfile, torch, collections
 from scipy import signal
 from matplotlib import pyplot as plt
 from utils import extract_envelope
+from packed_corpus import PackedClipCorpus
+from split_manifest import read_list, recorded_indices
 import numpy as np
 
+class AugmentBank(object):
+	"""
+	In-memory cache of the augmentation sources (noise_piezo.wav, motion/*.wav, MUSAN, RIR).
+	Every file is decoded the first time it is used and then served from memory; once the cache
+	holds more than max_mb, the least recently used sources are evicted. DataLoader workers each
+	get their own copy of the bank, so files are read at most once per worker.
+	"""
+	def __init__(self, max_mb = 1024):
+		self.max_bytes = max_mb * 1024 * 1024
+		self.n_bytes   = 0
+		self.cache     = collections.OrderedDict()
+
+	def load(self, path):
+		if path in self.cache:
+			self.cache.move_to_end(path)
+			return self.cache[path]
+		audio, _ = soundfile.read(path, dtype = 'float32')
+		if audio.ndim > 1:
+			audio = audio[:, 0]
+		self.cache[path] = audio
+		self.n_bytes += audio.nbytes
+		while self.n_bytes > self.max_bytes and len(self.cache) > 1:
+			_, evicted = self.cache.popitem(last = False)
+			self.n_bytes -= evicted.nbytes
+		return audio
+
+	def crops(self, path, n, length, normalize = False, rng = numpy.random):
+		# n random crops of length samples from one source, like process_wav but as one (n, length) gather;
+		# rng is numpy.random or a numpy.random.Generator
+		audio = self.load(path)
+		if audio.shape[0] <= length:
+			audio = numpy.pad(audio, (0, length - audio.shape[0]), 'wrap')
+		starts = rng.random(n) * (audio.shape[0] - length)
+		crops  = audio[starts.astype(numpy.int64)[:, None] + numpy.arange(length)].astype(numpy.float64)
+		if normalize:
+			crops = crops / numpy.max(numpy.abs(crops), axis = 1, keepdims = True)
+		return crops
+
+	def crops_from(self, paths, length):
+		# one random crop from each of the given sources, (len(paths), length)
+		return numpy.concatenate([self.crops(path, 1, length) for path in paths], axis = 0)
+
+	@staticmethod
+	def snr_scale(audio, noise, snr):
+		# per-row gain that brings noise to the given SNR (dB) below audio, for (n, samples) batches
+		clean_db = 10 * numpy.log10(numpy.mean(audio ** 2, axis = -1, keepdims = True) + 1e-4)
+		noise_db = 10 * numpy.log10(numpy.mean(noise ** 2, axis = -1, keepdims = True) + 1e-4)
+		return numpy.sqrt(10 ** ((clean_db - noise_db - snr) / 10))
+
 class train_loader(object):
-	def __init__(self, train_list, train_path, musan_path, rir_path, num_frames, num_uttr, eval_user_total, **kwargs):
+	def __init__(self, train_list, train_path, musan_path, rir_path, num_frames, num_uttr, eval_user_total, packed_prefix = '', augment_mem_mb = 1024, fbank_prefix = '', fbank_front_end = 'full', **kwargs):
 		self.train_path = train_path
+		self.augment_bank = AugmentBank(augment_mem_mb)
+		self.piezo_noise_file = "./noise_piezo.wav"
+		# Read clips from a corpus packed by packed_corpus.py instead of the wav files
+		self.corpus = PackedClipCorpus(packed_prefix) if packed_prefix != '' else None
+		# Log-mel features of the packed clips written by fbank_cache.py with the front-end fbank_front_end (a key of
+		# model.FRONT_ENDS), returned instead of the waveforms
+		self.fbanks = None
+		if fbank_prefix != '':
+			if self.corpus is None:
+				raise ValueError('fbank_prefix needs the packed corpus the features were computed from (packed_prefix)')
+			self.fbanks = {name: numpy.load('%s.%s.%s.fbank.npy' % (fbank_prefix, name, fbank_front_end), mmap_mode = 'r') for name in ['audio', 'piezo']}
 		self.num_frames = num_frames
 		# Load and configure augmentation files
 		self.noisetypes = ['noise','speech','music']
@@ -26,13 +88,20 @@ class train_loader(object):
 		# Load data & labels
 		self.data_list  = []
 		self.data_label = []
-		lines = open(train_list).read().splitlines()
+		# a plain list, or the train clips of a split manifest
+		lines = read_list(train_list, 'train')
+		# positions of the clips in the packed corpus, as recorded in the manifest if it has them
+		indices = recorded_indices(train_list, self.corpus, 'train') if self.corpus is not None else None
 		dictkeys = list(set([x.split()[0] for x in lines]))
 		dictkeys.sort()
 		dictkeys = { key : ii for ii, key in enumerate(dictkeys) }
 		for index, line in enumerate(lines):
 			speaker_label = dictkeys[line.split()[0]]
 			file_name     = os.path.join(train_path, line.split()[1])
+			if indices is not None:
+				file_name = int(indices[index])
+			elif self.corpus is not None:
+				file_name = self.corpus.index_of(file_name)
 			self.data_label.append(speaker_label)
 			self.data_list.append(file_name)
 		self.data_dict = {}
@@ -55,46 +124,75 @@ class train_loader(object):
 	def return_user_lists(self):
 		return self.user_list_train, self.user_list_veri
 
-	def process_wav(self, audio):
+	def read_clip(self, file, modality = 'audio'):
+		if self.corpus is not None:
+			return self.corpus.read(modality, file)
+		if modality == 'piezo':
+			file = file.replace("audio", "piezo")
+		clip, _ = soundfile.read(file)
+		return clip
+
+	def process_wav(self, audio, rng = random):
+		# rng is the random module or a random.Random
 		length = self.num_frames * 160 + 240
 		if audio.shape[0] <= length:
 			shortage = length - audio.shape[0]
 			audio = numpy.pad(audio, (0, shortage), 'wrap')
-		start_frame = numpy.int64(random.random()*(audio.shape[0]-length))
+		start_frame = numpy.int64(rng.random()*(audio.shape[0]-length))
 
 		audio = audio[start_frame:start_frame + length]
 		audio = numpy.stack([audio],axis=0)
 		return audio
 
 	def __getitem__(self, index):
+		# a whole batch planned by BalancedUserBatchSampler
+		if isinstance(index, tuple):
+			return self.get_batch(*index)
 		# Read the utterance and randomly select the segment
 		userid = self.user_list_train[index]
+		return self.load_user(userid, random.sample(self.data_dict[userid], self.num_uttr * 2))
+
+	def get_batch(self, seed, users, clips):
+		"""
+		One planned batch: the users at positions users (b,) of user_list_train with the clips clips (b, 2 * num_uttr)
+		of data_dict, stacked as the DataLoader collates single users. The crops and noise of the batch are drawn
+		from generators seeded with seed, so a batch is the same whichever worker loads it; the global random and
+		numpy.random states are left alone (with --n_cpu 0 they are the training process's own).
+		"""
+		rng, np_rng = random.Random(seed), numpy.random.default_rng(seed)
+		items = []
+		for user, row in zip(users, clips):
+			userid = self.user_list_train[user]
+			items.append(self.load_user(userid, [self.data_dict[userid][c] for c in row], rng, np_rng))
+		return tuple(torch.stack(x) for x in zip(*items))
 
+	def load_user(self, userid, file_paths, rng = random, np_rng = numpy.random):
+		# num_uttr concurrent (audio, piezo) clips from the first half of file_paths, non-concurrent audio from the second;
+		# the crops are drawn from rng (random or a random.Random) and np_rng (numpy.random or a Generator)
 		audios = []
 		audios_extra = []
 		piezos = []
-		noises = []
 		ids = []
 
-		file_paths = random.sample(self.data_dict[userid], self.num_uttr * 2)
 		file_paths_non_current_audio = file_paths[self.num_uttr: ]
 		file_paths = file_paths[0: self.num_uttr]
 		for i in range(self.num_uttr):
 			file = file_paths[i]
 			file_extra_audio = file_paths_non_current_audio[i]
-			audio, sr = soundfile.read(file)
-			piezo_path = file.replace("audio", "piezo")
-			piezo, sr = soundfile.read(piezo_path)
-			audio_extra, _ = soundfile.read(file_extra_audio)
+			if self.fbanks is not None:
+				audios.append(self.fbanks['audio'][file])
+				audios_extra.append(self.fbanks['audio'][file_extra_audio])
+				piezos.append(self.fbanks['piezo'][file])
+				ids.append(userid)
+				continue
+			audio = self.read_clip(file)
+			piezo = self.read_clip(file, 'piezo')
+			audio_extra = self.read_clip(file_extra_audio)
 
-			noise, sr = soundfile.read("./noise_piezo.wav")
+			audio = self.process_wav(audio, rng)
+			piezo = self.process_wav(piezo, rng)
 
-			audio = self.process_wav(audio)
-			piezo = self.process_wav(piezo)
-
-			audio_extra = self.process_wav(audio_extra)
-			noise = self.process_wav(noise)
-			noise = noise / np.max(np.abs(noise))
+			audio_extra = self.process_wav(audio_extra, rng)
 
 			# plt.figure()
 			# plt.plot(audio)
@@ -109,7 +207,6 @@ class train_loader(object):
 			audio = audio[0]
 			audio_extra = audio_extra[0]
 			piezo = piezo[0]
-			noise = noise[0]
 			# env = extract_envelope(np.abs(piezo))
 			# env = env / np.max(np.abs(env))
 			# env[env > 0.21] = 1
@@ -123,8 +220,10 @@ class train_loader(object):
 			audios.append(audio)
 			audios_extra.append(audio_extra)
 			piezos.append(piezo)
-			noises.append(noise)
 			ids.append(userid)
+
+		# the piezo noise is the same file for every utterance, crop and normalize it for the whole batch at once
+		noises = self.augment_bank.crops(self.piezo_noise_file, self.num_uttr, self.num_frames * 160 + 240, normalize = True, rng = np_rng)
 		
 		# length = self.num_frames * 160 + 240
 		# if audio.shape[0] <= length:
@@ -165,29 +264,84 @@ class train_loader(object):
 	def __len__(self):
 		return len(self.user_list_train)
 
+	def user_clip_counts(self):
+		return numpy.array([len(self.data_dict[userid]) for userid in self.user_list_train])
+
 	def add_rev(self, audio):
-		rir_file    = random.choice(self.rir_files)
-		rir, sr     = soundfile.read(rir_file)
-		rir         = numpy.expand_dims(rir.astype(numpy.float),0)
-		rir         = rir / numpy.sqrt(numpy.sum(rir**2))
-		return signal.convolve(audio, rir, mode='full')[:,:self.num_frames * 160 + 240]
+		return self.add_rev_batch(audio)
 
 	def add_noise(self, audio, noisecat):
-		clean_db    = 10 * numpy.log10(numpy.mean(audio ** 2)+1e-4) 
-		numnoise    = self.numnoise[noisecat]
-		noiselist   = random.sample(self.noiselist[noisecat], random.randint(numnoise[0],numnoise[1]))
-		noises = []
-		for noise in noiselist:
-			noiseaudio, sr = soundfile.read(noise)
-			length = self.num_frames * 160 + 240
-			if noiseaudio.shape[0] <= length:
-				shortage = length - noiseaudio.shape[0]
-				noiseaudio = numpy.pad(noiseaudio, (0, shortage), 'wrap')
-			start_frame = numpy.int64(random.random()*(noiseaudio.shape[0]-length))
-			noiseaudio = noiseaudio[start_frame:start_frame + length]
-			noiseaudio = numpy.stack([noiseaudio],axis=0)
-			noise_db = 10 * numpy.log10(numpy.mean(noiseaudio ** 2)+1e-4) 
-			noisesnr   = random.uniform(self.noisesnr[noisecat][0],self.noisesnr[noisecat][1])
-			noises.append(numpy.sqrt(10 ** ((clean_db - noise_db - noisesnr) / 10)) * noiseaudio)
-		noise = numpy.sum(numpy.concatenate(noises,axis=0),axis=0,keepdims=True)
-		return noise + audio
\ No newline at end of file
+		return self.add_noise_batch(audio, noisecat)
+
+	def add_rev_batch(self, audios):
+		# audios: (n, samples), a different random RIR for every row, convolved in one call
+		rirs = [self.augment_bank.load(random.choice(self.rir_files)) for _ in range(audios.shape[0])]
+		rir  = numpy.zeros((len(rirs), max(len(r) for r in rirs)))
+		for i, r in enumerate(rirs):
+			rir[i, :len(r)] = r / numpy.sqrt(numpy.sum(r ** 2))
+		return signal.fftconvolve(audios, rir, mode='full', axes=1)[:,:self.num_frames * 160 + 240]
+
+	def add_noise_batch(self, audios, noisecat):
+		# audios: (n, samples), every row gets its own number of noise files, crops and SNRs
+		n, length = audios.shape
+		numnoise  = self.numnoise[noisecat]
+		counts    = numpy.array([random.randint(numnoise[0], numnoise[1]) for _ in range(n)])
+		noise     = numpy.zeros_like(audios, dtype = numpy.float64)
+		for k in range(counts.max()):
+			crops = self.augment_bank.crops_from([random.choice(self.noiselist[noisecat]) for _ in range(n)], length)
+			snr   = numpy.random.uniform(self.noisesnr[noisecat][0], self.noisesnr[noisecat][1], (n, 1))
+			noise += (counts > k)[:, None] * AugmentBank.snr_scale(audios, crops, snr) * crops
+		return noise + audios
+
+
+class BalancedUserBatchSampler(torch.utils.data.Sampler):
+	"""
+	Per-epoch plan of whole training batches for train_loader, drawn from seed + epoch (as
+	voxceleb_trainer's train_dataset_sampler, vectorized with numpy):
+	- every user of user_list_train is planned rounds times per epoch, each round a permutation of the users cut
+	  into global batches of batch_size * world_size, so the users of a batch are always distinct (the users left
+	  over by a round are dropped, like drop_last);
+	- every planned user gets 2 * num_uttr of its clips, distinct whenever it has that many, drawn with
+	  replacement otherwise instead of failing in random.sample.
+	Every element is (seed, users, clips) for train_loader.get_batch, the rank-th batch_size users of a global
+	batch. Use it with DataLoader(batch_size = None) so workers load whole batches. Call set_epoch before every epoch.
+	"""
+	def __init__(self, data_source, batch_size, num_uttr, rounds = 1, seed = 0, rank = 0, world_size = 1):
+		self.counts     = data_source.user_clip_counts()
+		self.batch_size = batch_size
+		self.num_uttr   = num_uttr
+		self.rounds     = rounds
+		self.seed       = seed
+		self.rank       = rank
+		self.world_size = world_size
+		self.epoch      = 0
+		if len(self.counts) < batch_size * world_size:
+			raise ValueError('%d users cannot fill a batch of %d distinct users on each of %d ranks' % (len(self.counts), batch_size, world_size))
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def plan(self, epoch):
+		# users (n_batches, batch_size * world_size), clips (n_batches, batch_size * world_size, 2 * num_uttr), seeds (n_batches,)
+		rng = numpy.random.default_rng([self.seed, epoch])
+		n_users, global_batch, k = len(self.counts), self.batch_size * self.world_size, 2 * self.num_uttr
+		per_round = n_users // global_batch * global_batch
+		users = numpy.concatenate([rng.permutation(n_users)[:per_round] for _ in range(self.rounds)]).reshape(-1, global_batch)
+		users = users[rng.permutation(users.shape[0])]
+		# k distinct clips per user: the k smallest random keys among its clips, the padding sorts last
+		counts = self.counts[users]
+		keys = rng.random(users.shape + (max(self.counts.max(), k),))
+		keys[numpy.arange(keys.shape[-1]) >= counts[..., None]] = 2
+		clips = numpy.argsort(keys, axis = -1)[..., :k]
+		short = counts < k
+		clips[short] = (rng.random((short.sum(), k)) * counts[short][:, None]).astype(numpy.int64)
+		return users, clips, rng.integers(2 ** 31, size = users.shape[0])
+
+	def __iter__(self):
+		users, clips, seeds = self.plan(self.epoch)
+		ranks = slice(self.rank * self.batch_size, (self.rank + 1) * self.batch_size)
+		for b in range(users.shape[0]):
+			yield int(seeds[b]) * self.world_size + self.rank, users[b, ranks], clips[b, ranks]
+
+	def __len__(self):
+		return len(self.counts) // (self.batch_size * self.world_size) * self.rounds
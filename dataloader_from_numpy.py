@@ -6,6 +6,8 @@ import random
 from random import shuffle
 from utils import *
 import scipy
+from packed_corpus import PackedClipCorpus
+from split_manifest import user_clip_ids, recorded_indices
 
 
 def find_all_files(directory, type):
@@ -264,7 +266,8 @@ class WavDatasetForVerification(Dataset):
     # if is_multi_moda, return (piezo, audio, id)
     # else if is_audio, return (audio, id)
     # else return (piezo, id)
-    def __init__(self, dataset_dir, n_user_list, m, is_multi_moda=True, is_audio=True):
+    # with a split manifest, dataset_dir is the tree the manifest was made from and only the clips of split are used
+    def __init__(self, dataset_dir, n_user_list, m, is_multi_moda=True, is_audio=True, manifest=None, split='train'):
         super().__init__()
 
         self.is_audio = is_audio
@@ -274,6 +277,7 @@ class WavDatasetForVerification(Dataset):
 
         self.dir_piezo = dataset_dir + 'piezo/'
         self.dir_audio = dataset_dir + 'audio/'
+        self.clip_ids = user_clip_ids(manifest, split) if manifest is not None else None
 
     def __len__(self):
         return len(self.n_user_list)
@@ -285,9 +289,12 @@ class WavDatasetForVerification(Dataset):
             piezo_root = self.dir_piezo + '{}/'.format(user)
             audio_root = self.dir_audio + '{}/'.format(user)
 
-            file_list = find_all_files(audio_root, '.wav')
-            num_utter = len(file_list)
-            samples_idx = random.sample(list(range(num_utter)), self.m)
+            if self.clip_ids is not None:
+                samples_idx = random.sample(self.clip_ids[user], self.m)
+            else:
+                file_list = find_all_files(audio_root, '.wav')
+                num_utter = len(file_list)
+                samples_idx = random.sample(list(range(num_utter)), self.m)
 
             piezos = []
             audios = []
@@ -346,3 +353,59 @@ class Voxceleb1Dataset(Dataset):
         audios = torch.from_numpy(audios).float()
         ids = torch.from_numpy(ids)
         return (audios.to(self.device), ids.to(self.device))
+
+
+class PackedWavDatasetForVerification(Dataset):
+    # Same samples as WavDatasetForVerification, read from a corpus written by packed_corpus.pack_wav_tree
+    # returns (piezos, audios, ids)
+    def __init__(self, packed_prefix, n_user_list, m, manifest=None, split='train'):
+        super().__init__()
+
+        self.corpus = PackedClipCorpus(packed_prefix)
+        self.n_user_list = n_user_list
+        self.m = m
+        self.user_clips = self.corpus.user_clips
+        if manifest is not None:
+            # only the clips of split, at the positions in the packed corpus the manifest recorded
+            indices = recorded_indices(manifest, self.corpus, split)
+            if indices is not None:
+                labels = self.corpus.labels[indices]
+                self.user_clips = {int(uid): indices[labels == uid] for uid in np.unique(labels)}
+            else:
+                self.user_clips = {uid: np.array([self.corpus.lookup[(uid, cid)] for cid in cids])
+                                   for uid, cids in user_clip_ids(manifest, split).items()}
+
+    def __len__(self):
+        return len(self.n_user_list)
+
+    def __getitem__(self, idx):
+        user = self.n_user_list[idx]
+        samples_idx = np.random.choice(self.user_clips[user], self.m, replace=False)
+
+        # scipy.io.wavfile.read scale, as in WavDatasetForVerification
+        piezos = torch.from_numpy(self.corpus.read_many('piezo', samples_idx, normalize=False)).float()
+        audios = torch.from_numpy(self.corpus.read_many('audio', samples_idx, normalize=False)).float()
+        ids = torch.full((self.m,), user, dtype=torch.int64)
+        return (piezos, audios, ids)
+
+
+class PackedVoxceleb1Dataset(Dataset):
+    # Same samples as Voxceleb1Dataset, read from a corpus packed with --voxceleb
+    def __init__(self, packed_prefix, n_user_list, m, device):
+        super().__init__()
+
+        self.corpus = PackedClipCorpus(packed_prefix)
+        self.n_user_list = n_user_list
+        self.m = m
+        self.device = device
+
+    def __len__(self):
+        return len(self.n_user_list)
+
+    def __getitem__(self, idx):
+        user = self.n_user_list[idx]
+        samples_idx = np.random.choice(self.corpus.user_clips[user], self.m, replace=False)
+
+        audios = torch.from_numpy(self.corpus.read_many('audio', samples_idx, normalize=False)).float()
+        ids = torch.full((self.m,), idx, dtype=torch.int64)
+        return (audios.to(self.device), ids.to(self.device))
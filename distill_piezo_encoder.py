@@ -0,0 +1,116 @@
+'''
+Distil the piezo encoder of a trained PiezoBuds model into a narrower encoder with the decimated piezo front-end.
+
+The student encoder_p (ECAPA_TDNN(C_p, front_end='piezo'): 4 kHz, 128-point FFT, 40 mels, see model.FRONT_ENDS) is
+trained to reproduce the embeddings of the teacher encoder_p on every input encoder_p sees in training (piezo clips,
+the concurrent audio clips and the piezo noise). It regresses the teacher embeddings (cosine + MSE), so the converter
+and the other parts of the model, which are copied from the teacher, keep working with it. The student starts from
+the teacher tensors of matching shape: the pooling and output layers for any C_p, most of the trunk if C_p == C.
+
+Writes a PiezoBuds checkpoint with the student as encoder_p, e.g. to evaluate or fine-tune it end to end:
+  trainPiezoBudsModel.py --initial_model <out> --C_p 512 --piezo_front_end piezo ...
+'''
+
+import argparse, os, sys, time
+import torch
+import torch.nn.functional as F
+from dataLoader import train_loader, BalancedUserBatchSampler
+from PiezoBudsModel import PiezoBudsModel
+
+
+def copy_matching(src, dst):
+    # copy the tensors of src into dst where name and shape match, returns the number of copied tensors
+    state = dst.state_dict()
+    copied = 0
+    for name, param in src.state_dict().items():
+        if name in state and state[name].shape == param.shape:
+            state[name].copy_(param)
+            copied += 1
+    return copied
+
+
+def latency_ms(encoder, length, runs=10):
+    # forward time of one clip on the current device
+    x = torch.randn(1, length, device=next(encoder.parameters()).device) * 0.1
+    encoder.eval()
+    with torch.no_grad():
+        encoder.forward(x, aug=False)
+        tic = time.time()
+        for _ in range(runs):
+            encoder.forward(x, aug=False)
+    return (time.time() - tic) / runs * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distil encoder_p into a narrower encoder with the decimated piezo front-end')
+    parser.add_argument('--initial_model',   type=str,   required=True, help='Path of the trained (teacher) PiezoBuds model')
+    parser.add_argument('--out',             type=str,   default='exps/piezo_student/model.model', help='Path of the PiezoBuds model with the student encoder_p')
+    parser.add_argument('--C',               type=int,   default=1024,  help='Channel size of the teacher encoders')
+    parser.add_argument('--C_p',             type=int,   default=512,   help='Channel size of the student piezo encoder')
+    parser.add_argument('--piezo_front_end', type=str,   default='piezo', choices=['full', 'piezo', 'band'])
+    parser.add_argument('--n_class',         type=int,   default=81)
+    parser.add_argument('--train_list',      type=str,   default='/mnt/ssd/gen/piezo_authentication/train_list_piezo_500ms_1.txt')
+    parser.add_argument('--train_path',      type=str,   default='/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/train/')
+    parser.add_argument('--packed_prefix',   type=str,   default='', help='Prefix of the training corpus packed by packed_corpus.py')
+    parser.add_argument('--musan_path',      type=str,   default='/mnt/hdd/gen/musan/musan', help='Only read by train_loader, distillation adds no MUSAN noise')
+    parser.add_argument('--rir_path',        type=str,   default='/mnt/hdd/gen/rirs_noises/RIRS_NOISES/simulated_rirs')
+    parser.add_argument('--eval_user_total', type=int,   default=81, help='Number of training users, as in trainPiezoBudsModel.py')
+    parser.add_argument('--num_frames',      type=int,   default=50)
+    parser.add_argument('--batch_size',      type=int,   default=20, help='Users per batch')
+    parser.add_argument('--num_uttr',        type=int,   default=10, help='Clips per user')
+    parser.add_argument('--n_cpu',           type=int,   default=4)
+    parser.add_argument('--seed',            type=int,   default=0)
+    parser.add_argument('--max_epoch',       type=int,   default=100)
+    parser.add_argument('--test_step',       type=int,   default=10, help='Save every [test_step] epochs')
+    parser.add_argument('--lr',              type=float, default=0.001)
+    parser.add_argument('--lr_decay',        type=float, default=0.97)
+    parser.add_argument('--mse_weight',      type=float, default=1.0, help='Weight of the MSE to the teacher embeddings, next to 1 - cosine')
+    parser.add_argument('--no_aug',          dest='aug', action='store_false', help='No specaug on the student inputs')
+    parser.add_argument('--device',          type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    common = dict(lr=args.lr, lr_decay=args.lr_decay, C=args.C, n_class=args.n_class, m=0.2, s=30, test_step=args.test_step,
+                  device=args.device, num_frames=args.num_frames)
+    teacher = PiezoBudsModel(**common)
+    teacher.load_parameters(args.initial_model)
+    teacher.eval()
+    s = PiezoBudsModel(C_p=args.C_p, piezo_front_end=args.piezo_front_end, **common)
+    copied = copy_matching(teacher, s)
+    print('Student encoder_p: C_p %d, %s front-end, %d teacher tensors copied' % (args.C_p, args.piezo_front_end, copied))
+    length = args.num_frames * 160 + 240
+    print('encoder_p latency (1 clip): teacher %.1f ms, student %.1f ms' % (latency_ms(teacher.encoder_p, length), latency_ms(s.encoder_p, length)))
+
+    loader = train_loader(**vars(args))
+    sampler = BalancedUserBatchSampler(loader, args.batch_size, args.num_uttr, seed=args.seed)
+    workers = dict(num_workers=args.n_cpu, persistent_workers=True) if args.n_cpu > 0 else {}
+    batches = torch.utils.data.DataLoader(loader, batch_size=None, sampler=sampler, **workers)
+
+    optim = torch.optim.Adam(s.encoder_p.parameters(), lr=args.lr, weight_decay=2e-5)
+    scheduler = torch.optim.lr_scheduler.StepLR(optim, step_size=args.test_step, gamma=args.lr_decay)
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    for epoch in range(1, args.max_epoch + 1):
+        sampler.set_epoch(epoch)
+        s.encoder_p.train()
+        total, cos_total = 0, 0
+        for num, (audio, piezo, audio_extra, noise, labels) in enumerate(batches, start=1):
+            # the inputs of encoder_p in PiezoBudsModel.infer_training_embeddings
+            x = torch.cat([t.float().contiguous().view(-1, t.shape[-1]) for t in (piezo, audio, noise)], dim=0).to(args.device)
+            with torch.no_grad():
+                target = teacher.encoder_p.forward(x, aug=False)
+            out = s.encoder_p.forward(x, aug=args.aug)
+            cos = F.cosine_similarity(out, target, dim=-1).mean()
+            loss = (1 - cos) + args.mse_weight * F.mse_loss(out, target)
+            optim.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(s.encoder_p.parameters(), 3.0)
+            optim.step()
+            total += loss.item()
+            cos_total += cos.item()
+            sys.stderr.write(time.strftime('%m-%d %H:%M:%S') + ' [%2d] Lr: %5f, Training: %.2f%%, Loss: %.5f, Cosine to teacher: %.4f \r' % (
+                epoch, optim.param_groups[0]['lr'], 100 * num / len(batches), total / num, cos_total / num))
+            sys.stderr.flush()
+        sys.stdout.write('\n')
+        scheduler.step()
+        if epoch % args.test_step == 0 or epoch == args.max_epoch:
+            s.save_parameters(args.out)
+            print(time.strftime('%Y-%m-%d %H:%M:%S'), '%d epoch, loss %.5f, cosine to teacher %.4f, saved %s' % (epoch, total / num, cos_total / num, args.out))
@@ -0,0 +1,146 @@
+'''
+Multi-process (DistributedDataParallel) training of PiezoBudsModel, launched with torchrun, e.g. on two CPU nodes:
+
+  torchrun --nnodes 2 --nproc_per_node 8 --rdzv_backend c10d --rdzv_endpoint <host>:29500 \
+      trainPiezoBudsModel.py --backend gloo ...
+
+Every rank loads a disjoint share of the users of train_loader.user_list_train (DistributedUserSampler), the
+GE2E loss of every rank is computed over the users of all ranks (gather_users), DistributedDataParallel averages
+the gradients, and only rank 0 writes checkpoints and logs. A plain `python trainPiezoBudsModel.py` runs as a
+single process (world size 1) and every helper here is then a no-op.
+'''
+
+import os
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.utils.data import Sampler
+
+
+def init_distributed(backend='gloo'):
+    """
+    Join the process group of a torchrun launch. Returns (rank, world_size, local_rank), (0, 1, 0) outside torchrun.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1:
+        return 0, 1, 0
+    dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def gather_users(x):
+    """
+    (b, ...) tensor of every rank -> (world_size * b, ...) in rank order. Gradients flow back to the rank that
+    computed each slice, so a GE2E loss over the result sees the users of the global batch.
+    """
+    if not is_distributed():
+        return x
+    return torch.cat(torch.distributed.nn.functional.all_gather(x.contiguous()), dim=0)
+
+
+def all_reduce_mean(value):
+    # mean of a python number over the ranks
+    if not is_distributed():
+        return value
+    t = torch.tensor(float(value), dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.item() / get_world_size()
+
+
+def all_gather_objects(obj):
+    # [obj of rank 0, obj of rank 1, ...]
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def broadcast_object(obj, src=0):
+    # obj of rank src on every rank
+    if not is_distributed():
+        return obj
+    out = [obj]
+    dist.broadcast_object_list(out, src=src)
+    return out[0]
+
+
+class DistributedUserSampler(Sampler):
+    """
+    User indices of train_loader for one rank. Every epoch the users are shuffled with the same seed on all ranks,
+    cut into global batches of batch_size * world_size users and every rank takes its batch_size users of each.
+    The incomplete last global batch is dropped, so every rank runs the same number of steps
+    (the single-process DataLoader is used with drop_last=True as well). Call set_epoch before every epoch.
+    """
+    def __init__(self, n_users, batch_size, rank=None, world_size=None, seed=0, shuffle=True):
+        self.n_users = n_users
+        self.batch_size = batch_size
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.steps = n_users // (batch_size * self.world_size)
+        if self.steps == 0:
+            raise ValueError('%d users cannot fill one batch of %d users on each of %d ranks' % (n_users, batch_size, self.world_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.n_users, generator=torch.Generator().manual_seed(self.seed + self.epoch)).tolist()
+        else:
+            order = list(range(self.n_users))
+        global_batch = self.batch_size * self.world_size
+        for step in range(self.steps):
+            start = step * global_batch + self.rank * self.batch_size
+            for index in order[start:start + self.batch_size]:
+                yield index
+
+    def __len__(self):
+        return self.steps * self.batch_size
+
+
+class TrainingStep(nn.Module):
+    """
+    PiezoBudsModel.training_loss as the forward of a module, so that DistributedDataParallel wraps the whole model
+    and synchronizes the gradients of every parameter used by the loss.
+    """
+    def __init__(self, s):
+        super(TrainingStep, self).__init__()
+        self.s = s
+
+    def forward(self, audio, piezo, audio_extra, noise, labels):
+        return self.s.training_loss(audio, piezo, audio_extra, noise, labels)
+
+
+def wrap_training_step(s, device_ids=None):
+    """
+    The step for PiezoBudsModel.train_network: training_loss under DistributedDataParallel, or training_loss itself
+    in a single process. Parameters of s that the loss does not use (the unused GE2E heads, fc, ...) are allowed.
+    """
+    if not is_distributed():
+        return s.training_loss
+    return nn.parallel.DistributedDataParallel(TrainingStep(s), device_ids=device_ids, find_unused_parameters=True)
+
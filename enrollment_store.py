@@ -0,0 +1,141 @@
+'''
+Persistent enrollment store for PiezoBuds.
+Per-user audio / piezo / converted centroids are kept on disk together with the running sums
+and the number of enrolled utterances, so that users do not have to be re-enrolled on restart
+and a new enrollment utterance only updates its own user's centroid.
+
+Layout of <store_path>/:
+  CURRENT                  name of the version directory in use, e.g. v000002
+  <version>/sums.npy       float64 (n_users, 3, dim)   running sum of the embeddings of every modality
+  <version>/centroids.npy  float32 (n_users, 3, dim)   sums / counts, kept up to date on every add
+  <version>/counts.npy     int64   (n_users,)          number of enrolled utterances per user
+All arrays are .npy memmaps indexed by user id. Growing the store writes the three arrays to a new version directory
+and then switches CURRENT to it with one rename, so a crash leaves either the old or the new arrays in use, never a
+mix. Stores written before the versioned layout (the three files directly in <store_path>) are still opened.
+'''
+
+import os, shutil, numpy, torch
+from numpy.lib.format import open_memmap
+
+MODALITIES = ['audio', 'piezo', 'conv']
+
+class EnrollmentStore(object):
+	def __init__(self, store_path, n_users = 128, dim = 192):
+		self.store_path = store_path
+		os.makedirs(store_path, exist_ok = True)
+		self.version = self._current_version()
+		if self.version is not None:
+			self.counts    = open_memmap(self._file('counts'), mode = 'r+')
+			self.sums      = open_memmap(self._file('sums'), mode = 'r+')
+			self.centroids = open_memmap(self._file('centroids'), mode = 'r+')
+			self.dim       = self.sums.shape[-1]
+			lengths = [len(self.counts), len(self.sums), len(self.centroids)]
+			if len(set(lengths)) != 1:
+				raise ValueError('%s: counts, sums and centroids have %s users' % (store_path, lengths))
+		else:
+			self.dim       = dim
+			self._allocate(n_users)
+
+	def _current_version(self):
+		# directory of the arrays in use, '' for a store written before the versioned layout, None for a new store
+		pointer = os.path.join(self.store_path, 'CURRENT')
+		if os.path.exists(pointer):
+			with open(pointer) as f:
+				return f.read().strip()
+		if os.path.exists(os.path.join(self.store_path, 'counts.npy')):
+			return ''
+		return None
+
+	def _file(self, name, version = None):
+		return os.path.join(self.store_path, self.version if version is None else version, name + '.npy')
+
+	def _allocate(self, n_users, old = None):
+		# Write the new arrays into a new version directory, then switch CURRENT to it with one atomic rename
+		version = 'v%06d' % (int(self.version[1:]) + 1 if self.version else 1)
+		os.makedirs(os.path.join(self.store_path, version), exist_ok = True)
+		arrays = {}
+		for name, shape, dtype in [('counts', (n_users,), numpy.int64),
+								   ('sums', (n_users, len(MODALITIES), self.dim), numpy.float64),
+								   ('centroids', (n_users, len(MODALITIES), self.dim), numpy.float32)]:
+			array = open_memmap(self._file(name, version), mode = 'w+', dtype = dtype, shape = shape)
+			if old is not None:
+				array[:len(old[name])] = old[name]
+			array.flush()
+			arrays[name] = array
+		pointer = os.path.join(self.store_path, 'CURRENT')
+		with open(pointer + '.tmp', 'w') as f:
+			f.write(version)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(pointer + '.tmp', pointer)
+		# the previous arrays are no longer referenced by CURRENT
+		if self.version:
+			shutil.rmtree(os.path.join(self.store_path, self.version), ignore_errors = True)
+		elif self.version == '':
+			for name in arrays:
+				os.remove(self._file(name))
+		self.version = version
+		self.counts, self.sums, self.centroids = arrays['counts'], arrays['sums'], arrays['centroids']
+
+	def __len__(self):
+		return len(self.counts)
+
+	def _ensure_capacity(self, uid):
+		if uid < len(self.counts):
+			return
+		old = {'counts': numpy.array(self.counts), 'sums': numpy.array(self.sums), 'centroids': numpy.array(self.centroids)}
+		self.counts, self.sums, self.centroids = None, None, None
+		self._allocate(max(uid + 1, 2 * len(old['counts'])), old)
+
+	def _to_numpy(self, embeddings):
+		if torch.is_tensor(embeddings):
+			embeddings = embeddings.detach().cpu().numpy()
+		return numpy.asarray(embeddings, dtype = numpy.float64).reshape(-1, self.dim)
+
+	def add(self, uid, audio, piezo, conv):
+		"""
+		Add one or more enrollment utterances of user uid.
+
+		Args:
+		- audio, piezo, conv: embeddings of shape (dim,) or (num of utterances, dim)
+
+		Only the running sums of this user are touched, so the cost is O(dim) per utterance.
+		The sums, the count and the centroids of the user are updated one after the other: a crash in the middle of
+		an add can leave them out of step with each other (the other users are not touched), remove and re-enroll
+		the user then.
+		"""
+		self._ensure_capacity(uid)
+		embeddings = [self._to_numpy(x) for x in (audio, piezo, conv)]
+		for m, embedding in enumerate(embeddings):
+			self.sums[uid, m] += embedding.sum(axis = 0)
+		self.counts[uid] += embeddings[0].shape[0]
+		self.centroids[uid] = self.sums[uid] / self.counts[uid]
+
+	def remove(self, uid):
+		if uid < len(self.counts):
+			self.counts[uid] = 0
+			self.sums[uid] = 0
+			self.centroids[uid] = 0
+
+	def enrolled_users(self):
+		return numpy.nonzero(numpy.asarray(self.counts))[0].tolist()
+
+	def is_enrolled(self, uid):
+		return uid < len(self.counts) and self.counts[uid] > 0
+
+	def get_centroids(self, uids = None, modality = None, device = 'cpu'):
+		"""
+		Returns the centroids of the given users as a float tensor of shape
+		(num of users, 3, dim), or (num of users, dim) if a modality is given.
+		"""
+		if uids is None:
+			uids = self.enrolled_users()
+		centroids = numpy.asarray(self.centroids[numpy.asarray(uids, dtype = numpy.int64)])
+		if modality is not None:
+			centroids = centroids[:, MODALITIES.index(modality)]
+		return torch.from_numpy(numpy.ascontiguousarray(centroids)).to(device)
+
+	def flush(self):
+		self.counts.flush()
+		self.sums.flush()
+		self.centroids.flush()
@@ -35,7 +35,12 @@ parser.add_argument('--eval_uttr_verify',  type=int,   default=5)
 parser.add_argument('--eval_noise_type',  type=int,   default=0, help='0: no noise; 1: white noise; 2: conversation; 3: cafe; 4: restaurant; 5: construction')
 parser.add_argument('--eval_noise_path',  type=str,   default="/mnt/ssd/gen/GithubRepo/PiezoBuds/noise", help='The path of noise data')
 parser.add_argument('--eval_motion_type',  type=int,   default=0, help='0: No motion; 1: turn; 2: tap; 3: clap; 4: walk')
+parser.add_argument('--eval_times',  type=int,   default=2000, help='Number of random enroll/verify rounds')
+parser.add_argument('--eval_draws',  type=int,   default=1, help='Embeddings (specaug / noise draws) per clip in the embedding table')
+parser.add_argument('--eval_replay_pool',  type=int,   default=50, help='Replay mixtures per user in the embedding table')
+parser.add_argument('--eval_legacy', dest='eval_legacy', action='store_true', help='Re-read and re-embed the clips in every round')
 parser.add_argument('--eval_motion_path',  type=str,   default="/mnt/ssd/gen/GithubRepo/PiezoBuds/motion", help='The path of motion data')
+parser.add_argument('--packed_prefix', type=str,   default="",                    help='Prefix of the training corpus packed by packed_corpus.py, read wav files if empty')
 parser.add_argument('--musan_path', type=str,   default="/mnt/hdd/gen/musan/musan",                    help='The path to the MUSAN set, eg:"/data08/Others/musan_split" in my case')
 parser.add_argument('--rir_path',   type=str,   default="/mnt/hdd/gen/rirs_noises/RIRS_NOISES/simulated_rirs",     help='The path to the RIR set, eg:"/data08/Others/RIRS_NOISES/simulated_rirs" in my case');
 parser.add_argument('--save_path',  type=str,   default="exps/huber3",                                     help='Path to save the score.txt and models')
@@ -45,6 +50,10 @@ parser.add_argument('--initial_extractor', type=str, default="/mnt/ssd/gen/Githu
 
 ## Model and Loss settings
 parser.add_argument('--C',       type=int,   default=1024,   help='Channel size for the speaker encoder')
+parser.add_argument('--C_p',     type=int,   default=0,      help='Channel size for the piezo encoder, 0 for C')
+parser.add_argument('--piezo_front_end', type=str, default='full', choices=['full', 'piezo', 'band'], help='Front-end of the piezo encoder, piezo: decimated to 4 kHz, 40 mels (see distill_piezo_encoder.py), band: 80 mels up to 2 kHz')
+parser.add_argument('--shared_encoder', dest='shared_encoder', action='store_true', help='One trunk for audio and piezo with per-modality BatchNorms (see convert_dual_encoder.py)')
+parser.add_argument('--adapter_dim', type=int,   default=0,      help='Per-modality adapters of this width in the shared encoder, 0 for none')
 parser.add_argument('--m',       type=float, default=0.2,    help='Loss margin in AAM softmax')
 parser.add_argument('--s',       type=float, default=30,     help='Loss scale in AAM softmax')
 parser.add_argument('--n_class', type=int,   default=81,   help='Number of speakers')
@@ -100,7 +109,8 @@ if True:
 							eval_uttr_verify=args.eval_uttr_verify, veri_usr_lst=veri_list, 
 							eval_noise_type=args.eval_noise_type, eval_noise_path=args.eval_noise_path,
 							eval_motion_type=args.eval_motion_type, eval_motion_path=args.eval_motion_path,
-							eval_times=2000)
+							eval_times=args.eval_times, embed_once=not args.eval_legacy,
+							eval_draws=args.eval_draws, replay_pool=args.eval_replay_pool)
 	print("EER %2.2f%%, threshold %2.5f, minDCF %.4f%%, FAR_replay %.4f, EER_audio %2.2f%%, EER_piezo %2.2f%%, thres_audio %2.5f, thres_piezo %2.5f, thres_conv %2.5f"%(EER * 100, 
 																																									 thres, minDCF, FAR_replay, EER_audio * 100, EER_piezo * 100, thres_audio, thres_piezo, thres_conv))
 	quit()
@@ -0,0 +1,182 @@
+'''
+Embed-once Monte-Carlo evaluation for PiezoBudsModel.eval_network.
+
+eval_network_one_time re-reads and re-embeds eval_user * (eval_uttr_enroll + 3 * eval_uttr_verify) random
+clips in every round, and eval_network runs thousands of rounds. EmbeddingTable reads and embeds every
+evaluation clip of the evaluated users once (audio, piezo and converted embeddings), together with a pool of
+replay mixtures per user. MonteCarloEvaluator then draws the enroll / verify splits of all rounds as index
+samples over the table and computes the EER / FAR / FRR / replay FAR of every round with batched tensor ops.
+
+The sampling protocol of eval_network_one_time is kept: in every round eval_user users are drawn from the
+evaluated users, eval_uttr_enroll + eval_uttr_verify distinct clips are drawn for each of them, the enrolled
+centroids are the means of the first eval_uttr_enroll and the statistics are those of eval_network_one_time.
+What is drawn once instead of in every round:
+- the crop of clips longer than num_frames * 160 + 240 samples, the specaug masks and the noise / motion crops
+  and SNR of every clip (with draws > 1, every clip is embedded draws times and one of them is used per round)
+- the (clip, replayed clip) pairs of the replay attack, of which every round draws eval_uttr_verify per user
+  from a pool of replay_pool pairs
+Under distributed training every rank embeds a share of the users and the table is assembled on all ranks.
+'''
+
+import os, random
+import numpy as np
+import soundfile
+import torch
+import torch.nn.functional as F
+from tools import compute_EER_sweep, compute_error_rates, ComputeMinDcf
+from split_manifest import read_list
+from distributed import get_rank, get_world_size, all_gather_objects
+
+
+class EmbeddingTable(object):
+    """
+    Audio / piezo / converted embeddings of every evaluation clip of a set of users.
+
+    - embeddings: (n_clips, draws, 3, D), modalities in the order audio, piezo, conv
+    - clip_index: (n_users, max_clips) clip rows of every user, padded with -1; n_clips per user in counts
+    - replay: (n_users, replay_pool, 3, D) embeddings of the replay mixtures of every user
+    """
+    def __init__(self, s, eval_list, eval_path, users, eval_noise_file=None, eval_motion_file=None,
+                 draws=1, replay_pool=50, batch_size=128):
+        self.s = s
+        self.users = list(users)
+        self.length = s.num_frames * 160 + 240
+        self.batch_size = batch_size
+        eval_dict = {}
+        for line in read_list(eval_list, 'test'):
+            id, file_path = int(line.split()[0]), eval_path + line.split()[1]
+            eval_dict.setdefault(id, []).append(file_path)
+
+        s.eval()
+        per_user = {}
+        for id in self.users[get_rank()::get_world_size()]:
+            files = eval_dict[id]
+            audios = np.array([self.read(os.path.join(eval_path, file)) for file in files])
+            piezos = np.array([self.read(os.path.join(eval_path, file).replace('audio', 'piezo')) for file in files])
+            embeddings = torch.stack([torch.stack(self.embed(*self.augment(audios, piezos, eval_noise_file, eval_motion_file)), dim=1)
+                                      for _ in range(draws)], dim=1)
+
+            # replay attack while talking: a clip of the user mixed with another of their clips, fed to both encoders
+            pairs = [random.sample(range(len(files)), 2) for _ in range(replay_pool)]
+            mixtures = np.array([audios[i] + audios[j] for i, j in pairs])
+            mixtures = mixtures / np.max(np.abs(mixtures), axis=1, keepdims=True)
+            per_user[id] = (embeddings, torch.stack(self.embed(mixtures, mixtures), dim=1))
+        if get_world_size() > 1:
+            for part in all_gather_objects(per_user):
+                per_user.update(part)
+
+        embeddings, replay, clip_index = [], [], []
+        n_clips = 0
+        for id in self.users:
+            embeddings.append(per_user[id][0])
+            replay.append(per_user[id][1])
+            clip_index.append(torch.arange(n_clips, n_clips + per_user[id][0].shape[0]))
+            n_clips += per_user[id][0].shape[0]
+
+        self.embeddings = torch.cat(embeddings, dim=0)
+        self.counts = torch.tensor([len(index) for index in clip_index])
+        self.clip_index = torch.full((len(self.users), int(self.counts.max())), -1, dtype=torch.long)
+        for i, index in enumerate(clip_index):
+            self.clip_index[i, :len(index)] = index
+        self.replay = torch.stack(replay, dim=0)
+
+    def read(self, path):
+        clip, _ = soundfile.read(path)
+        return self.s.process_wav(clip)[0]
+
+    def augment(self, audios, piezos, eval_noise_file, eval_motion_file):
+        # noise on the audio and motion on the piezo, as in eval_network_one_time (one SNR per user)
+        if eval_noise_file is not None:
+            noises = self.s.augment_bank.crops(eval_noise_file, audios.shape[0], self.length)
+            audios = self.s.add_noise(audios, noises / np.max(np.abs(noises)), 0, 1)
+        if eval_motion_file is not None:
+            motions = self.s.augment_bank.crops(eval_motion_file, piezos.shape[0], self.length)
+            piezos = self.s.add_noise(piezos, motions / np.max(np.abs(motions)), 0, 1)
+        return audios, piezos
+
+    def embed(self, audios, piezos):
+        # (n, samples) clips -> audio, piezo and converted embeddings on the cpu, in batches of batch_size
+        out = []
+        with torch.no_grad():
+            for start in range(0, audios.shape[0], self.batch_size):
+                audio = torch.from_numpy(audios[start:start + self.batch_size]).float().to(self.s.device)
+                piezo = torch.from_numpy(piezos[start:start + self.batch_size]).float().to(self.s.device)
+                # with specaug, as get_embeddings_cat in eval_network_one_time
+                out.append([e.cpu() for e in self.s.embed_batch(audio, piezo, aug=True)])
+        return [torch.cat(e, dim=0) for e in zip(*out)]
+
+
+class MonteCarloEvaluator(object):
+    """
+    Runs the rounds of eval_network over an EmbeddingTable.
+
+    run() returns, for every round, the tuple of eval_network_one_time as tensors of shape (eval_times,):
+    EER, EER_FAR, EER_FRR, threshold, FAR_replay, EER_audio, EER_piezo, thres_audio, thres_piezo, thres_conv
+    """
+    def __init__(self, table, threshold=0.56147, thres_audio=0.5190, thres_piezo=0.60798, thres_conv=0.68924,
+                 thresholds=None, device='cpu', seed=None):
+        self.table = table
+        self.threshold = threshold
+        self.thres = torch.tensor([thres_audio, thres_piezo, thres_conv], dtype=torch.float64)
+        # the sweep of compute_EER for EER_audio / EER_piezo
+        self.thresholds = torch.linspace(0.5, 1.0, 501) if thresholds is None else thresholds
+        self.device = device
+        self.generator = torch.Generator().manual_seed(random.randrange(2 ** 63) if seed is None else seed)
+
+    def sample(self, n, k, valid, rounds):
+        # (rounds, *valid.shape, k): k distinct positions among the first valid of n (random keys, padding sorts last)
+        keys = torch.rand(rounds, *valid.shape, n, generator=self.generator)
+        keys[torch.arange(n).expand_as(keys) >= valid.unsqueeze(-1)] = 2
+        return keys.argsort(dim=-1)[..., :k]
+
+    def run_chunk(self, rounds, eval_user, eval_uttr_enroll, eval_uttr_verify):
+        table = self.table
+        n_users = len(table.users)
+        total_uttr = eval_uttr_enroll + eval_uttr_verify
+        # eval_user users per round, then total_uttr clips and replay mixtures per user
+        users = self.sample(n_users, eval_user, torch.tensor(n_users), rounds)
+        clips = self.sample(table.clip_index.shape[1], total_uttr, table.counts[users], 1)[0]
+        clips = table.clip_index[users.unsqueeze(-1), clips]
+        draws = torch.randint(table.embeddings.shape[1], clips.shape, generator=self.generator)
+        embeddings = table.embeddings[clips, draws].to(self.device)  # (rounds, b, u, 3, D)
+        pool = table.replay.shape[1]
+        replay = self.sample(pool, eval_uttr_verify, torch.full(users.shape, pool), 1)[0]
+        replay = table.replay[users.unsqueeze(-1), replay].to(self.device)  # (rounds, b, v, 3, D)
+
+        centroids = F.normalize(embeddings[:, :, :eval_uttr_enroll].mean(dim=2), dim=-1)  # (rounds, b, 3, D)
+        verify = F.normalize(embeddings[:, :, eval_uttr_enroll:], dim=-1)
+        # (rounds, 3, b, v, b), get_modal_cossim_revised of every modality
+        sims = torch.einsum('rivmd,rjmd->rmivj', verify, centroids) + 1e-6
+        EER_audio = compute_EER_sweep(sims[:, 0], self.thresholds)[0]
+        EER_piezo = compute_EER_sweep(sims[:, 1], self.thresholds)[0]
+        FAR, FRR = compute_error_rates(sims.mean(dim=1), torch.tensor([self.threshold]))
+        FAR, FRR = FAR[:, 0], FRR[:, 0]
+
+        # replay mixtures against the centroids of their own user, accepted if every modality passes its threshold
+        sims_replay = (F.normalize(replay, dim=-1) * centroids.unsqueeze(2)).sum(dim=-1) + 1e-6  # (rounds, b, v, 3)
+        FAR_replay = (sims_replay > self.thres.to(self.device, sims_replay.dtype)).all(dim=-1).float().mean(dim=(1, 2))
+        self.last_replay = sims_replay[-1, 0]
+
+        full = lambda value: torch.full((rounds,), value, dtype=torch.float64)
+        return [((FAR + FRR) / 2).cpu(), FAR.cpu(), FRR.cpu(), full(self.threshold), FAR_replay.cpu(),
+                EER_audio.cpu(), EER_piezo.cpu(), full(float(self.thres[0])), full(float(self.thres[1])), full(float(self.thres[2]))]
+
+    def run(self, eval_user, eval_uttr_enroll, eval_uttr_verify, eval_times, rounds_per_chunk=100):
+        if eval_user > len(self.table.users):
+            raise ValueError('Cannot draw %d of %d users' % (eval_user, len(self.table.users)))
+        if int(self.table.counts.min()) < eval_uttr_enroll + eval_uttr_verify:
+            raise ValueError('Every user needs at least %d clips' % (eval_uttr_enroll + eval_uttr_verify))
+        if self.table.replay.shape[1] < eval_uttr_verify:
+            raise ValueError('The replay pool needs at least %d mixtures per user' % eval_uttr_verify)
+        results = []
+        for start in range(0, eval_times, rounds_per_chunk):
+            results.append(self.run_chunk(min(rounds_per_chunk, eval_times - start), eval_user, eval_uttr_enroll, eval_uttr_verify))
+        return [torch.cat(x, dim=0) for x in zip(*results)]
+
+
+def summarize(results):
+    # eval_network's aggregation of the per-round results
+    EER, EER_FAR, EER_FRR, threshold, FAR_replay, EER_audio, EER_piezo, thres_audio, thres_piezo, thres_conv = [x.tolist() for x in results]
+    minDCF, _ = ComputeMinDcf(EER_FRR, EER_FAR, threshold, 0.05, 1, 1)
+    return np.mean(EER), minDCF, np.mean(threshold), np.mean(FAR_replay), np.mean(EER_audio), np.mean(EER_piezo), \
+        np.mean(thres_audio), np.mean(thres_piezo), np.mean(thres_conv)
@@ -0,0 +1,188 @@
+'''
+Export a trained PiezoBuds model as a single verification graph for on-device / edge-CPU inference.
+
+The exported module takes (audio, piezo, enrolled_centroids) and returns the fused score of every attempt
+together with the per-modality scores, i.e. encoder_a, encoder_p, the converter and the cosine scoring of
+PiezoBudsModel.verify_batch in one traced graph. With --quantize the 1x1 convolutions of the TDNN / Bottle2neck /
+SE / attention layers (rewritten as Linear layers) and the final Linear layer of both encoders are dynamically
+quantized to int8. The export is checked against the float model and a CPU latency / size report is printed.
+'''
+
+import argparse, copy, os, time
+import numpy as np
+import soundfile
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.mobile_optimizer import optimize_for_mobile
+from PiezoBudsModel import PiezoBudsModel
+from model import AttentiveStatsPool
+from split_manifest import read_list
+
+
+class Conv1x1AsLinear(nn.Module):
+    '''
+    A kernel_size=1 Conv1d as a Linear layer over the channels, which dynamic quantization supports.
+    '''
+    def __init__(self, conv):
+        super(Conv1x1AsLinear, self).__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight.squeeze(2))
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def conv1x1_to_linear(module):
+    # replace, in place, every pointwise Conv1d of module by a Conv1x1AsLinear
+    for name, child in module.named_children():
+        if isinstance(module, AttentiveStatsPool) and name == '0':
+            # the pooling splits the weight of its first conv between the frames and the mean / std, it stays a Conv1d
+            continue
+        if isinstance(child, nn.Conv1d) and child.kernel_size == (1,) and child.stride == (1,) \
+                and child.padding == (0,) and child.groups == 1:
+            setattr(module, name, Conv1x1AsLinear(child))
+        else:
+            conv1x1_to_linear(child)
+    return module
+
+
+class FusedVerifier(nn.Module):
+    '''
+    encoder_a + encoder_p + converter + scoring of PiezoBudsModel.verify_batch as one module.
+
+    forward(audio, piezo, centroids):
+    - audio, piezo: (n, num_frames * 160 + 240) clips
+    - centroids: (n, 3, 192) enrolled audio / piezo / converted centroids of the claimed user of every attempt,
+      e.g. EnrollmentStore.get_centroids(claimed_ids)
+    Returns the fused scores (n,) and the audio / piezo / converted scores (n, 3).
+    '''
+    def __init__(self, encoder_a, encoder_p, converter):
+        super(FusedVerifier, self).__init__()
+        self.encoder_a = encoder_a
+        self.encoder_p = encoder_p
+        self.converter = converter
+
+    def forward(self, audio, piezo, centroids):
+        embeddings_audio = self.encoder_a.forward(audio, aug=False)
+        embeddings_piezo = self.encoder_p.forward(piezo, aug=False)
+        embeddings_conv = self.converter.convert(embeddings_piezo, embeddings_audio)
+        embeddings = torch.stack([embeddings_audio, embeddings_piezo, embeddings_conv], dim=1)
+        sims = F.cosine_similarity(embeddings, centroids, dim=-1) + 1e-6
+        return sims.mean(dim=1), sims
+
+
+def build_verifier(s, quantize=False):
+    encoder_a = copy.deepcopy(s.encoder_a).cpu().eval()
+    encoder_p = copy.deepcopy(s.encoder_p).cpu().eval()
+    converter = copy.deepcopy(s.converter).cpu().eval()
+    verifier = FusedVerifier(encoder_a, encoder_p, converter).eval()
+    if quantize:
+        # the dilated convolutions (kernel 3 / 5) have no dynamic int8 kernel and stay in float,
+        # as does the converter, whose reverse divides by coupling outputs and amplifies quantization error
+        conv1x1_to_linear(verifier.encoder_a)
+        conv1x1_to_linear(verifier.encoder_p)
+        verifier.encoder_a = torch.ao.quantization.quantize_dynamic(verifier.encoder_a, {nn.Linear}, dtype=torch.qint8)
+        verifier.encoder_p = torch.ao.quantization.quantize_dynamic(verifier.encoder_p, {nn.Linear}, dtype=torch.qint8)
+    # cache the folded converter weights now, so that the trace records the frozen path
+    verifier.converter.freeze()
+    return verifier
+
+
+def load_clips(eval_list, eval_path, n, length):
+    # n random (audio, piezo) clips of an eval list, cropped / wrap-padded to length samples
+    files = [line.split()[1] for line in read_list(eval_list, 'test')]
+    audios, piezos = [], []
+    for file in np.random.choice(files, n, replace=False):
+        for clips, path in [(audios, os.path.join(eval_path, file)), (piezos, os.path.join(eval_path, file).replace('audio', 'piezo'))]:
+            clip, _ = soundfile.read(path)
+            clips.append(np.pad(clip, (0, max(0, length - clip.shape[0])), 'wrap')[:length])
+    return torch.from_numpy(np.array(audios)).float(), torch.from_numpy(np.array(piezos)).float()
+
+
+def latency_ms(module, inputs, runs):
+    with torch.no_grad():
+        for _ in range(3):
+            module(*inputs)
+        tic = time.time()
+        for _ in range(runs):
+            module(*inputs)
+    return (time.time() - tic) / runs * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export PiezoBuds as one (quantized) verification graph')
+    parser.add_argument('--initial_model', type=str,   required=True, help='Path of the PiezoBuds model')
+    parser.add_argument('--out',           type=str,   default='exps/mobile/piezobuds_verifier', help='Output prefix, writes <out>.pt (and <out>.ptl with --mobile)')
+    parser.add_argument('--mobile',        dest='mobile', action='store_true', help='Also write an optimize_for_mobile lite interpreter model (needs XNNPACK)')
+    parser.add_argument('--quantize',      dest='quantize', action='store_true', help='Dynamic int8 quantization of the pointwise convolutions and linear layers')
+    parser.add_argument('--num_frames',    type=int,   default=50)
+    parser.add_argument('--C',             type=int,   default=1024)
+    parser.add_argument('--C_p',           type=int,   default=0, help='Channel size of the piezo encoder, 0 for C')
+    parser.add_argument('--piezo_front_end', type=str, default='full', choices=['full', 'piezo', 'band'])
+    parser.add_argument('--shared_encoder', dest='shared_encoder', action='store_true', help='The model has one trunk for both modalities')
+    parser.add_argument('--adapter_dim',   type=int,   default=0)
+    parser.add_argument('--n_class',       type=int,   default=81)
+    parser.add_argument('--threshold',     type=float, default=0.56147)
+    parser.add_argument('--eval_list',     type=str,   default='', help='Clips for the parity check, random signals if empty')
+    parser.add_argument('--eval_path',     type=str,   default='')
+    parser.add_argument('--n_parity',      type=int,   default=64, help='Number of attempts in the parity check')
+    parser.add_argument('--threads',       type=int,   default=1, help='CPU threads for the latency report')
+    parser.add_argument('--runs',          type=int,   default=20)
+    args = parser.parse_args()
+
+    s = PiezoBudsModel(lr=0.001, lr_decay=0.97, C=args.C, n_class=args.n_class, m=0.2, s=30, test_step=50,
+                       device='cpu', num_frames=args.num_frames, C_p=args.C_p, piezo_front_end=args.piezo_front_end,
+                       shared_encoder=args.shared_encoder, adapter_dim=args.adapter_dim)
+    s.load_parameters(args.initial_model)
+    s.eval()
+
+    length = args.num_frames * 160 + 240
+    if args.eval_list != '':
+        audio, piezo = load_clips(args.eval_list, args.eval_path, args.n_parity, length)
+    else:
+        audio, piezo = torch.randn(args.n_parity, length) * 0.1, torch.randn(args.n_parity, length) * 0.1
+    # claim the identity of the attempt itself for half of the attempts and of another attempt for the rest,
+    # so the parity check sees genuine-like and impostor-like scores
+    reference = FusedVerifier(s.encoder_a, s.encoder_p, s.converter).eval()
+    with torch.no_grad():
+        embeddings = torch.stack([s.encoder_a.forward(audio, aug=False), s.encoder_p.forward(piezo, aug=False)], dim=1)
+        embeddings = torch.cat([embeddings, s.converter.convert(embeddings[:, 1], embeddings[:, 0]).unsqueeze(1)], dim=1)
+        claimed = torch.arange(args.n_parity)
+        claimed[args.n_parity // 2:] = claimed[args.n_parity // 2:].roll(1)
+        centroids = embeddings[claimed]
+        scores_ref, sims_ref = reference(audio, piezo, centroids)
+
+    verifier = build_verifier(s, args.quantize)
+    # traced on the whole parity batch; the trace checker re-traces it on a single attempt and compares graphs and
+    # outputs, so a Python branch or shape read that the trace froze for one batch size fails the export.
+    # One forward first fills the fused Bottle2neck weights, so that neither trace records the folding itself
+    example = (audio[:1], piezo[:1], centroids[:1])
+    with torch.no_grad():
+        verifier(*example)
+        traced = torch.jit.trace(verifier, (audio, piezo, centroids), check_inputs=[example], check_tolerance=1e-4)
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    traced.save(args.out + '.pt')
+    if args.mobile:
+        optimize_for_mobile(traced)._save_for_lite_interpreter(args.out + '.ptl')
+
+    # parity of the exported graph against the float model
+    exported = torch.jit.load(args.out + '.pt')
+    with torch.no_grad():
+        scores, sims = exported(audio, piezo, centroids)
+    agree = ((scores > args.threshold) == (scores_ref > args.threshold)).float().mean().item()
+    print('Parity: max |score diff| %.5f, max |modality score diff| %.5f (audio %.5f, piezo %.5f, conv %.5f), decision agreement %.2f%%' % (
+        (scores - scores_ref).abs().max(), (sims - sims_ref).abs().max(),
+        *[(sims[:, m] - sims_ref[:, m]).abs().max() for m in range(3)], agree * 100))
+
+    # CPU latency and size
+    torch.set_num_threads(args.threads)
+    float_size = sum(p.numel() * p.element_size() for p in reference.parameters()) / 1024 / 1024
+    sizes = ', '.join('%s%s %.2f MB' % (args.out, ext, os.path.getsize(args.out + ext) / 1024 / 1024)
+                      for ext in ['.pt', '.ptl'] if ext == '.pt' or args.mobile)
+    print('Size: float parameters %.2f MB, %s' % (float_size, sizes))
+    print('Latency (1 attempt, %d thread(s)): float model %.1f ms, exported %.1f ms' % (
+        args.threads, latency_ms(reference, example, args.runs), latency_ms(exported, example, args.runs)))
@@ -1,4 +1,12 @@
 import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import librosa
 import numpy as np
 from speech_split import split_audio_to_utterances, apply_vad
@@ -13,6 +21,22 @@ import matplotlib.pyplot as plt
 import scipy.io.wavfile as wav_writer
 
 
+def clip_starts(num_samples, sample_rate, window_size_ms):
+    """
+    Start indices of the clips of slice_audio.
+
+    :param num_samples: Integer, the length of the audio data.
+    :param sample_rate: Integer, the sample rate of the audio data.
+    :param window_size_ms: Integer, the window size in milliseconds.
+    :return: (starts, window_size_samples), clip k is audio_data[starts[k]:starts[k] + window_size_samples].
+    """
+    window_size_samples = int((window_size_ms / 1000) * sample_rate)
+    num_clips = int(np.ceil(num_samples / window_size_samples))
+    # a last clip shorter than the window is padded with the preceding audio, i.e. it is the last full window
+    starts = np.minimum(np.arange(num_clips) * window_size_samples, max(num_samples - window_size_samples, 0))
+    return starts, window_size_samples
+
+
 def slice_audio(audio_data, sample_rate, window_size_ms):
     """
     Slices the audio data into clips of the specified window size. If the last clip
@@ -22,31 +46,10 @@ def slice_audio(audio_data, sample_rate, window_size_ms):
     :param audio_data: 1D NumPy array of audio data.
     :param sample_rate: Integer, the sample rate of the audio data.
     :param window_size_ms: Integer, the window size in milliseconds.
-    :return: List of 1D NumPy arrays, each representing a clip of the specified window size.
+    :return: List of 1D NumPy arrays (views of audio_data), each representing a clip of the specified window size.
     """
-    # Calculate the window size in samples
-    window_size_samples = int((window_size_ms / 1000) * sample_rate)
-    
-    # Calculate the number of clips to be created
-    num_clips = int(np.ceil(len(audio_data) / window_size_samples))
-    
-    # Slice the audio and collect clips
-    audio_clips = []
-    for i in range(num_clips):
-        start_index = i * window_size_samples
-        end_index = start_index + window_size_samples
-        if end_index > len(audio_data):
-            # If we're beyond the end of the audio, pad the last clip
-            last_clip = audio_data[start_index:]
-            padding_needed = window_size_samples - len(last_clip)
-            # Pad with the preceding audio
-            padded_clip = np.concatenate((audio_data[-(padding_needed + len(last_clip)):-len(last_clip)], last_clip))
-            audio_clips.append(padded_clip)
-        else:
-            # Otherwise, just append the clip
-            audio_clips.append(audio_data[start_index:end_index])
-    
-    return audio_clips
+    starts, window_size_samples = clip_starts(len(audio_data), sample_rate, window_size_ms)
+    return [audio_data[start:start + window_size_samples] for start in starts]
 
 
 def compute_mfcc(data, sr, n_mfcc=13, n_mels=40, fmin=0, fmax=None):
@@ -198,117 +201,204 @@ def get_stft(audio, sample_rate=44100, n_fft=2048, hop_length=512, n_frames=128)
     return lists
 
 
+STAGES = ['load', 'denoise', 'resample', 'vad', 'write_clips', 'spectra']
+
+
+@functools.lru_cache(maxsize=None)
+def load_noise(noise_path):
+    # reference noise of the 16 kHz recordings, loaded once per worker
+    sr, noise = scipy.io.wavfile.read(noise_path)
+    return librosa.resample(noise, orig_sr=sr, target_sr=16000)
+
+
+def params_key(params):
+    # hash of the parameters that change the outputs, a user is only skipped if it was processed with the same ones
+    # options left at None are not part of the key, so that adding an option does not invalidate old manifests
+    params = {k: v for k, v in params.items() if v is not None}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def replace_dir(tmp_dir, final_dir):
+    # move a completely written directory into place, dropping what an interrupted run may have left there
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir)
+    os.replace(tmp_dir, final_dir)
+
+
+def save_npy_atomic(path, array):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def process_user(i, params):
+    """
+    Preprocess the recording of user i: high-pass filter and denoise the piezo channel, resample both channels
+    to 16 kHz, run the VAD on the audio channel, write the per_clip_duration wav clips of every utterance and
+    the normalized power spectra. Outputs are written to temporary paths and moved into place at the end.
+    Returns the number of clips and spectra and the time spent in every stage.
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    tic = time.time()
+
+    def lap(stage):
+        nonlocal tic
+        timings[stage] += time.time() - tic
+        tic = time.time()
+
+    dir_wav_piezo = os.path.join(params['dir_wav'], params['data_set'], 'piezo', str(i))
+    dir_wav_audio = os.path.join(params['dir_wav'], params['data_set'], 'audio', str(i))
+    sr, data = scipy.io.wavfile.read(params['root'].format(i, i))
+    lap('load')
+    tmp_piezo, tmp_audio = dir_wav_piezo + '.partial', dir_wav_audio + '.partial'
+    for d in [tmp_piezo, tmp_audio]:
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+    try:
+        n_clips, n_spectra = _process_recording(i, sr, data, params, tmp_piezo, tmp_audio, lap)
+    except BaseException:
+        shutil.rmtree(tmp_piezo, ignore_errors=True)
+        shutil.rmtree(tmp_audio, ignore_errors=True)
+        raise
+    replace_dir(tmp_piezo, dir_wav_piezo)
+    replace_dir(tmp_audio, dir_wav_audio)
+    lap('write_clips')
+    return {'user': i, 'n_clips': n_clips, 'n_spectra': n_spectra, 'timings': timings}
+
+
+def _process_recording(i, sr, data, params, tmp_piezo, tmp_audio, lap):
+    # the stages of process_user after loading, writing into the temporary clip directories
+    if sr == 24000:
+        piezo = data[:, 0]
+        piezo = piezo[24000:len(piezo) - 3000]
+        audio = data[24000 + 3000:, 1]
+        piezo = butter_highpass_filter(piezo, 100, sr, order=5)
+        piezo = nr.reduce_noise(piezo, sr)
+    else:
+        piezo = data[:, 0]
+        piezo = piezo[16000:len(piezo) - 1500]
+        audio = data[16000 + 1500:, 1]
+        piezo = butter_highpass_filter(piezo, 100, sr, order=5)
+        piezo = nr.reduce_noise(piezo, sr, y_noise=load_noise(params['noise']))
+    piezo = piezo / np.max(np.abs(piezo))
+    audio = audio / np.max(np.abs(audio))
+    lap('denoise')
+    piezo = librosa.resample(piezo, orig_sr=sr, target_sr=16000)
+    audio = librosa.resample(audio, orig_sr=sr, target_sr=16000)
+    sr = 16000
+    lap('resample')
+
+    speech_labels = apply_vad(audio, sr, params['vad_level'], params['frame_duration'], params.get('vad_min_rms'))
+    speech_utterances = split_audio_to_utterances(audio, sr, speech_labels, params['frame_duration'], params['min_speech_duration'])
+    lap('vad')
+
+    n_fft, hop_len, t_len = params['n_fft'], params['hop_len'], params['t_len']
+    piezos, audios = [], []
+    j = 0
+    for utterance in speech_utterances:
+        piezo_piece = piezo[utterance[0]: utterance[1]]
+        audio_piece = audio[utterance[0]: utterance[1]]
+
+        # clips are written straight from views of the utterance
+        starts, window = clip_starts(len(audio_piece), sr, params['per_clip_duration'])
+        for start in starts:
+            wav_writer.write(os.path.join(tmp_piezo, '{}.wav'.format(j)), sr, piezo_piece[start:start + window])
+            wav_writer.write(os.path.join(tmp_audio, '{}.wav'.format(j)), sr, audio_piece[start:start + window])
+            j = j + 1
+        lap('write_clips')
+
+        piezos += get_stft(piezo_piece, 16000, n_fft, hop_len, t_len)
+        audios += get_stft(audio_piece, 16000, n_fft, hop_len, t_len)
+        lap('spectra')
+
+    for k in range(len(piezos)):
+        piezos[k] = 10*np.log10(np.abs(piezos[k])**2)
+        audios[k] = 10*np.log10(np.abs(audios[k])**2)
+        audios_max = np.max(audios[k])
+        audios_min = np.min(audios[k])
+        audios[k] = (audios[k] - audios_min) / (audios_max - audios_min)
+        piezos[k] = (piezos[k] - audios_min) / (audios_max - audios_min)
+    piezos = np.array(piezos)[:, :256, :]
+    audios = np.array(audios)[:, :256, :]
+    spectra_dir = os.path.join(params['spectra_dir'], 'res_' + str(n_fft // 2) + '_hop_' + str(hop_len) + '_t_' + str(t_len))
+    os.makedirs(spectra_dir, exist_ok=True)
+    save_npy_atomic(os.path.join(spectra_dir, '{}_piezo.npy'.format(i)), piezos)
+    save_npy_atomic(os.path.join(spectra_dir, '{}_audio.npy'.format(i)), audios)
+    lap('spectra')
+    return j, int(piezos.shape[0])
+
+
+def read_manifest(path):
+    # user -> last completion record; a line cut short by a crash is ignored
+    done = {}
+    if os.path.exists(path):
+        for line in open(path).read().splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[record['user']] = record
+    return done
+
+
+def run_pipeline(users, params, workers=4, manifest=None, force=False):
+    """
+    Run process_user for every user in a process pool. Every finished user is appended to the manifest
+    (one JSON line per user), and users already recorded there with the same parameters are skipped.
+    Returns the records of the users processed by this run.
+    """
+    key = params_key(params)
+    manifest = manifest or os.path.join(params['dir_wav'], params['data_set'], 'manifest.jsonl')
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    done = read_manifest(manifest)
+    todo = [i for i in users if force or done.get(i, {}).get('params') != key]
+    print('%d users to process, %d already done (manifest %s)' % (len(todo), len(users) - len(todo), manifest))
+
+    records = []
+    tic = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(manifest, 'a') as f:
+        futures = {pool.submit(process_user, i, params): i for i in todo}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                print('user %d failed: %r' % (i, e), file=sys.stderr)
+                continue
+            record['params'] = key
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            records.append(record)
+            print('user %d: %d clips, %d spectra, %.1fs' % (i, record['n_clips'], record['n_spectra'], sum(record['timings'].values())))
+
+    if records:
+        total = {stage: sum(r['timings'][stage] for r in records) for stage in STAGES}
+        print('Processed %d users in %.1fs wall time (%d workers)' % (len(records), time.time() - tic, workers))
+        for stage in STAGES:
+            print('  %-12s %8.1fs  %5.1f%%' % (stage, total[stage], 100 * total[stage] / max(sum(total.values()), 1e-9)))
+    return records
+
+
 if __name__ == "__main__":
-    sr, noise = scipy.io.wavfile.read('./noise.wav')
-    raw_noise = librosa.resample(noise, orig_sr=sr, target_sr=16000)
-
-    root = './data/{}/{}.wav'
-    vad_level = 2
-    frame_duration = 30  # Duration of each frame in ms
-    min_speech_duration = 1000
-    per_clip_duration = 500 # clip in ms
-    # model = vggish()
-
-    dir_wav = './processed_data/wav_clips/'
-    data_set = 'piezobuds/'
-
-    labels = []
-
-    for i in range(0, 70):
-        dir_wav_piezo = dir_wav + data_set + 'piezo/' + '{}/'.format(i)
-        dir_wav_audio = dir_wav + data_set + 'audio/' + '{}/'.format(i)             
-        os.makedirs(dir_wav_audio, exist_ok=True)
-        os.makedirs(dir_wav_piezo, exist_ok=True)
-        print(i)
-        piezos = []
-        audios = []
-        noises = []
-
-        fft_piezos = []
-        fft_audios = []
-
-        file_path = root.format(i, i)
-        sr, data = scipy.io.wavfile.read(file_path)
-        if sr == 24000:
-            piezo = data[:, 0]
-            piezo = piezo[24000:len(piezo) - 3000]
-            audio = data[24000 + 3000:, 1]
-            piezo = butter_highpass_filter(piezo, 100, sr, order=5)
-            piezo = nr.reduce_noise(piezo, sr)
-        else:
-            piezo = data[:, 0]
-            piezo = piezo[16000:len(piezo) - 1500]
-            audio = data[16000 + 1500:, 1]
-            piezo = butter_highpass_filter(piezo, 100, sr, order=5)
-            piezo = nr.reduce_noise(piezo, sr, y_noise=raw_noise)
-            # piezo = piezo[24000:len(piezo) - 3000]
-            # audio = data[24000 + 3000:, 1]
-        piezo = piezo / np.max(np.abs(piezo))
-        audio = audio / np.max(np.abs(audio))
-        piezo = librosa.resample(piezo, orig_sr=sr, target_sr=16000)
-        audio = librosa.resample(audio, orig_sr=sr, target_sr=16000)
-        sr = 16000
-
-        speech_labels = apply_vad(audio, sr, vad_level, frame_duration)
-        speech_utterances = split_audio_to_utterances(audio, sr, speech_labels, frame_duration, min_speech_duration)
-
-        # longest = max(speech_utterances, key=lambda x: x[1] - x[0])
-        # longest_length = longest[1] - longest[0]
-        # print(longest_length)
-
-        n_fft = 512
-        hop_len = 256
-        t_len = 16
-        j = 0
-        for utterance in speech_utterances:
-            labels.append(i)
-
-            piezo_piece = piezo[utterance[0]: utterance[1]]
-            audio_piece = audio[utterance[0]: utterance[1]]
-
-            piezo_clips = slice_audio(piezo_piece, sr, per_clip_duration)
-            audio_clips = slice_audio(audio_piece, sr, per_clip_duration)
-            for x in range(len(piezo_clips)):
-                wav_writer.write(dir_wav_piezo + '{}.wav'.format(j), sr, piezo_clips[x])
-                wav_writer.write(dir_wav_audio + '{}.wav'.format(j), sr, audio_clips[x])
-                j = j + 1
-
-            noise = generate_white_noise(len(audio_piece))
-
-            bins_piezo = get_stft(piezo_piece, 16000, n_fft, hop_len, t_len)
-            bins_audio = get_stft(audio_piece, 16000, n_fft, hop_len, t_len)
-            piezos += bins_piezo
-            audios += bins_audio
-
-        for j in range(len(piezos)):
-            piezos[j] = 10*np.log10(np.abs(piezos[j])**2)
-            audios[j] = 10*np.log10(np.abs(audios[j])**2)
-            audios_max = np.max(audios[j])
-            audios_min = np.min(audios[j])
-            audios[j] = (audios[j] - audios_min) / (audios_max - audios_min)
-            piezos[j] = (piezos[j] - audios_min) / (audios_max - audios_min)
-
-            # piezos[j] = librosa.amplitude_to_db(np.abs(piezos[j]))
-            # audios[j] = librosa.amplitude_to_db(np.abs(audios[j]))
-            
-        piezos = np.array(piezos)
-        audios = np.array(audios)
-        piezos = piezos[:, :256, :]
-        audios = audios[:, :256, :]
-        n = piezos.shape[0]
-        # os.makedirs("./stft_img/", exist_ok=True)
-        # for j in range(n):
-        #     plot_stft_colormap(piezos[j], "./stft_img/{}_{}_{}.png".format(i, j, 0))
-        #     plot_stft_colormap(audios[j], "./stft_img/{}_{}_{}.png".format(i, j, 1))
-        print(piezos.shape)
-        print(audios.shape)
-        # file_dir_name = './processed_data/res_512/'
-        #file_dir_name = './processed_data/res_512a_512p/'
-        file_dir_name = './processed_data/power_spectra/res_' + str(n_fft // 2) + '_hop_' + str(hop_len) + '_t_' + str(t_len) +'/'
-        os.makedirs(file_dir_name, exist_ok=True)
-        np.save(file_dir_name+'{}_piezo.npy'.format(i), piezos)
-        np.save(file_dir_name+'{}_audio.npy'.format(i), audios)
-        # np.save(file_dir_name+'{}_noise.npy'.format(i), noises)
-
-
-        # print(len(speech_utterances))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Preprocess the raw piezo + mic recordings into wav clips and power spectra')
+    parser.add_argument('--root',                type=str, default='./data/{}/{}.wav', help='Recording of user i, formatted with (i, i)')
+    parser.add_argument('--noise',               type=str, default='./noise.wav', help='Reference noise for the 16 kHz recordings')
+    parser.add_argument('--dir_wav',             type=str, default='./processed_data/wav_clips/')
+    parser.add_argument('--data_set',            type=str, default='piezobuds/')
+    parser.add_argument('--spectra_dir',         type=str, default='./processed_data/power_spectra/')
+    parser.add_argument('--users',               type=int, nargs=2, default=[0, 70], help='Process users in [start, end)')
+    parser.add_argument('--workers',             type=int, default=os.cpu_count())
+    parser.add_argument('--manifest',            type=str, default='', help='Completion manifest, <dir_wav>/<data_set>/manifest.jsonl by default')
+    parser.add_argument('--force',               dest='force', action='store_true', help='Reprocess users already in the manifest')
+    parser.add_argument('--vad_level',           type=int, default=2)
+    parser.add_argument('--vad_min_rms',         type=float, default=None, help='Label frames with RMS (16-bit units) at most this as silence without running the VAD')
+    parser.add_argument('--frame_duration',      type=int, default=30, help='Duration of each VAD frame in ms')
+    parser.add_argument('--min_speech_duration', type=int, default=1000)
+    parser.add_argument('--per_clip_duration',   type=int, default=500, help='Clip length in ms')
+    parser.add_argument('--n_fft',               type=int, default=512)
+    parser.add_argument('--hop_len',             type=int, default=256)
+    parser.add_argument('--t_len',               type=int, default=16)
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ('users', 'workers', 'manifest', 'force')}
+    run_pipeline(list(range(*args.users)), params, args.workers, args.manifest or None, args.force)
@@ -0,0 +1,121 @@
+'''
+Log-mel front-end caching for the ECAPA encoders.
+
+FbankCache: within one training step, train_network embeds the same audio / piezo tensors several times
+(audio goes through both encoders in three of the four infer_embedding calls). An FbankCache attached to
+encoder_a and encoder_p computes the log-mel features of every distinct input once per step. Specaug is still
+drawn independently for every call, on a copy of the cached features.
+
+persist_corpus_fbanks: writes the log-mel features of every clip of a corpus packed by packed_corpus.py, computed by
+one front-end (a key of model.FRONT_ENDS), to
+  <prefix>.<modality>.<front_end>.fbank.npy   (n_clips, n_mels, frames)
+so that train_loader(fbank_prefix=..., fbank_front_end=...) can feed features to the encoders without any STFT in the
+training loop.
+'''
+
+import argparse, contextlib
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from model import FRONT_ENDS, make_torchfbank, compute_log_fbank
+from packed_corpus import PackedClipCorpus
+
+
+class FbankCache(object):
+    """
+    Log-mel features of the waveforms seen since the cache became active, shared by the encoders it is attached to.
+
+    An input hits the cache if it is a view of a cached tensor that was not modified since (same storage,
+    shape, strides and version counter) or, with by_content, if it has exactly the same values (torch.equal),
+    and its features were computed by the same front-end (the key of model.FRONT_ENDS of the encoder).
+    Cached inputs are referenced by the cache, so their storage cannot be reused while the step runs.
+    """
+    def __init__(self, by_content=True):
+        self.by_content = by_content
+        self.active = False
+        self.entries = []  # (input, front-end, features)
+        self.hits, self.misses = 0, 0
+
+    def attach(self, *encoders):
+        for encoder in encoders:
+            encoder.fbank_cache = self
+        return self
+
+    @contextlib.contextmanager
+    def step(self):
+        # features are only cached inside the block, and dropped when it ends
+        self.entries, self.active = [], True
+        try:
+            yield self
+        finally:
+            self.entries, self.active = [], False
+
+    def _same(self, x, y):
+        if x.shape != y.shape or x.dtype != y.dtype or x.device != y.device:
+            return False
+        if x.data_ptr() == y.data_ptr() and x.stride() == y.stride() and x._version == y._version:
+            return True
+        return self.by_content and torch.equal(x, y)
+
+    def get(self, x, compute, front_end='full'):
+        if not self.active:
+            return compute(x)
+        for y, key, features in self.entries:
+            if key == front_end and self._same(x, y):
+                self.hits += 1
+                return features
+        self.misses += 1
+        features = compute(x)
+        self.entries.append((x, front_end, features))
+        return features
+
+
+def crop_clip(clip, length):
+    # train_loader.process_wav for clips of at most length samples (wrap padding, start 0)
+    if clip.shape[0] <= length:
+        return np.pad(clip, (0, length - clip.shape[0]), 'wrap')
+    return clip[:length]
+
+
+def persist_corpus_fbanks(prefix, num_frames=50, batch_size=256, dtype='float32', device='cpu', front_end='full'):
+    """
+    Compute the log-mel features of front-end front_end of every clip of the packed corpus <prefix> and write
+    <prefix>.<modality>.<front_end>.fbank.npy.
+
+    The features are those of the first num_frames * 160 + 240 samples of each clip, which is what process_wav
+    takes from clips that are not longer than that (the 500 ms clips). Longer clips are randomly cropped by
+    process_wav, so training from persisted features always uses their first segment; they are counted and reported.
+    """
+    corpus = PackedClipCorpus(prefix)
+    length = num_frames * 160 + 240
+    torchfbank = make_torchfbank(**FRONT_ENDS[front_end]).to(device)
+    n_long = int(np.sum(np.diff(corpus.offsets) > length))
+    for name in corpus.arrays:
+        features = None
+        for start in range(0, len(corpus), batch_size):
+            indices = range(start, min(start + batch_size, len(corpus)))
+            clips = np.array([crop_clip(corpus.read(name, i), length) for i in indices])
+            x = compute_log_fbank(torchfbank, torch.from_numpy(clips).float().to(device)).cpu().numpy()
+            if features is None:
+                features = open_memmap('%s.%s.%s.fbank.npy' % (prefix, name, front_end), mode='w+', dtype=dtype,
+                                       shape=(len(corpus),) + x.shape[1:])
+            features[start:start + x.shape[0]] = x
+        features.flush()
+        del features
+    return len(corpus), n_long
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Persist the log-mel features of a packed corpus')
+    parser.add_argument('--packed_prefix', type=str, default='/mnt/ssd/gen/processed_data/packed/piezobuds_new_1_train')
+    parser.add_argument('--num_frames',    type=int, default=50)
+    parser.add_argument('--batch_size',    type=int, default=256)
+    parser.add_argument('--dtype',         type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--front_end',     type=str, default='full', choices=list(FRONT_ENDS), help='Front-end of the encoders the features are for')
+    parser.add_argument('--device',        type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    n_clips, n_long = persist_corpus_fbanks(args.packed_prefix, args.num_frames, args.batch_size, args.dtype, args.device, args.front_end)
+    print('Wrote the features of %d clips to %s.*.%s.fbank.npy' % (n_clips, args.packed_prefix, args.front_end))
+    if n_long > 0:
+        print('%d clips are longer than %d samples, only their first segment was kept' % (n_long, args.num_frames * 160 + 240))
@@ -0,0 +1,164 @@
+'''
+Fused GE2E losses.
+
+One similarity matrix per call (similarity.ge2e_cossim / modal_cossim): the GE2E softmax, GE2E contrast,
+intra-modal and per-user softmax losses are all read from that matrix. The boolean masks these losses
+need depend only on (N, M) and the device and are built once. With checkpoint=True the similarity
+matrix and the losses are recomputed during backward instead of keeping the (N, M, D) temporaries alive.
+
+The functions keep the semantics (including the 1e-6 offsets) of utils.calc_loss, cal_contrast_loss,
+cal_intra_loss, softmax_loss and softmax_per_user_loss, which now call them.
+'''
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint as checkpoint_fn
+from similarity import ge2e_cossim, modal_cossim, pairwise_cossim
+
+_masks = {}
+
+
+def get_mask(kind, n, m, device):
+    '''
+    Cached masks, built once per (kind, N, M, device):
+    - 'same': (N, 1, N) True where the centroid is the utterance's own speaker
+    - 'diag': (N, N) identity
+    - 'user_blocks': (N * M, N * M) True inside the M x M block of every user
+    '''
+    key = (kind, n, m, device)
+    if key not in _masks:
+        eye = torch.eye(n, dtype=torch.bool, device=device)
+        if kind == 'same':
+            mask = eye.unsqueeze(1)
+        elif kind == 'diag':
+            mask = eye
+        elif kind == 'user_blocks':
+            mask = eye.repeat_interleave(m, dim=0).repeat_interleave(m, dim=1)
+        else:
+            raise ValueError('Unknown mask %s' % kind)
+        _masks[key] = mask
+    return _masks[key]
+
+
+def ge2e_sim(embeddings, centroid_embeddings=None):
+    '''
+    Cosine similarity matrix (N, M, N) + 1e-6 of (N, M, D) embeddings against the speaker centroids.
+    Without centroid_embeddings this is similarity.ge2e_cossim on the speaker means (leave-one-out centroid
+    for the own speaker), otherwise similarity.modal_cossim against the centroids of centroid_embeddings.
+    '''
+    if centroid_embeddings is not None:
+        return modal_cossim(embeddings, centroid_embeddings.mean(dim=1))
+    n, m, _ = embeddings.shape
+    return ge2e_cossim(embeddings, embeddings.mean(dim=1), same=get_mask('same', n, m, embeddings.device))
+
+
+def own_speaker(sim_matrix):
+    # (N, M, N) -> (N, M) similarities with the own speaker, sim_matrix[i, :, i]
+    return sim_matrix.diagonal(dim1=0, dim2=2).t()
+
+
+def softmax_loss_terms(sim_matrix):
+    # utils.calc_loss: loss, per_embedding_loss, -sum_i log sum_m exp(pos), sum of the log-sum-exp over centroids
+    pos = own_speaker(sim_matrix)
+    neg = (sim_matrix.exp().sum(dim=2) + 1e-6).log()
+    per_embedding_loss = neg - pos
+    include = (pos.exp().sum(dim=1) + 1e-6).log()
+    return per_embedding_loss.sum(), per_embedding_loss, -include.sum(), neg.sum()
+
+
+def contrast_loss(sim_matrix):
+    # utils.cal_contrast_loss: 1 - sigmoid(own speaker) + max sigmoid(other speakers)
+    n, m, _ = sim_matrix.shape
+    sig = torch.sigmoid(sim_matrix)
+    neg = sig.masked_fill(get_mask('same', n, m, sim_matrix.device), float('-inf')).amax(dim=2)
+    per_embedding_loss = 1 - own_speaker(sig) + neg
+    return per_embedding_loss.sum(), per_embedding_loss
+
+
+def intra_loss(sim_matrix):
+    # utils.cal_intra_loss: 1 - sigmoid(own speaker), for similarity matrices across modalities
+    per_user_loss = 1 - torch.sigmoid(own_speaker(sim_matrix))
+    return per_user_loss.sum(), per_user_loss
+
+
+def pairwise_softmax_loss(input_tensor):
+    # utils.softmax_loss on an (N, N) matrix, the diagonal is zeroed (not removed) in the negative term
+    n = input_tensor.shape[0]
+    pos = input_tensor.diagonal()
+    masked = input_tensor.masked_fill(get_mask('diag', n, 1, input_tensor.device), 0)
+    loss_per_user_utter = (masked.exp().sum(dim=1) + 1e-6).log() - pos
+    return loss_per_user_utter.mean(), loss_per_user_utter
+
+
+def per_user_softmax_loss(input_tensor, n_user):
+    '''
+    utils.softmax_per_user_loss on an (n_user * n_utter, n_user * n_utter) pairwise matrix: the own-user
+    blocks are zeroed in the negative term, which is a log-sum-exp over every (utterance, user) block.
+    '''
+    n = input_tensor.shape[0]
+    n_utter = n // n_user
+    pos = input_tensor.diagonal().view(n_user, n_utter).sum(dim=1)
+    neg = input_tensor.masked_fill(get_mask('user_blocks', n_user, n_utter, input_tensor.device), 0)
+    neg = (neg.view(n_user, n_utter, n_user, n_utter).exp().sum(dim=3) + 1e-6).log().sum(dim=(1, 2))
+    loss_per_user = (neg - pos) / n_utter
+    return loss_per_user.mean(), loss_per_user
+
+
+class FusedGE2ELoss(nn.Module):
+    '''
+    GE2E loss with learnable scale w and offset b over one fused similarity matrix.
+
+    forward(embeddings, centroid_embeddings=None, terms=('softmax',)) returns the sum of the requested terms:
+    - 'softmax': GE2E softmax loss (utils.calc_loss)
+    - 'include' / 'exclude': the 3rd / 4th outputs of utils.calc_loss
+    - 'contrast': GE2E contrast loss (utils.cal_contrast_loss)
+    - 'intra': intra-modal loss (utils.cal_intra_loss), with centroid_embeddings of the other modality
+    - 'per_user': per-user softmax (utils.softmax_per_user_loss) of the scaled pairwise matrix of embeddings
+      against centroid_embeddings (or themselves)
+    losses() takes the same arguments and returns the terms one by one.
+    '''
+    TERMS = ('softmax', 'include', 'exclude', 'contrast', 'intra', 'per_user')
+
+    def __init__(self, device, checkpoint=False):
+        super(FusedGE2ELoss, self).__init__()
+        self.w = nn.Parameter(torch.tensor(10.0).to(device), requires_grad=True)
+        self.b = nn.Parameter(torch.tensor(-5.0).to(device), requires_grad=True)
+        self.device = device
+        self.checkpoint = checkpoint
+
+    def _losses(self, embeddings, centroid_embeddings, terms):
+        out = []
+        if any(term != 'per_user' for term in terms):
+            sim_matrix = self.w * ge2e_sim(embeddings, centroid_embeddings) + self.b
+        if any(term in ('softmax', 'include', 'exclude') for term in terms):
+            loss, _, include, exclude = softmax_loss_terms(sim_matrix)
+        for term in terms:
+            if term == 'softmax':
+                out.append(loss)
+            elif term == 'include':
+                out.append(include)
+            elif term == 'exclude':
+                out.append(exclude)
+            elif term == 'contrast':
+                out.append(contrast_loss(sim_matrix)[0])
+            elif term == 'intra':
+                out.append(intra_loss(sim_matrix)[0])
+            elif term == 'per_user':
+                other = embeddings if centroid_embeddings is None else centroid_embeddings
+                pairwise = self.w * pairwise_cossim(embeddings, other) + self.b
+                out.append(per_user_softmax_loss(pairwise, embeddings.shape[0])[0])
+            else:
+                raise ValueError('Unknown loss term %s, expected one of %s' % (term, ', '.join(self.TERMS)))
+        return tuple(out)
+
+    def losses(self, embeddings, centroid_embeddings=None, terms=('softmax',)):
+        terms = tuple(terms)
+        embeddings = embeddings.to(self.device)
+        if centroid_embeddings is not None:
+            centroid_embeddings = centroid_embeddings.to(self.device)
+        if self.checkpoint and torch.is_grad_enabled():
+            return checkpoint_fn(self._losses, embeddings, centroid_embeddings, terms, use_reentrant=False)
+        return self._losses(embeddings, centroid_embeddings, terms)
+
+    def forward(self, embeddings, centroid_embeddings=None, terms=('softmax',)):
+        return sum(self.losses(embeddings, centroid_embeddings, terms))
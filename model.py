@@ -74,6 +74,13 @@ class TDNN(torch.nn.Module):
         return out
 
 class Bottle2neck(nn.Module):
+    '''
+    Res2Net block of ECAPA-TDNN. The branch outputs are written into one preallocated buffer instead of a concatenation
+    grown branch by branch. In inference (eval mode, and no gradient of the parameters needed) every BatchNorm, which
+    follows a ReLU here, is applied as a cached scale / shift: those feeding conv3 are folded into its weights and the
+    conv1 output buffer is reused for the branch outputs. The cache is rebuilt when a parameter or running statistic
+    changes, the parameters and checkpoint keys are those of the plain block.
+    '''
 
     def __init__(self, inplanes, planes, kernel_size=None, dilation=None, scale = 8):
         super(Bottle2neck, self).__init__()
@@ -94,14 +101,22 @@ class Bottle2neck(nn.Module):
         self.relu   = nn.ReLU()
         self.width  = width
         self.se     = SEModule(planes)
+        self._fused, self._fused_key = None, None
 
     def forward(self, x):
+        if self.training or not isinstance(self.conv3, nn.Conv1d) or not isinstance(self.bn1, nn.BatchNorm1d) or \
+                (torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())):
+            return self.forward_reference(x)
+        return self.forward_fused(x)
+
+    def forward_reference(self, x):
         residual = x
         out = self.conv1(x)
         out = self.relu(out)
         out = self.bn1(out)
 
         spx = torch.split(out, self.width, 1)
+        buffer = out.new_empty(out.shape)
         for i in range(self.nums):
           if i==0:
             sp = spx[i]
@@ -110,13 +125,10 @@ class Bottle2neck(nn.Module):
           sp = self.convs[i](sp)
           sp = self.relu(sp)
           sp = self.bns[i](sp)
-          if i==0:
-            out = sp
-          else:
-            out = torch.cat((out, sp), 1)
-        out = torch.cat((out, spx[self.nums]),1)
+          buffer[:, i*self.width:(i+1)*self.width] = sp
+        buffer[:, self.nums*self.width:] = spx[self.nums]
 
-        out = self.conv3(out)
+        out = self.conv3(buffer)
         out = self.relu(out)
         out = self.bn3(out)
         
@@ -124,6 +136,48 @@ class Bottle2neck(nn.Module):
         out += residual
         return out 
 
+    def fuse(self):
+        # eval-mode BatchNorm as (C, 1) scale / shift, with the scales / shifts of conv3's inputs folded into conv3
+        def affine(bn):
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            return scale.unsqueeze(1), (bn.bias - bn.running_mean * scale).unsqueeze(1)
+        w = self.width
+        scale1, shift1 = affine(self.bn1)
+        branches = [affine(bn) for bn in self.bns]
+        scale = torch.cat([s for s, _ in branches] + [scale1[self.nums*w:]], dim=0)
+        shift = torch.cat([b for _, b in branches] + [shift1[self.nums*w:]], dim=0)
+        weight = self.conv3.weight * scale.view(1, -1, 1)
+        bias = self.conv3.bias + self.conv3.weight[:, :, 0] @ shift[:, 0]
+        # input of branch i > 0: bns[i-1](r_{i-1}) + bn1(r1)_i = scale_{i-1} r_{i-1} + scale1_i r1_i + (shift_{i-1} + shift1_i)
+        inputs = [(scale1[i*w:(i+1)*w], shift1[i*w:(i+1)*w] + (branches[i-1][1] if i > 0 else 0)) for i in range(self.nums)]
+        return inputs, [s for s, _ in branches], weight, bias, affine(self.bn3)
+
+    def get_fused(self):
+        tensors = [self.bn1, self.conv3, self.bn3] + list(self.bns)
+        key = tuple((t._version, t.data_ptr(), t.device, t.dtype) for m in tensors for t in list(m.parameters()) + list(m.buffers()))
+        if self._fused_key != key:
+            with torch.inference_mode(False), torch.no_grad():
+                self._fused = self.fuse()
+            self._fused_key = key
+        return self._fused
+
+    def forward_fused(self, x):
+        inputs, scales, weight, bias, (scale3, shift3) = self.get_fused()
+        # relu(conv1(x)) is the buffer of conv3's input: branch i overwrites chunk i once branch i has read it
+        out = torch.relu_(self.conv1(x))
+        spx = torch.split(out, self.width, 1)
+        for i in range(self.nums):
+            sp = torch.addcmul(inputs[i][1], inputs[i][0], spx[i])
+            if i > 0:
+                sp.addcmul_(scales[i-1], spx[i-1])
+            spx[i].copy_(torch.relu_(self.convs[i](sp)))
+
+        out = torch.relu_(F.conv1d(out, weight, bias))
+        out = torch.addcmul(shift3, scale3, out)
+        out = self.se(out)
+        out += x
+        return out
+
 class PreEmphasis(torch.nn.Module):
 
     def __init__(self, coef: float = 0.97):
@@ -174,17 +228,109 @@ class FbankAug(nn.Module):
         x = self.mask_along_axis(x, dim=1)
         return x
 
+# log-mel front-ends of ECAPA_TDNN, on 16 kHz clips. 'piezo' decimates to 4 kHz before the STFT: the bone-conducted
+# piezo channel has almost no energy above 2 kHz, so a 128-point FFT and 40 mels cover it, at the same 100 frames/s.
+# 'band' is the piezo bank of ECAPA_TDNN_w_Modality.py, band-limited but with the shape of 'full'
+FRONT_ENDS = {
+    'full':  dict(decimation=1, f_min=20, f_max=7600, n_mels=80),
+    'piezo': dict(decimation=4, f_min=20, f_max=2000, n_mels=40),
+    'band':  dict(decimation=1, f_min=20, f_max=2000, n_mels=80),
+}
+
+def make_torchfbank(decimation=1, f_min=20, f_max=7600, n_mels=80):
+    # window / hop of 25 ms / 10 ms at 16000 / decimation Hz; with decimation the clips are first resampled (low-passed)
+    melspec = torchaudio.transforms.MelSpectrogram(sample_rate=16000 // decimation, n_fft=512 // decimation, win_length=400 // decimation, \
+                                                   hop_length=160 // decimation, f_min = f_min, f_max = f_max, window_fn=torch.hamming_window, n_mels=n_mels)
+    if decimation == 1:
+        return torch.nn.Sequential(PreEmphasis(), melspec)
+    return torch.nn.Sequential(torchaudio.transforms.Resample(16000, 16000 // decimation), PreEmphasis(), melspec)
+
+def compute_log_fbank(torchfbank, x):
+    # (batch, samples) -> mean-normalized log-mel features (batch, n_mels, frames), without specaug
+    with torch.no_grad():
+        x = torchfbank(x)+1e-6
+        x = x.log()   
+        x = x - torch.mean(x, dim=-1, keepdim=True)
+    return x
+
+class AttentiveStatsPool(nn.Sequential):
+    '''
+    Attentive statistics pooling of ECAPA-TDNN, (B, C, T) -> (B, 2 * C) attention-weighted mean and std.
+    Same layers, and so the same checkpoint keys, as the former nn.Sequential attention on the (B, 3 * C, T)
+    concatenation of x and its time mean / std. The first 1x1 conv is applied to x and to the (B, 2 * C, 1) mean / std
+    separately, so that concatenation is never built, and the weighted mean and mean square come from one product.
+    With chunk_size (eval mode only, BatchNorm then uses its running statistics) the softmax over time is computed
+    online over chunks of chunk_size frames and no (B, C, T) attention tensor is kept.
+    '''
+    def __init__(self, channels=1536, bottleneck=256, chunk_size=None):
+        super(AttentiveStatsPool, self).__init__(
+            nn.Conv1d(3 * channels, bottleneck, kernel_size=1),
+            nn.ReLU(),
+            nn.BatchNorm1d(bottleneck),
+            nn.Tanh(), # I add this layer
+            nn.Conv1d(bottleneck, channels, kernel_size=1),
+            nn.Softmax(dim=2),
+            )
+        self.channels = channels
+        self.chunk_size = chunk_size
+
+    def logits(self, x, context):
+        # attention logits of the frames x, context: first conv of the mean / std with its bias, (B, bottleneck, 1)
+        x = F.conv1d(x, self[0].weight[:, :self.channels]) + context
+        return self[4](self[3](self[2](self[1](x))))
+
+    def forward(self, x, weights=None, return_weights=False):
+        # weights: optional (B, C, T) factors of the attention after the softmax
+        # return_weights: also return the (B, C, T) attention w (times weights), never chunked then
+        var, mean = torch.var_mean(x, dim=2, keepdim=True)
+        stats = torch.cat((mean, torch.sqrt(var.clamp(min=1e-4))), dim=1)
+        context = F.conv1d(stats, self[0].weight[:, self.channels:], self[0].bias)
+        if self.chunk_size is None or self.training or x.shape[2] <= self.chunk_size or return_weights:
+            w = self[5](self.logits(x, context))
+            if weights is not None:
+                w = w * weights
+            wx = w * x
+            mu = torch.sum(wx, dim=2)
+            sg = torch.sqrt( ( torch.sum(wx * x, dim=2) - mu**2 ).clamp(min=1e-4) )
+            if return_weights:
+                return torch.cat((mu,sg),1), w
+            return torch.cat((mu,sg),1)
+        return self.chunked(x, context, weights)
+
+    def chunked(self, x, context, weights=None):
+        # online softmax over time: running max, normalizer and weighted sums of x and x^2 per channel
+        m = norm = sx = sxx = None
+        for start in range(0, x.shape[2], self.chunk_size):
+            xc = x[:, :, start:start + self.chunk_size]
+            z = self.logits(xc, context)
+            zmax = z.amax(dim=2, keepdim=True)
+            if m is None:
+                m, norm, sx, sxx = zmax, 0, 0, 0
+            else:
+                new_m = torch.maximum(m, zmax)
+                scale = torch.exp(m - new_m)
+                m, norm, sx, sxx = new_m, norm * scale, sx * scale, sxx * scale
+            e = torch.exp(z - m)
+            norm = norm + e.sum(dim=2, keepdim=True)
+            if weights is not None:
+                e = e * weights[:, :, start:start + self.chunk_size]
+            ex = e * xc
+            sx = sx + ex.sum(dim=2, keepdim=True)
+            sxx = sxx + (ex * xc).sum(dim=2, keepdim=True)
+        mu = (sx / norm)[:, :, 0]
+        sg = torch.sqrt( ( (sxx / norm)[:, :, 0] - mu**2 ).clamp(min=1e-4) )
+        return torch.cat((mu,sg),1)
+
 class ECAPA_TDNN(nn.Module):
 
-    def __init__(self, C):
+    def __init__(self, C, front_end='full'):
 
         super(ECAPA_TDNN, self).__init__()
 
-        self.torchfbank = torch.nn.Sequential(
-            PreEmphasis(),            
-            torchaudio.transforms.MelSpectrogram(sample_rate=16000, n_fft=512, win_length=400, hop_length=160, \
-                                                 f_min = 20, f_max = 7600, window_fn=torch.hamming_window, n_mels=80),
-            )
+        self.front_end = front_end # key of FRONT_ENDS
+        self.n_mels = FRONT_ENDS[front_end]['n_mels']
+        self.torchfbank = make_torchfbank(**FRONT_ENDS[front_end])
+        self.fbank_cache = None # FbankCache shared with other encoders, see fbank_cache.py
 
         self.specaug = FbankAug() # Spec augmentation
 
@@ -192,28 +338,21 @@ class ECAPA_TDNN(nn.Module):
         self.relu   = nn.ReLU()
         # self.bn1    = nn.BatchNorm1d(C)
 
-        self.tdnn1 = TDNN(80, C, kernel_size=5, dilation=1, scale=8)
+        self.tdnn1 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=8)
         self.layer1 = Bottle2neck(C, C, kernel_size=3, dilation=2, scale=8)
         # self.layer1_ = Bottle2neck(C, C, kernel_size=3, dilation=2, scale=8)
 
-        self.tdnn2 = TDNN(80, C, kernel_size=5, dilation=1, scale=4)
+        self.tdnn2 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=4)
         self.layer2 = Bottle2neck(C, C, kernel_size=3, dilation=3, scale=4)
         # self.layer2_ = Bottle2neck(C, C, kernel_size=3, dilation=3, scale=4)
 
-        self.tdnn3 = TDNN(80, C, kernel_size=5, dilation=1, scale=2)
+        self.tdnn3 = TDNN(self.n_mels, C, kernel_size=5, dilation=1, scale=2)
         self.layer3 = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=2)
         # self.layer3_ = Bottle2neck(C, C, kernel_size=3, dilation=4, scale=2)
 
         # I fixed the shape of the output from MFA layer, that is close to the setting from ECAPA paper.
         self.layer4 = nn.Conv1d(3*C, 1536, kernel_size=1)
-        self.attention = nn.Sequential(
-            nn.Conv1d(4608, 256, kernel_size=1),
-            nn.ReLU(),
-            nn.BatchNorm1d(256),
-            nn.Tanh(), # I add this layer
-            nn.Conv1d(256, 1536, kernel_size=1),
-            nn.Softmax(dim=2),
-            )
+        self.attention = AttentiveStatsPool(1536, 256)
         self.bn5 = nn.BatchNorm1d(3072)
         self.fc6 = nn.Linear(3072, 192)
         self.bn6 = nn.BatchNorm1d(192)
@@ -227,14 +366,30 @@ class ECAPA_TDNN(nn.Module):
         return x
 
 
-    def forward(self, x, aug=True):
+    def log_fbank(self, x):
+        return compute_log_fbank(self.torchfbank, x)
+
+    def fbank(self, x, aug=True):
+        # (batch, samples) -> mean-normalized log-mel features (batch, n_mels, frames)
         with torch.no_grad():
-            x = self.torchfbank(x)+1e-6
-            x = x.log()   
-            x = x - torch.mean(x, dim=-1, keepdim=True)
+            if x.dim() == 3:
+                # log-mel features already, e.g. persisted by fbank_cache.py
+                if x.shape[1] != self.n_mels:
+                    raise ValueError('%d-band features given to an encoder with the %s front-end (%d mels)' % (x.shape[1], self.front_end, self.n_mels))
+                x = x.float()
+            elif self.fbank_cache is not None:
+                x = self.fbank_cache.get(x, self.log_fbank, self.front_end)
+            else:
+                x = self.log_fbank(x)
             if aug == True:
-                x = self.specaug(x)
+                # specaug masks in place, keep cached and persisted features intact
+                x = self.specaug(x.clone())
+        return x
+
+    def forward(self, x, aug=True):
+        return self.forward_features(self.fbank(x, aug))
 
+    def forward_features(self, x):
         # x = self.conv1(x)
         # x = self.relu(x)
         # x = self.bn1(x)
@@ -257,16 +412,7 @@ class ECAPA_TDNN(nn.Module):
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
-        t = x.size()[-1]
-
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
-
-        mu = torch.sum(x * w, dim=2)
-        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
-
-        x = torch.cat((mu,sg),1)
+        x = self.attention(x)
         x = self.bn5(x)
         x = self.fc6(x)
         x = self.bn6(x)
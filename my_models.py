@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from torch.autograd import Variable
-from utils import get_centroids, get_cossim, calc_loss, get_modal_cossim, cal_contrast_loss, cal_intra_loss
+from ge2e_loss import FusedGE2ELoss, ge2e_sim, softmax_loss_terms, contrast_loss, intra_loss
 import torchvision
 
 class CNNModel(nn.Module):
@@ -275,37 +275,26 @@ class GE2ELoss(nn.Module):
         torch.clamp(self.alphas[1], 1e-6)
         torch.clamp(self.alphas[2], 1e-6)
 
-        centroids_piezo = get_centroids(embeddings_piezo)
-        centroids_audio = get_centroids(embeddings_audio)
-
-        cossim_piezo_to_piezo = get_cossim(embeddings_piezo, centroids_piezo)
-        cossim_audio_to_audio = get_cossim(embeddings_audio, centroids_audio)
-        # cossim_piezo_to_auido = get_cossim(embeddings_piezo, centroids_audio)
-        # cossim_audio_to_piezo = get_cossim(embeddings_audio, centroids_piezo)
-        cossim_piezo_to_auido = get_modal_cossim(embeddings_piezo, centroids_audio)
-        cossim_audio_to_piezo = get_modal_cossim(embeddings_audio, centroids_piezo)
-
-        sim_matrix = self.ws[0] * cossim_piezo_to_piezo.to(self.device) + self.bs[0]
-        loss_pp, _, loss_pp_include, loss_pp_exclude = calc_loss(sim_matrix)
+        # one fused similarity matrix per pair of modalities, every loss term is read from it
+        sim_matrix = self.ws[0] * ge2e_sim(embeddings_piezo) + self.bs[0]
+        loss_pp, _, loss_pp_include, loss_pp_exclude = softmax_loss_terms(sim_matrix)
         # contrast loss
-        loss_pp_contrast, _ = cal_contrast_loss(sim_matrix, self.device)
+        loss_pp_contrast, _ = contrast_loss(sim_matrix)
 
-        sim_matrix = self.ws[1] * cossim_audio_to_audio.to(self.device) + self.bs[1]
-        loss_aa, _, loss_aa_include, loss_aa_exclude = calc_loss(sim_matrix)
+        sim_matrix = self.ws[1] * ge2e_sim(embeddings_audio) + self.bs[1]
+        loss_aa, _, loss_aa_include, loss_aa_exclude = softmax_loss_terms(sim_matrix)
         # contrast loss
-        loss_aa_contrast, _ = cal_contrast_loss(sim_matrix, self.device)
+        loss_aa_contrast, _ = contrast_loss(sim_matrix)
 
-        sim_matrix = self.ws[2] * cossim_piezo_to_auido.to(self.device) + self.bs[2]
-        # _, _, loss_pa = calc_loss(sim_matrix)
-        _, _, loss_pa_include, _ = calc_loss(sim_matrix)
+        sim_matrix = self.ws[2] * ge2e_sim(embeddings_piezo, embeddings_audio) + self.bs[2]
+        _, _, loss_pa_include, _ = softmax_loss_terms(sim_matrix)
         # intra loss
-        loss_pa_intra, _ = cal_intra_loss(sim_matrix, self.device)
-        
-        sim_matrix = self.ws[3] * cossim_audio_to_piezo.to(self.device) + self.bs[3]
-        # _, _, loss_ap = calc_loss(sim_matrix)
-        _, _, loss_ap_include, _ = calc_loss(sim_matrix)
+        loss_pa_intra, _ = intra_loss(sim_matrix)
+
+        sim_matrix = self.ws[3] * ge2e_sim(embeddings_audio, embeddings_piezo) + self.bs[3]
+        _, _, loss_ap_include, _ = softmax_loss_terms(sim_matrix)
         # intra loss
-        loss_ap_intra, _ = cal_intra_loss(sim_matrix, self.device)
+        loss_ap_intra, _ = intra_loss(sim_matrix)
 
         # loss =  torch.sqrt(torch.abs(loss_aa * loss_pp)) + 2 * (loss_pa_include + loss_ap_include)
         # loss = 2.0 * (loss_pp_exclude + loss_aa_exclude) + 1.0 * (loss_ap_include + loss_pa_include + loss_aa_include + loss_pp_include)
@@ -600,21 +589,11 @@ class Extractor_pure_FC(nn.Module):
 
         return x
     
-class GE2ELoss_ori(nn.Module):
-
-    def __init__(self, device):
-        super(GE2ELoss_ori, self).__init__()
-        self.w = nn.Parameter(torch.tensor(10.0).to(device), requires_grad=True)
-        self.b = nn.Parameter(torch.tensor(-5.0).to(device), requires_grad=True)
-        self.device = device
+class GE2ELoss_ori(FusedGE2ELoss):
+    # GE2E softmax loss, forward(embeddings); see ge2e_loss.FusedGE2ELoss for the other loss terms
 
-    def forward(self, embeddings):
-        torch.clamp(self.w, 1e-6)
-        centroids = get_centroids(embeddings)
-        cossim = get_cossim(embeddings, centroids)
-        sim_matrix = self.w * cossim.to(self.device) + self.b
-        loss, _, _, _ = calc_loss(sim_matrix)
-        return loss
+    def __init__(self, device, checkpoint=False):
+        super(GE2ELoss_ori, self).__init__(device, checkpoint)
     
 
 class class_model_FC(nn.Module):
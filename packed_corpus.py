@@ -0,0 +1,190 @@
+'''
+Pack a wav clip tree into one contiguous memory-mapped array per modality.
+
+The layout <dataset_dir>/piezo/<uid>/<n>.wav + <dataset_dir>/audio/<uid>/<n>.wav becomes
+  <out_prefix>.piezo.npy   all piezo samples, clip after clip (int16, float16 or float32)
+  <out_prefix>.audio.npy   all audio samples, in the same order
+  <out_prefix>.index.npz   offsets (n_clips + 1,), labels (user id), clip_ids (<n>) and the wav subtype of every clip
+so that datasets read a clip with a single slice instead of opening and decoding a file.
+
+extract_feature.py writes the clips as 64-bit float wavs (scipy wav_writer on float64 arrays). They are read as
+float and, for int16, quantized with round(x * 32767); PCM_16 clips are stored as they are. The subtype of every
+clip is kept so that reads can be scaled like soundfile.read or like scipy.io.wavfile.read of the source file.
+'''
+
+import os, argparse, tempfile
+import numpy as np
+import soundfile
+from numpy.lib.format import open_memmap
+
+DEFAULT_MODALITIES = {'piezo': 'piezo/', 'audio': 'audio/'}
+FLOAT_SUBTYPES = ('FLOAT', 'DOUBLE')
+
+
+def list_user_clips(user_dir):
+    # clips are named <n>.wav, keep them in numeric order
+    clip_ids = [int(f[:-4]) for f in os.listdir(user_dir) if f.endswith('.wav') and f[:-4].isdigit()]
+    return sorted(clip_ids)
+
+
+def pack_wav_tree(dataset_dir, out_prefix, users=None, modalities=None, dtype='int16'):
+    """
+    Pack the clips of the given users into <out_prefix>.<modality>.npy and <out_prefix>.index.npz.
+
+    :param dataset_dir: root of the clip tree, e.g. .../piezobuds_new_1/train/
+    :param users: list of user ids, all sub-directories of the first modality by default
+    :param modalities: dict of modality name -> sub-directory, {'audio': ''} for a VoxCeleb1 tree
+    :param dtype: 'int16' keeps PCM_16 samples as they are and quantizes float clips with round(x * 32767),
+                  'float16' / 'float32' store the samples normalized to [-1, 1] as soundfile.read returns them
+    """
+    if modalities is None:
+        modalities = DEFAULT_MODALITIES
+    names = list(modalities.keys())
+    first_dir = os.path.join(dataset_dir, modalities[names[0]])
+    if users is None:
+        users = sorted(int(d) for d in os.listdir(first_dir) if d.isdigit())
+
+    # First pass: only the headers, to know the size of every clip
+    labels, clip_ids, lengths, subtypes = [], [], [], []
+    for uid in users:
+        for cid in list_user_clips(os.path.join(first_dir, str(uid))):
+            infos = [soundfile.info(os.path.join(dataset_dir, modalities[name], str(uid), '%d.wav' % cid)) for name in names]
+            frames = [info.frames for info in infos]
+            if len(set(frames)) != 1:
+                raise ValueError('Clip %d of user %d has different lengths across modalities: %s' % (cid, uid, frames))
+            labels.append(uid)
+            clip_ids.append(cid)
+            lengths.append(frames[0])
+            subtypes.append([info.subtype for info in infos])
+    subtypes = np.array(subtypes, dtype=str).reshape(len(labels), len(names)).T
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    # Second pass: decode every clip once into the packed arrays
+    for m, name in enumerate(names):
+        packed = open_memmap('%s.%s.npy.tmp' % (out_prefix, name), mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+        for i, (uid, cid) in enumerate(zip(labels, clip_ids)):
+            path = os.path.join(dataset_dir, modalities[name], str(uid), '%d.wav' % cid)
+            if dtype == 'int16' and subtypes[m, i] == 'PCM_16':
+                clip, _ = soundfile.read(path, dtype='int16')
+            else:
+                # libsndfile does not scale float samples to int16 (they would come back as -1, 0 or 1), read as float
+                clip, _ = soundfile.read(path, dtype='float64')
+                if dtype == 'int16':
+                    clip = np.clip(np.round(clip * 32767), -32768, 32767)
+            if clip.ndim > 1:
+                clip = clip[:, 0]
+            packed[offsets[i]:offsets[i + 1]] = clip
+        packed.flush()
+        del packed
+        os.replace('%s.%s.npy.tmp' % (out_prefix, name), '%s.%s.npy' % (out_prefix, name))
+
+    np.savez(out_prefix + '.index.npz', offsets=offsets, labels=np.array(labels, dtype=np.int64),
+             clip_ids=np.array(clip_ids, dtype=np.int64), modalities=np.array(names), dtype=np.array(dtype), subtypes=subtypes)
+    return len(labels)
+
+
+class PackedClipCorpus(object):
+    """
+    Read-only view of a corpus written by pack_wav_tree. Clips are slices of memory-mapped arrays.
+    """
+    def __init__(self, prefix):
+        index = np.load(prefix + '.index.npz')
+        self.offsets = index['offsets']
+        self.labels = index['labels']
+        self.clip_ids = index['clip_ids']
+        self.dtype = str(index['dtype'])
+        self.arrays = {str(name): np.load('%s.%s.npy' % (prefix, name), mmap_mode='r') for name in index['modalities']}
+        # wav subtype of every clip, corpora packed before it was recorded hold PCM_16 clips
+        subtypes = index['subtypes'] if 'subtypes' in index else np.full((len(self.arrays), len(self.labels)), 'PCM_16')
+        self.subtypes = {str(name): subtypes[m] for m, name in enumerate(index['modalities'])}
+        self.float_source = {name: np.isin(subtypes, FLOAT_SUBTYPES) for name, subtypes in self.subtypes.items()}
+
+        order = np.argsort(self.labels, kind='stable')
+        users, starts = np.unique(self.labels[order], return_index=True)
+        self.user_clips = {int(uid): idx for uid, idx in zip(users, np.split(order, starts[1:]))}
+        self.lookup = {(int(uid), int(cid)): i for i, (uid, cid) in enumerate(zip(self.labels, self.clip_ids))}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def index_of(self, path):
+        # .../<uid>/<n>.wav -> position of the clip in the corpus
+        uid = int(os.path.basename(os.path.dirname(path)))
+        cid = int(os.path.basename(path)[:-4])
+        return self.lookup[(uid, cid)]
+
+    def read(self, name, i, normalize=True):
+        """
+        Return clip i of modality name as float64.
+        normalize=True matches soundfile.read of the source wav (up to the int16 quantization of float clips),
+        normalize=False matches scipy.io.wavfile.read: int16 values for a PCM_16 wav, [-1, 1] for a float wav.
+        """
+        clip = np.array(self.arrays[name][self.offsets[i]:self.offsets[i + 1]], dtype=np.float64)
+        float_source = self.float_source[name][i]
+        if self.dtype == 'int16':
+            clip = clip / (32767.0 if float_source else 32768.0)
+        if normalize or float_source:
+            return clip
+        if self.subtypes[name][i] != 'PCM_16':
+            raise ValueError('No scipy.io.wavfile scaling for %s clips' % self.subtypes[name][i])
+        return clip * 32768.0
+
+    def read_many(self, name, indices, normalize=True):
+        # Clips of equal length are stacked into a (len(indices), samples) array
+        return np.array([self.read(name, i, normalize) for i in indices])
+
+
+def check_corpus(corpus, dataset_dir, modalities, n_clips=20, seed=0):
+    # largest difference between corpus.read and soundfile.read of the source wav over n_clips random clips
+    rng = np.random.RandomState(seed)
+    diff = 0.0
+    for i in rng.choice(len(corpus), min(n_clips, len(corpus)), replace=False):
+        for name, sub_dir in modalities.items():
+            path = os.path.join(dataset_dir, sub_dir, str(corpus.labels[i]), '%d.wav' % corpus.clip_ids[i])
+            clip, _ = soundfile.read(path)
+            if clip.ndim > 1:
+                clip = clip[:, 0]
+            diff = max(diff, float(np.abs(corpus.read(name, i) - clip).max()))
+    return diff
+
+
+def self_check():
+    # round trip of a scipy-written float64 wav (as extract_feature.py writes them) and an int16 wav through every dtype
+    from scipy.io import wavfile
+    root = tempfile.mkdtemp(prefix='packed_corpus_check_')
+    sine = 0.8 * np.sin(2 * np.pi * 440 * np.arange(8000) / 16000)
+    for name, clip in [('piezo', sine), ('audio', np.round(sine * 32767).astype(np.int16))]:
+        os.makedirs(os.path.join(root, name, '0'))
+        wavfile.write(os.path.join(root, name, '0', '0.wav'), 16000, clip)
+    for dtype, tolerance in [('int16', 1.0 / 32767), ('float16', 1e-3), ('float32', 1e-7)]:
+        pack_wav_tree(root, os.path.join(root, dtype), dtype=dtype)
+        corpus = PackedClipCorpus(os.path.join(root, dtype))
+        diff = check_corpus(corpus, root, DEFAULT_MODALITIES)
+        scipy_diff = max(float(np.abs(corpus.read(name, 0, normalize=False) - wavfile.read(os.path.join(root, name, '0', '0.wav'))[1]).max())
+                         for name in DEFAULT_MODALITIES)
+        if diff > tolerance or scipy_diff > tolerance * 32768:
+            raise AssertionError('%s round trip: max diff %g to soundfile.read, %g to scipy.io.wavfile.read' % (dtype, diff, scipy_diff))
+        print('%-8s round trip ok: max diff %.2e to soundfile.read, %.2e to scipy.io.wavfile.read' % (dtype, diff, scipy_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a wav clip tree into memory-mapped arrays')
+    parser.add_argument('--dataset_dir', type=str, default='/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/train/')
+    parser.add_argument('--out_prefix',  type=str, default='/mnt/ssd/gen/processed_data/packed/piezobuds_new_1_train')
+    parser.add_argument('--n_user',      type=int, default=0, help='Pack users 0..n_user-1, 0 for every user in the tree')
+    parser.add_argument('--dtype',       type=str, default='int16', choices=['int16', 'float16', 'float32'])
+    parser.add_argument('--voxceleb',    dest='voxceleb', action='store_true', help='The tree is <uid>/<n>.wav without piezo')
+    parser.add_argument('--n_check',     type=int, default=20, help='Clips compared with soundfile.read after packing')
+    parser.add_argument('--self_check',  dest='self_check', action='store_true', help='Only run the round trip check on generated wavs')
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        raise SystemExit
+
+    os.makedirs(os.path.dirname(args.out_prefix) or '.', exist_ok=True)
+    users = list(range(args.n_user)) if args.n_user > 0 else None
+    modalities = {'audio': ''} if args.voxceleb else DEFAULT_MODALITIES
+    n_clips = pack_wav_tree(args.dataset_dir, args.out_prefix, users=users, modalities=modalities, dtype=args.dtype)
+    diff = check_corpus(PackedClipCorpus(args.out_prefix), args.dataset_dir, modalities, args.n_check)
+    print('Packed %d clips into %s, max diff to soundfile.read %.2e' % (n_clips, args.out_prefix, diff))
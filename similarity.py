@@ -0,0 +1,65 @@
+'''
+Cosine-similarity kernels for GE2E-style losses and evaluation.
+
+Embeddings and centroids are L2-normalized once and compared with a single matmul, instead of repeating
+them into (N * M * K, D) tensors for F.cosine_similarity. Memory is O((N * M + K) * D + N * M * K) instead of
+O(N * M * K * D). Scores against very large enrollment sets can be computed in chunks of centroids.
+'''
+
+import torch
+import torch.nn.functional as F
+
+
+def normalize(x, eps=1e-8):
+    return F.normalize(x, p=2, dim=-1, eps=eps)
+
+
+def cossim_matrix(embeddings, centroids, chunk_size=None):
+    '''
+    Cosine similarity of every embedding with every centroid.
+
+    Args:
+    - embeddings: (..., D)
+    - centroids: (K, D)
+    - chunk_size: if given, compare against chunk_size centroids at a time
+
+    Returns: (..., K), without the +1e-6 offset
+    '''
+    embeddings = normalize(embeddings)
+    if chunk_size is None or centroids.shape[0] <= chunk_size:
+        return torch.matmul(embeddings, normalize(centroids).t())
+    return torch.cat([torch.matmul(embeddings, normalize(chunk).t()) for chunk in centroids.split(chunk_size)], dim=-1)
+
+
+def modal_cossim(embeddings, centroids, chunk_size=None):
+    '''
+    (N, M, D) embeddings against (K, D) centroids -> (N, M, K) similarity matrix + 1e-6,
+    as utils.get_modal_cossim (which needs K == N).
+    '''
+    return cossim_matrix(embeddings, centroids, chunk_size) + 1e-6
+
+
+def ge2e_cossim(embeddings, centroids, chunk_size=None, same=None):
+    '''
+    GE2E similarity matrix of utils.get_cossim: (N, M, D) embeddings against (N, D) centroids -> (N, M, N) + 1e-6,
+    where an utterance is compared with the centroid of its own speaker computed without that utterance.
+    same is the (N, 1, N) own-speaker mask, built here unless given (ge2e_loss passes its cached one).
+    '''
+    n, m, _ = embeddings.shape
+    cos_diff = cossim_matrix(embeddings, centroids, chunk_size)
+    # leave-one-out centroid of the utterance's own speaker
+    utterance_centroids = (embeddings.sum(dim=1, keepdim=True) - embeddings) / (m - 1)
+    cos_same = (normalize(embeddings) * normalize(utterance_centroids)).sum(dim=-1)
+    if same is None:
+        same = torch.eye(n, dtype=torch.bool, device=embeddings.device).unsqueeze(1)
+    cos_diff = torch.where(same, cos_same.unsqueeze(2), cos_diff)
+    return cos_diff + 1e-6
+
+
+def pairwise_cossim(tensor_a, tensor_b):
+    '''
+    (b, u, D) x (b, u, D) -> (b * u, b * u) cosine similarity of every utterance of tensor_a with every
+    utterance of tensor_b, without the +1e-6 offset.
+    '''
+    b, u, _ = tensor_a.shape
+    return torch.matmul(normalize(tensor_a.reshape(b * u, -1)), normalize(tensor_b.reshape(b * u, -1)).t())
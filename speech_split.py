@@ -1,35 +1,77 @@
 import webrtcvad
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 
-def apply_vad(audio, sr, vad_level=3, frame_duration=30):
+def frame_view(signal, frame_samples, hop_samples=None):
+    # (num_frames, frame_samples) strided view of the complete frames of a 1-D signal, no copy
+    hop_samples = hop_samples or frame_samples
+    num_frames = max(0, (len(signal) - frame_samples) // hop_samples + 1)
+    stride = signal.strides[0]
+    return as_strided(signal, shape=(num_frames, frame_samples), strides=(hop_samples * stride, stride), writeable=False)
+
+
+def apply_vad(audio, sr, vad_level=3, frame_duration=30, min_rms=None):
+    """
+    webrtcvad speech label of every complete frame_duration frame of audio (float in [-1, 1]), as a bool array.
+
+    The signal is converted to 16-bit PCM once and the frames are views of it. With min_rms, frames whose RMS
+    (in 16-bit units) is at most min_rms are labelled non-speech without calling webrtcvad. This is a pre-gate
+    for long recordings with silent stretches: webrtcvad keeps a hangover state across frames, so the labels
+    right after speech can differ from those of the ungated VAD.
+    """
     vad = webrtcvad.Vad()
     vad.set_mode(vad_level)
 
     frame_samples = int(sr * frame_duration / 1000)
     num_frames = len(audio) // frame_samples
-    audio_frames = [audio[i:i + frame_samples] for i in range(0, len(audio), frame_samples)]
-    audio_frames = audio_frames[:num_frames]
-
-    # Convert the frames to 16-bit PCM format
-    audio_frames = [np.round(frame * 32767).astype(np.int16) for frame in audio_frames]
+    pcm = np.round(np.asarray(audio[:num_frames * frame_samples]) * 32767).astype(np.int16)
+    frames = frame_view(pcm, frame_samples)
 
-    speech_labels = [vad.is_speech(audio_frames[i].tobytes(), sample_rate=sr) for i in range(num_frames)]
+    speech_labels = np.zeros(num_frames, dtype=bool)
+    if min_rms is None:
+        candidates = range(num_frames)
+    else:
+        energy = np.einsum('ij,ij->i', frames, frames, dtype=np.float64) / frame_samples
+        candidates = np.flatnonzero(energy > min_rms ** 2)
+    for i in candidates:
+        speech_labels[i] = vad.is_speech(frames[i].tobytes(), sample_rate=sr)
     return speech_labels
 
 
 def split_audio_to_utterances(audio, sr, speech_labels, frame_duration=30, min_speech_duration=500):
     frame_samples = int(sr * frame_duration / 1000)
 
-    speech_starts = np.where(np.diff(np.array([0] + speech_labels + [0])) == 1)[0]
-    speech_ends = np.where(np.diff(np.array([0] + speech_labels + [0])) == -1)[0]
+    edges = np.diff(np.concatenate([[0], np.asarray(speech_labels, dtype=np.int8), [0]]))
+    speech_starts = np.flatnonzero(edges == 1)
+    speech_ends = np.flatnonzero(edges == -1)
 
     min_speech_samples = int(sr * min_speech_duration / 1000)
 
-    speech_utterances = []
-    for start, end in zip(speech_starts, speech_ends):
-        if (end - start) * frame_samples >= min_speech_samples:
-            speech_utterances.append((start * frame_samples, end * frame_samples))
+    keep = (speech_ends - speech_starts) * frame_samples >= min_speech_samples
+    return [(start * frame_samples, end * frame_samples) for start, end in zip(speech_starts[keep], speech_ends[keep])]
+
+
+
+class StreamingVAD(object):
+    """
+    Incremental version of apply_vad: feed samples as they arrive and get one speech label
+    per complete frame_duration frame, the same labels apply_vad gives on the whole signal.
+    """
+    def __init__(self, sr, vad_level=3, frame_duration=30):
+        self.vad = webrtcvad.Vad()
+        self.vad.set_mode(vad_level)
+        self.sr = sr
+        self.frame_samples = int(sr * frame_duration / 1000)
+        self.pending = np.zeros(0, dtype=np.float64)
 
-    return speech_utterances
+    def push(self, audio):
+        audio = np.concatenate([self.pending, np.asarray(audio, dtype=np.float64)])
+        num_frames = len(audio) // self.frame_samples
+        self.pending = audio[num_frames * self.frame_samples:]
+        frames = np.round(audio[:num_frames * self.frame_samples] * 32767).astype(np.int16)
+        return [self.vad.is_speech(frame.tobytes(), sample_rate=self.sr)
+                for frame in frames.reshape(num_frames, self.frame_samples)]
 
+    def reset(self):
+        self.pending = np.zeros(0, dtype=np.float64)
@@ -0,0 +1,142 @@
+'''
+Train/test splits as a manifest instead of copies of the clip tree.
+
+A split manifest lists every clip of a clip tree (<root>/piezo/<uid>/<n>.wav + <root>/audio/<uid>/<n>.wav, or
+<root>/<uid>/<n>.wav for VoxCeleb1) with its split:
+
+  # split manifest layout=piezobuds packed=<prefix of the packed corpus, or ->
+  <uid> <n> <split> <index> <offset>
+
+index and offset are the position of the clip in the packed corpus and of its first sample in the packed arrays
+(-1 if the tree is not packed); readers of the packed corpus take the clips at the recorded indices. Clips are read from the original tree (or packed corpus), so a new split only
+writes this file. Every reader of a train / eval list (train_loader, PiezoBudsModel.eval_network,
+WavDatasetForVerification) accepts a manifest in its place, through read_list.
+'''
+
+import os, argparse
+import numpy as np
+from packed_corpus import PackedClipCorpus, list_user_clips
+
+HEADER = '# split manifest'
+
+
+def split_user(clip_ids, test_ratio=0.2, min_test=50):
+    # the split of split_train_test_dataset.py: the last max(int(n * test_ratio), min_test) clips are test clips
+    n_test = max(int(len(clip_ids) * test_ratio), min_test)
+    n_train = len(clip_ids) - n_test
+    return clip_ids[:n_train], clip_ids[n_train:]
+
+
+def make_split(root, users, test_ratio=0.2, min_test=50, layout='piezobuds', packed_prefix='', seed=None):
+    """
+    Split the clips of every user of the tree at root into train and test clips.
+    Clips are taken in numeric order, or in a random order drawn with seed.
+    Returns the records (uid, n, split, index, offset).
+    """
+    clip_dir = os.path.join(root, 'piezo') if layout == 'piezobuds' else root
+    corpus = PackedClipCorpus(packed_prefix) if packed_prefix != '' else None
+    rng = np.random.default_rng(seed) if seed is not None else None
+    records = []
+    for uid in users:
+        clip_ids = list_user_clips(os.path.join(clip_dir, str(uid)))
+        if rng is not None:
+            clip_ids = list(rng.permutation(clip_ids))
+        train, test = split_user(clip_ids, test_ratio, min_test)
+        for split, ids in [('train', train), ('test', test)]:
+            for cid in ids:
+                index = corpus.lookup[(uid, int(cid))] if corpus is not None else -1
+                offset = int(corpus.offsets[index]) if corpus is not None else -1
+                records.append((uid, int(cid), split, index, offset))
+    return records
+
+
+def write_manifest(path, records, layout='piezobuds', packed_prefix=''):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('%s layout=%s packed=%s\n' % (HEADER, layout, packed_prefix or '-'))
+        for record in records:
+            f.write('%d %d %s %d %d\n' % record)
+    os.replace(tmp_path, path)
+
+
+def is_manifest(path):
+    with open(path) as f:
+        return f.readline().startswith(HEADER)
+
+
+def read_manifest(path, split=None):
+    """
+    Records (uid, n, split, index, offset) of a manifest, only those of split if given, and its header fields.
+    """
+    lines = open(path).read().splitlines()
+    header = dict(field.split('=', 1) for field in lines[0][len(HEADER):].split())
+    records = []
+    for line in lines[1:]:
+        uid, cid, s, index, offset = line.split()
+        if split is None or s == split:
+            records.append((int(uid), int(cid), s, int(index), int(offset)))
+    return records, header
+
+
+def clip_path(uid, cid, layout='piezobuds', modality='audio'):
+    # path of a clip relative to the root of the tree
+    if layout == 'piezobuds':
+        return '%s/%d/%d.wav' % (modality, uid, cid)
+    return '%d/%d.wav' % (uid, cid)
+
+
+def read_list(path, split='train'):
+    """
+    Lines '<uid> <relative path>' of a train / eval list. A split manifest is read as the list of the clips
+    of split, with paths relative to the root of the tree it was made from.
+    """
+    if not is_manifest(path):
+        return open(path).read().splitlines()
+    records, header = read_manifest(path, split)
+    layout = header.get('layout', 'piezobuds')
+    return ['%d %s' % (uid, clip_path(uid, cid, layout)) for uid, cid, _, _, _ in records]
+
+
+def recorded_indices(path, corpus, split='train'):
+    """
+    Positions in the packed corpus of the clips of split, in the order of read_list, as recorded in the manifest.
+    None if path is a plain list or the manifest was made without a packed corpus.
+    """
+    if not is_manifest(path):
+        return None
+    records, header = read_manifest(path, split)
+    if header.get('packed', '-') == '-' or any(record[3] < 0 for record in records):
+        return None
+    indices = np.array([record[3] for record in records], dtype=np.int64)
+    offsets = np.array([record[4] for record in records], dtype=np.int64)
+    if len(indices) > 0 and (indices.max() >= len(corpus) or (corpus.offsets[indices] != offsets).any()):
+        raise ValueError('%s records the clips of another packed corpus (%s)' % (path, header['packed']))
+    return indices
+
+
+def user_clip_ids(path, split='train'):
+    # uid -> clip ids of split
+    records, _ = read_manifest(path, split)
+    clips = {}
+    for uid, cid, _, _, _ in records:
+        clips.setdefault(uid, []).append(cid)
+    return clips
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a train/test split manifest of a clip tree')
+    parser.add_argument('--root',          type=str,   default='/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/')
+    parser.add_argument('--out',           type=str,   default='/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/split.manifest')
+    parser.add_argument('--users',         type=int,   nargs=2, default=[0, 81], help='Split users in [start, end)')
+    parser.add_argument('--test_ratio',    type=float, default=0.2)
+    parser.add_argument('--min_test',      type=int,   default=50, help='Minimum number of test clips per user')
+    parser.add_argument('--voxceleb',      dest='voxceleb', action='store_true', help='The tree is <uid>/<n>.wav without piezo')
+    parser.add_argument('--packed_prefix', type=str,   default='', help='Packed corpus of the tree, to record clip indices and offsets')
+    parser.add_argument('--seed',          type=int,   default=None, help='Shuffle the clips of every user before splitting')
+    args = parser.parse_args()
+
+    layout = 'voxceleb' if args.voxceleb else 'piezobuds'
+    records = make_split(args.root, range(*args.users), args.test_ratio, args.min_test, layout, args.packed_prefix, args.seed)
+    write_manifest(args.out, records, layout, args.packed_prefix)
+    n_test = sum(record[2] == 'test' for record in records)
+    print('Wrote %s: %d users, %d train and %d test clips' % (args.out, args.users[1] - args.users[0], len(records) - n_test, n_test))
@@ -1,60 +1,19 @@
 import os
-import shutil
+from split_manifest import make_split, write_manifest
 
 if __name__=='__main__':
     n_user = 81
 
     data_file_dir = '/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/'
 
-    target_file_dir_train = '/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/train/'
-    target_file_dir_test = '/mnt/hdd/gen/processed_data/wav_clips_500ms/piezobuds_new_1/test/'
-    os.makedirs(target_file_dir_train, exist_ok=True)
-    os.makedirs(target_file_dir_test, exist_ok=True)
+    # the split is a manifest of data_file_dir instead of copies of the clips in train/ and test/:
+    # use it as --train_list / --eval_list with data_file_dir as --train_path / --eval_path
+    manifest = data_file_dir + 'split.manifest'
+    records = make_split(data_file_dir, range(n_user), test_ratio=0.2, min_test=50)
+    write_manifest(manifest, records)
 
     for i in range(n_user):
-        lst = os.listdir(data_file_dir + 'piezo/{}/'.format(i))
-        n_uttr = len(lst)
-        print('User: %d' % i)
-        print(n_uttr)
-        n_uttr_test = int(n_uttr * 0.2)
-        if n_uttr_test < 50:
-            n_uttr_test = 50
-        n_uttr_train = n_uttr - n_uttr_test
-        print('Train: %d, Test: %d' % (n_uttr_train, n_uttr_test))
-        
-        for j in range(0, n_uttr_train):
-            piezo_path = target_file_dir_train + 'piezo/{}/'.format(i)
-            audio_path = target_file_dir_train + 'audio/{}/'.format(i)
-            os.makedirs(piezo_path, exist_ok=True)
-            os.makedirs(audio_path, exist_ok=True)
-
-            source_piezo = data_file_dir + 'piezo/{}/'.format(i) + lst[j]
-            target_piezo = piezo_path + '{}.wav'.format(j)
-            print('Copy ' + source_piezo + ' to ' + target_piezo)
-            shutil.copyfile(source_piezo, target_piezo)
-
-            source_audio = data_file_dir + 'audio/{}/'.format(i) + lst[j]
-            target_audio = audio_path + '{}.wav'.format(j)
-            print('Copy ' + source_audio + ' to ' + target_audio)
-            shutil.copyfile(source_audio, target_audio)
-
-        for j in range(n_uttr_train, n_uttr):
-            piezo_path = target_file_dir_test + 'piezo/{}/'.format(i)
-            audio_path = target_file_dir_test + 'audio/{}/'.format(i)
-            os.makedirs(piezo_path, exist_ok=True)
-            os.makedirs(audio_path, exist_ok=True)
-
-            source_piezo = data_file_dir + 'piezo/{}/'.format(i) + lst[j]
-            target_piezo = piezo_path + '{}.wav'.format(j - n_uttr_train)
-            print('Copy ' + source_piezo + ' to ' + target_piezo)
-            shutil.copyfile(source_piezo, target_piezo)
-
-            source_audio = data_file_dir + 'audio/{}/'.format(i) + lst[j]
-            target_audio = audio_path + '{}.wav'.format(j - n_uttr_train)
-            print('Copy ' + source_audio + ' to ' + target_audio)
-            shutil.copyfile(source_audio, target_audio)
-
-
-
-        # n_uttr = 
-
+        n_uttr_train = sum(1 for record in records if record[0] == i and record[2] == 'train')
+        n_uttr_test = sum(1 for record in records if record[0] == i and record[2] == 'test')
+        print('User: %d, Train: %d, Test: %d' % (i, n_uttr_train, n_uttr_test))
+    print('Wrote ' + manifest)
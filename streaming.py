@@ -0,0 +1,260 @@
+'''
+Streaming verification for continuous piezo + mic input.
+
+Interleaved stereo frames (piezo on channel 0, mic on channel 1, as recorded for extract_feature.py)
+are pushed as they arrive. The engine keeps the last num_frames*160+240 samples of both channels in a
+ring buffer, runs the VAD of speech_split.py incrementally on the mic channel and, while there is speech,
+emits a rolling verification score every hop. When the VAD sees the end of an utterance it emits the
+decision for the whole utterance right away.
+
+The ECAPA front-end is not recomputed over the overlapping windows: every mel frame that lies inside
+the window is computed once, when its samples arrive, and reused by the following windows. Only the
+frames that touch the reflect padding at the two ends of the window depend on the window itself, and
+those few frames are recomputed for every window, so the features are the same as ECAPA_TDNN.fbank.
+'''
+
+import argparse, time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from speech_split import StreamingVAD
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of the last capacity samples of every channel.
+    """
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.buffer = np.zeros((channels, capacity), dtype=np.float32)
+        self.total = 0  # number of samples written since the start of the stream
+
+    def write(self, samples):
+        # samples: (channels, n)
+        n = samples.shape[1]
+        if n > self.capacity:
+            self.total += n - self.capacity
+            samples, n = samples[:, -self.capacity:], self.capacity
+        # stream sample k lives at k % capacity
+        self.buffer[:, (self.total + np.arange(n)) % self.capacity] = samples
+        self.total += n
+
+    def full(self):
+        return self.total >= self.capacity
+
+    def read(self):
+        # the last capacity samples in time order, (channels, capacity)
+        pos = self.total % self.capacity
+        return np.concatenate([self.buffer[:, pos:], self.buffer[:, :pos]], axis=1)
+
+
+class IncrementalFbank(object):
+    """
+    ECAPA_TDNN.fbank (PreEmphasis + MelSpectrogram + log + mean normalization, no specaug) of a sliding window,
+    computed incrementally. Consecutive windows must start a multiple of hop_length (160) samples apart.
+    """
+    def __init__(self, torchfbank, n_samples):
+        self.torchfbank = torchfbank
+        self.coef = torchfbank[0].coef
+        self.melspec = torchfbank[1]
+        spectrogram = self.melspec.spectrogram
+        self.n_fft, self.win_length, self.hop = spectrogram.n_fft, spectrogram.win_length, spectrogram.hop_length
+        self.n_samples = n_samples
+        self.n_frames = n_samples // self.hop + 1
+        half = self.win_length // 2
+        # frames first..last see only samples of the window, the others see the reflect padding
+        self.first = -(-half // self.hop)
+        self.last = (n_samples - half) // self.hop
+        self.frames = None  # log-mel of the interior frames of the previous window, (channels, n_mels, last - first + 1)
+        self.start = None   # stream position of the previous window
+
+    def _logmel(self, x):
+        return (self.torchfbank(x) + 1e-6).log()
+
+    def _interior(self, window, a, b):
+        # log-mel of frames a..b-1, from the pre-emphasized samples they cover (center=False framing)
+        pad = self.n_fft // 2
+        lo, hi = a * self.hop - pad, (b - 1) * self.hop + pad
+        x = window[:, lo - 1:min(hi, self.n_samples)]
+        y = x[:, 1:] - self.coef * x[:, :-1]
+        if y.shape[1] < hi - lo:
+            # samples past the end of the window fall outside the 400-sample analysis window, they are weighted by 0
+            y = F.pad(y, (0, hi - lo - y.shape[1]))
+        spec = torch.stft(y, n_fft=self.n_fft, hop_length=self.hop, win_length=self.win_length,
+                          window=self.melspec.spectrogram.window, center=False, return_complex=True).abs().pow(2)
+        return (self.melspec.mel_scale(spec) + 1e-6).log()
+
+    def __call__(self, window, start):
+        """
+        window: (channels, n_samples) tensor, start: stream position of window[:, 0].
+        Returns the normalized log-mel features (channels, n_mels, n_frames).
+        """
+        n_interior = self.last - self.first + 1
+        shift = None if self.start is None else start - self.start
+        if shift is not None and shift % self.hop == 0 and 0 <= shift // self.hop < n_interior \
+                and self.frames.shape[0] == window.shape[0]:
+            k = shift // self.hop
+            new = self._interior(window, self.last + 1 - k, self.last + 1) if k > 0 else self.frames[:, :, :0]
+            interior = torch.cat([self.frames[:, :, k:], new], dim=-1)
+        else:
+            interior = self._interior(window, self.first, self.last + 1)
+        self.frames, self.start = interior, start
+
+        # frames that touch the reflect padding, from short chunks at both ends of the window
+        head = self._logmel(window[:, :self.first * self.hop + self.n_fft // 2])[:, :, :self.first]
+        tail_start = self.last + 1 - self.first
+        tail = self._logmel(window[:, tail_start * self.hop:])[:, :, self.first:]
+        x = torch.cat([head, interior, tail], dim=-1)
+        return x - torch.mean(x, dim=-1, keepdim=True)
+
+
+class StreamingVerifier(object):
+    """
+    Verifies a claimed user on a continuous piezo + mic stream against the centroids of an EnrollmentStore.
+
+    push() takes interleaved stereo frames of shape (samples, 2) at 16 kHz, float in [-1, 1] or int16,
+    and returns the results produced by these samples, as dicts:
+    - {'type': 'window', ...}: rolling score of the last window, every hop while there is speech
+    - {'type': 'utterance', ...}: decision on the mean window score of an utterance, as soon as the VAD sees its end
+    """
+    def __init__(self, model, store, claimed_id, threshold=0.56147, hop_ms=100, sr=16000,
+                 vad_level=3, frame_duration=30, min_speech_ratio=0.5, hangover_ms=150):
+        self.model = model
+        self.model.eval()
+        self.device = model.device
+        self.threshold = threshold
+        self.sr = sr
+        self.n_samples = model.num_frames * 160 + 240
+        self.block = model.encoder_a.torchfbank[1].spectrogram.hop_length
+        self.hop = int(sr * hop_ms / 1000)
+        if self.hop % self.block != 0:
+            raise ValueError('hop_ms must be a multiple of %d ms' % (self.block * 1000 // sr))
+
+        self.ring = RingBuffer(self.n_samples, 2)
+        self.vad = StreamingVAD(sr, vad_level, frame_duration)
+        self.vad_frames = self.n_samples // self.vad.frame_samples
+        self.hangover = max(1, int(hangover_ms / frame_duration))
+        self.min_speech_ratio = min_speech_ratio
+        # both encoders use the same (parameter-free) front-end, one fbank serves the two channels,
+        # unless the piezo encoder has its own (decimated) front-end, which then runs on the whole piezo window
+        self.shared_front_end = model.encoder_p.front_end == model.encoder_a.front_end
+        self.fbank = IncrementalFbank(model.encoder_a.torchfbank.to(self.device), self.n_samples)
+        self.pending = np.zeros((0, 2), dtype=np.float32)
+        self.set_claimed_user(store, claimed_id)
+        self.reset()
+
+    def set_claimed_user(self, store, claimed_id):
+        self.centroids = store.get_centroids([claimed_id], device=self.device).float()
+
+    def reset(self):
+        self.labels = []
+        self.in_speech = False
+        self.silence = 0
+        self.speech_end = 0
+        self.utterance_scores = []
+
+    def score_window(self):
+        # rolling score of the samples currently in the ring buffer
+        window = torch.from_numpy(self.ring.read()).to(self.device)
+        with torch.no_grad():
+            # channel 0 is the piezo, channel 1 the mic
+            if self.shared_front_end:
+                features = self.fbank(window, self.ring.total - self.n_samples)
+                embeddings = self.model.embed_features(features[1:2], features[0:1])
+            else:
+                features = self.fbank(window[1:2], self.ring.total - self.n_samples)
+                embeddings = self.model.embed_features(features, self.model.encoder_p.log_fbank(window[0:1]))
+        sims = [F.cosine_similarity(e, self.centroids[:, m], dim=-1) + 1e-6 for m, e in enumerate(embeddings)]
+        score = float(sum(sims) / 3)
+        return {'type': 'window', 'time': self.ring.total / self.sr, 'score': score, 'accept': score > self.threshold,
+                'sim_audio': float(sims[0]), 'sim_piezo': float(sims[1]), 'sim_conv': float(sims[2])}
+
+    def push(self, frames):
+        frames = np.asarray(frames)
+        if frames.dtype == np.int16:
+            frames = frames / 32768.0
+        frames = np.concatenate([self.pending, frames.astype(np.float32)], axis=0)
+        results = []
+        # whole 10 ms blocks only, so that every window ends on the mel frame grid
+        n_blocks = frames.shape[0] // self.block
+        for i in range(n_blocks):
+            results += self._push_block(frames[i * self.block:(i + 1) * self.block].T)
+        self.pending = frames[n_blocks * self.block:]
+        return results
+
+    def _push_block(self, block):
+        results = []
+        self.ring.write(block)
+        for label in self.vad.push(block[1]):
+            self.labels = (self.labels + [label])[-self.vad_frames:]
+            if label:
+                self.in_speech, self.silence = True, 0
+                self.speech_end = self.ring.total - len(self.vad.pending)
+            elif self.in_speech:
+                self.silence += 1
+                if self.silence >= self.hangover:
+                    results += self._end_utterance()
+        if self.ring.full() and self.ring.total % self.hop == 0 \
+                and self.in_speech and np.mean(self.labels) >= self.min_speech_ratio:
+            result = self.score_window()
+            self.utterance_scores.append(result['score'])
+            results.append(result)
+        return results
+
+    def _end_utterance(self):
+        tic = time.time()
+        if len(self.utterance_scores) == 0 and self.ring.full():
+            # utterance shorter than a hop, score the window that ends now
+            self.utterance_scores.append(self.score_window()['score'])
+        if len(self.utterance_scores) == 0:
+            # the stream does not hold a whole window yet, nothing to decide on
+            self.in_speech, self.silence = False, 0
+            return []
+        score = float(np.mean(self.utterance_scores))
+        result = {'type': 'utterance', 'time': self.ring.total / self.sr, 'speech_end': self.speech_end / self.sr,
+                  'score': score, 'accept': score > self.threshold, 'n_windows': len(self.utterance_scores),
+                  'compute_time': time.time() - tic}
+        self.in_speech, self.silence, self.utterance_scores = False, 0, []
+        return [result]
+
+
+if __name__ == '__main__':
+    import soundfile
+    from PiezoBudsModel import PiezoBudsModel
+    from enrollment_store import EnrollmentStore
+
+    parser = argparse.ArgumentParser(description='Simulate the streaming verifier on a stereo recording')
+    parser.add_argument('--wav',           type=str,   required=True, help='Stereo 16 kHz recording, piezo on channel 0 and mic on channel 1')
+    parser.add_argument('--initial_model', type=str,   required=True, help='Path of the PiezoBuds model')
+    parser.add_argument('--store_path',    type=str,   required=True, help='Path of the EnrollmentStore')
+    parser.add_argument('--claimed_id',    type=int,   required=True)
+    parser.add_argument('--num_frames',    type=int,   default=50)
+    parser.add_argument('--hop_ms',        type=int,   default=100, help='Rolling score every hop_ms')
+    parser.add_argument('--block_ms',      type=int,   default=10,  help='Size of the blocks pushed into the stream')
+    parser.add_argument('--threshold',     type=float, default=0.56147)
+    parser.add_argument('--C',             type=int,   default=1024)
+    parser.add_argument('--C_p',           type=int,   default=0, help='Channel size of the piezo encoder, 0 for C')
+    parser.add_argument('--piezo_front_end', type=str, default='full', choices=['full', 'piezo', 'band'])
+    parser.add_argument('--shared_encoder', dest='shared_encoder', action='store_true', help='The model has one trunk for both modalities')
+    parser.add_argument('--adapter_dim',   type=int,   default=0)
+    parser.add_argument('--n_class',       type=int,   default=81)
+    parser.add_argument('--device',        type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    s = PiezoBudsModel(lr=0.001, lr_decay=0.97, C=args.C, n_class=args.n_class, m=0.2, s=30, test_step=50,
+                       device=args.device, num_frames=args.num_frames, C_p=args.C_p, piezo_front_end=args.piezo_front_end,
+                       shared_encoder=args.shared_encoder, adapter_dim=args.adapter_dim)
+    s.load_parameters(args.initial_model)
+    verifier = StreamingVerifier(s, EnrollmentStore(args.store_path), args.claimed_id, args.threshold, args.hop_ms)
+
+    data, sr = soundfile.read(args.wav)
+    block = int(sr * args.block_ms / 1000)
+    for i in range(0, data.shape[0], block):
+        tic = time.time()
+        for result in verifier.push(data[i:i + block]):
+            if result['type'] == 'utterance':
+                print('%7.2fs utterance score %.4f accept %d, end of speech -> decision %.0f ms (compute %.1f ms)' % (
+                    result['time'], result['score'], result['accept'],
+                    (result['time'] - result['speech_end']) * 1000 + (time.time() - tic) * 1000, result['compute_time'] * 1000))
+            else:
+                print('%7.2fs window score %.4f' % (result['time'], result['score']))
@@ -10,6 +10,7 @@ from my_models import *
 from torch.utils.tensorboard import SummaryWriter
 from UniqueDraw import UniqueDraw
 from utils import *
+import tools
 import torchvision
 from mobile_net_v3 import *
 from SincNet import SincConv_fast
@@ -66,46 +67,11 @@ def compute_EER(sim_matrix, is_piezo=False):
     - FAR (float): False acceptance rate at EER.
     - FRR (float): False rejection rate at EER.
     """
-    num_of_speakers, num_of_utters, _ = sim_matrix.shape
-    
-    # Initialize values
-    diff = float('inf')
-    EER = 0.0
-    threshold = 0.5
-    EER_FAR = 0.0
-    EER_FRR = 0.0
-    FARs = []
-    FRRs = []
-    threses = []
-
-    # Iterate over potential thresholds
-    for thres in torch.linspace(0.0, 1.0, 501):
-        sim_matrix_thresh = sim_matrix > thres
-
-        # Compute FAR and FRR
-        FAR = sum([(sim_matrix_thresh[i].sum() - sim_matrix_thresh[i, :, i].sum()).float()
-                    for i in range(num_of_speakers)]) / (num_of_speakers - 1.0) / (num_of_utters) / num_of_speakers
-
-        FRR = sum([(num_of_utters - sim_matrix_thresh[i, :, i].sum()).float()
-                   for i in range(num_of_speakers)]) / (num_of_utters) / num_of_speakers
-        
-        threses.append(thres)
-        FARs.append(FAR.item())
-        FRRs.append(FRR.item())
-
-        # Update if this is the closest FAR and FRR we've seen so far
-        if diff > abs(FAR - FRR):
-            diff = abs(FAR - FRR)
-            EER = ((FAR + FRR) / 2).item()
-            threshold = thres.item()
-            EER_FAR = FAR.item()
-            EER_FRR = FRR.item()
-    
-    threses = np.array(threses)
-    FARs = np.array(FARs)
-    FRRs = np.array(FRRs)
+    thresholds = torch.linspace(0.0, 1.0, 501)
+    EER, threshold, EER_FAR, EER_FRR = tools.compute_EER(sim_matrix, thresholds=thresholds)
     if is_piezo:
-        return EER, threshold, EER_FAR, EER_FRR, FARs, FRRs
+        FARs, FRRs = tools.compute_error_rates(sim_matrix, thresholds)
+        return EER, threshold, EER_FAR, EER_FRR, FARs.cpu().numpy(), FRRs.cpu().numpy()
     else:
         return EER, threshold, EER_FAR, EER_FRR
 
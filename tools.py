@@ -106,13 +106,84 @@ def remove_prefix(text, prefix):
         return text[len(prefix):]
     return text
 
-def compute_EER(sim_matrix, threshold=None):
+def compute_error_rates(sim_matrix, thresholds):
+    """
+    Compute FAR and FRR at many thresholds with a single sort of the scores.
+
+    Args:
+    - sim_matrix (torch.Tensor): A similarity matrix of shape
+      (..., num of speakers, num of utterances, num of speakers), leading dims are batched.
+    - thresholds (torch.Tensor): Thresholds of shape (T,) shared by the batch, or (..., T).
+
+    Returns:
+    - FAR (torch.Tensor): False acceptance rates of shape (..., T).
+    - FRR (torch.Tensor): False rejection rates of shape (..., T).
+
+    A trial is accepted if its score is > threshold, as in compute_EER.
+    """
+    num_of_speakers, num_of_utters, _ = sim_matrix.shape[-3:]
+    batch = sim_matrix.shape[:-3]
+    same = torch.eye(num_of_speakers, dtype=torch.bool, device=sim_matrix.device)
+    same = same.unsqueeze(1).expand(num_of_speakers, num_of_utters, num_of_speakers).reshape(-1)
+    scores = sim_matrix.reshape(*batch, -1)
+    genuine, _ = scores[..., same].sort(dim=-1)
+    impostor, _ = scores[..., ~same].sort(dim=-1)
+
+    thresholds = torch.as_tensor(thresholds, device=sim_matrix.device).to(sim_matrix.dtype)
+    if thresholds.dim() == 1:
+        thresholds = thresholds.expand(*batch, -1)
+    thresholds = thresholds.contiguous()
+
+    # number of scores <= threshold, i.e. the rejected trials
+    genuine_rejected = torch.searchsorted(genuine, thresholds, right=True)
+    impostor_rejected = torch.searchsorted(impostor, thresholds, right=True)
+    FRR = genuine_rejected.float() / genuine.shape[-1]
+    FAR = (impostor.shape[-1] - impostor_rejected).float() / impostor.shape[-1]
+    return FAR, FRR
+
+def compute_EER_sweep(sim_matrix, thresholds=None, p_target=0.05, c_miss=1, c_fa=1):
+    """
+    Compute EER, FAR, FRR, the EER threshold and minDCF in one pass.
+
+    Args:
+    - sim_matrix (torch.Tensor): A similarity matrix of shape
+      (..., num of speakers, num of utterances, num of speakers), leading dims are batched.
+    - thresholds (torch.Tensor): Thresholds to sweep. If None, every score is used as a
+      threshold, which gives the exact ROC.
+
+    Returns (tensors of shape (...)):
+    - EER, threshold, FAR, FRR at the threshold where |FAR - FRR| is minimal
+      (the first one, as in compute_EER).
+    - minDCF: minimum of the normalized detection cost over the same thresholds.
+    """
+    if thresholds is None:
+        thresholds, _ = sim_matrix.reshape(*sim_matrix.shape[:-3], -1).sort(dim=-1)
+    else:
+        thresholds = torch.as_tensor(thresholds, device=sim_matrix.device).to(sim_matrix.dtype)
+    FAR, FRR = compute_error_rates(sim_matrix, thresholds)
+    if thresholds.dim() == 1:
+        thresholds = thresholds.expand(FAR.shape)
+
+    idx = torch.argmin((FAR - FRR).abs(), dim=-1, keepdim=True)
+    EER_FAR = FAR.gather(-1, idx).squeeze(-1)
+    EER_FRR = FRR.gather(-1, idx).squeeze(-1)
+    threshold = thresholds.gather(-1, idx).squeeze(-1)
+    EER = (EER_FAR + EER_FRR) / 2
+
+    # See ComputeMinDcf
+    c_det = c_miss * FRR * p_target + c_fa * FAR * (1 - p_target)
+    minDCF = c_det.min(dim=-1).values / min(c_miss * p_target, c_fa * (1 - p_target))
+    return EER, threshold, EER_FAR, EER_FRR, minDCF
+
+def compute_EER(sim_matrix, threshold=None, thresholds=None):
     """
     Compute EER, FAR, FRR and the threshold at which EER occurs.
 
     Args:
     - sim_matrix (torch.Tensor): A similarity matrix of shape 
       (num of speakers, num of utterances, num of speakers).
+    - threshold (float): If given, only evaluate at this threshold.
+    - thresholds (torch.Tensor): Thresholds to sweep, torch.linspace(0.5, 1.0, 501) by default.
 
     Returns:
     - EER (float): Equal error rate.
@@ -120,46 +191,14 @@ def compute_EER(sim_matrix, threshold=None):
     - FAR (float): False acceptance rate at EER.
     - FRR (float): False rejection rate at EER.
     """
-    num_of_speakers, num_of_utters, _ = sim_matrix.shape
     if threshold == None:
-        # Initialize values
-        diff = float('inf')
-        EER = 0.0
-        threshold = 0.5
-        EER_FAR = 0.0
-        EER_FRR = 0.0
-
-        # Iterate over potential thresholds
-        for thres in torch.linspace(0.5, 1.0, 501):
-            sim_matrix_thresh = sim_matrix > thres
-
-            # Compute FAR and FRR
-            FAR = sum([(sim_matrix_thresh[i].sum() - sim_matrix_thresh[i, :, i].sum()).float()
-                        for i in range(num_of_speakers)]) / (num_of_speakers - 1.0) / (num_of_utters) / num_of_speakers
-
-            FRR = sum([(num_of_utters - sim_matrix_thresh[i, :, i].sum()).float()
-                    for i in range(num_of_speakers)]) / (num_of_utters) / num_of_speakers
-
-            # Update if this is the closest FAR and FRR we've seen so far
-            if diff > abs(FAR - FRR):
-                diff = abs(FAR - FRR)
-                EER = ((FAR + FRR) / 2).item()
-                threshold = thres.item()
-                EER_FAR = FAR.item()
-                EER_FRR = FRR.item()
-
-        return EER, threshold, EER_FAR, EER_FRR
+        if thresholds is None:
+            thresholds = torch.linspace(0.5, 1.0, 501)
+        EER, threshold, EER_FAR, EER_FRR, _ = compute_EER_sweep(sim_matrix, thresholds)
+        return EER.item(), threshold.item(), EER_FAR.item(), EER_FRR.item()
     else:
-        sim_matrix_thresh = sim_matrix > threshold
-
-        # Compute FAR and FRR
-        FAR = sum([(sim_matrix_thresh[i].sum() - sim_matrix_thresh[i, :, i].sum()).float()
-                    for i in range(num_of_speakers)]) / (num_of_speakers - 1.0) / (num_of_utters) / num_of_speakers
-
-        FRR = sum([(num_of_utters - sim_matrix_thresh[i, :, i].sum()).float()
-                for i in range(num_of_speakers)]) / (num_of_utters) / num_of_speakers
-        
+        FAR, FRR = compute_error_rates(sim_matrix, torch.tensor([threshold]))
         EER = ((FAR + FRR) / 2).item()
         EER_FAR = FAR.item()
         EER_FRR = FRR.item()
-        return EER, threshold, EER_FAR, EER_FRR
\ No newline at end of file
+        return EER, threshold, EER_FAR, EER_FRR
@@ -4,8 +4,10 @@ This is the main code of the ECAPATDNN project, to define the parameters and bui
 
 import argparse, glob, os, torch, warnings, time
 from tools import *
-from dataLoader import train_loader
+from dataLoader import train_loader, BalancedUserBatchSampler
 from PiezoBudsModel import PiezoBudsModel
+from ECAPA_TDNN_w_Modality import convert_two_encoder_state
+from distributed import init_distributed, is_main_process, DistributedUserSampler, wrap_training_step
 from torch import nn
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -17,6 +19,10 @@ parser.add_argument('--max_epoch',  type=int,   default=2100,      help='Maximum
 parser.add_argument('--batch_size', type=int,   default=20,     help='Batch size (number of users per batch)')
 parser.add_argument('--num_uttr', type=int,   default=10,     help='(number of uttrences per user)')
 parser.add_argument('--n_cpu',      type=int,   default=4,       help='Number of loader threads')
+parser.add_argument('--sampler',    type=str,   default="balanced", choices=["balanced", "random"], help='balanced: per-epoch batch plan of BalancedUserBatchSampler, random: shuffled users and random.sample of their clips')
+parser.add_argument('--user_rounds', type=int,  default=1,       help='Number of times every user is planned per epoch by the balanced sampler')
+parser.add_argument('--seed',       type=int,   default=0,       help='Seed of the batch plans of the balanced sampler')
+parser.add_argument('--prefetch_factor', type=int, default=4,    help='Batches loaded ahead by every loader worker')
 parser.add_argument('--test_step',  type=int,   default=25,       help='Test and save every [test_step] epochs')
 parser.add_argument('--lr',         type=float, default=0.001,   help='Learning rate')
 parser.add_argument("--lr_decay",   type=float, default=0.97,    help='Learning rate decay every [test_step] epochs')
@@ -30,6 +36,13 @@ parser.add_argument('--eval_user_total', type=int, default=81, help='Number of u
 parser.add_argument('--eval_user',  type=int,   default=10)
 parser.add_argument('--eval_uttr_enroll',  type=int,   default=8)
 parser.add_argument('--eval_uttr_verify',  type=int,   default=4)
+parser.add_argument('--eval_noise_type',  type=int,   default=0, help='0: no noise; 1: white noise; 2: conversation; 3: cafe; 4: restaurant; 5: construction')
+parser.add_argument('--eval_noise_path',  type=str,   default="/mnt/ssd/gen/GithubRepo/PiezoBuds/noise", help='The path of noise data')
+parser.add_argument('--eval_motion_type',  type=int,   default=0, help='0: No motion; 1: turn; 2: tap; 3: clap; 4: walk')
+parser.add_argument('--eval_motion_path',  type=str,   default="/mnt/ssd/gen/GithubRepo/PiezoBuds/motion", help='The path of motion data')
+parser.add_argument('--eval_times',  type=int,   default=10, help='Number of random enroll/verify rounds')
+parser.add_argument('--packed_prefix', type=str,   default="",                    help='Prefix of the training corpus packed by packed_corpus.py, read wav files if empty')
+parser.add_argument('--fbank_prefix', type=str,   default="",                     help='Prefix of the log-mel features written by fbank_cache.py, train from features instead of waveforms')
 parser.add_argument('--musan_path', type=str,   default="/mnt/hdd/gen/musan/musan",                    help='The path to the MUSAN set, eg:"/data08/Others/musan_split" in my case')
 parser.add_argument('--rir_path',   type=str,   default="/mnt/hdd/gen/rirs_noises/RIRS_NOISES/simulated_rirs",     help='The path to the RIR set, eg:"/data08/Others/RIRS_NOISES/simulated_rirs" in my case');
 parser.add_argument('--save_path',  type=str,   default="exps/aam_apzff_noncurrent_04061119am_full_dataset",                                     help='Path to save the score.txt and models')
@@ -38,11 +51,16 @@ parser.add_argument('--initial_extractor', type=str, default="/mnt/ssd/gen/Githu
 
 ## Model and Loss settings
 parser.add_argument('--C',       type=int,   default=1024,   help='Channel size for the speaker encoder')
+parser.add_argument('--C_p',     type=int,   default=0,      help='Channel size for the piezo encoder, 0 for C')
+parser.add_argument('--piezo_front_end', type=str, default='full', choices=['full', 'piezo', 'band'], help='Front-end of the piezo encoder, piezo: decimated to 4 kHz, 40 mels (see distill_piezo_encoder.py), band: 80 mels up to 2 kHz')
+parser.add_argument('--shared_encoder', dest='shared_encoder', action='store_true', help='One trunk for audio and piezo with per-modality BatchNorms (see convert_dual_encoder.py)')
+parser.add_argument('--adapter_dim', type=int,   default=0,      help='Per-modality adapters of this width in the shared encoder, 0 for none')
 parser.add_argument('--m',       type=float, default=0.2,    help='Loss margin in AAM softmax')
 parser.add_argument('--s',       type=float, default=30,     help='Loss scale in AAM softmax')
 parser.add_argument('--n_class', type=int,   default=81,   help='Number of speakers')
 
 parser.add_argument('--device',  type=str,   default=device)
+parser.add_argument('--backend', type=str,   default="gloo", help='torch.distributed backend when launched with torchrun, gloo also runs on CPU-only nodes')
 
 ## Command
 parser.add_argument('--eval',    dest='eval', action='store_true', help='Only do evaluation')
@@ -52,11 +70,30 @@ warnings.simplefilter("ignore")
 torch.multiprocessing.set_sharing_strategy('file_system')
 args = parser.parse_args()
 args = init_args(args)
+if args.fbank_prefix != "" and args.piezo_front_end != 'full':
+	# the persisted features feed both encoders (encoder_p also embeds the audio clips), so they need one front-end
+	parser.error('--fbank_prefix needs the full front-end for both encoders, not --piezo_front_end %s' % args.piezo_front_end)
+
+## Distributed training with torchrun: one process per device / CPU share, each loading batch_size users of every global batch
+rank, world_size, local_rank = init_distributed(args.backend)
+if world_size > 1 and torch.cuda.is_available():
+	args.device = "cuda:%d"%local_rank
+	torch.cuda.set_device(local_rank)
 
 ## Define the data loader
 trainloader = train_loader(**vars(args))
 _, veri_list = trainloader.return_user_lists()
-trainLoader = torch.utils.data.DataLoader(trainloader, batch_size = args.batch_size, shuffle = True, num_workers = args.n_cpu, drop_last = True)
+if args.sampler == "balanced":
+	## Workers load whole planned batches and stay alive across epochs
+	sampler = BalancedUserBatchSampler(trainloader, args.batch_size, args.num_uttr, rounds = args.user_rounds, seed = args.seed, rank = rank, world_size = world_size)
+	workers = dict(num_workers = args.n_cpu, persistent_workers = True, prefetch_factor = args.prefetch_factor) if args.n_cpu > 0 else {}
+	trainLoader = torch.utils.data.DataLoader(trainloader, batch_size = None, sampler = sampler, **workers)
+elif world_size > 1:
+	sampler = DistributedUserSampler(len(trainloader), args.batch_size)
+	trainLoader = torch.utils.data.DataLoader(trainloader, batch_size = args.batch_size, sampler = sampler, num_workers = args.n_cpu, drop_last = True)
+else:
+	sampler = None
+	trainLoader = torch.utils.data.DataLoader(trainloader, batch_size = args.batch_size, shuffle = True, num_workers = args.n_cpu, drop_last = True)
 
 ## Search for the exist models
 modelfiles = glob.glob('%s/model_0*.model'%args.model_save_path)
@@ -93,36 +130,59 @@ else:
 	s = PiezoBudsModel(**vars(args))
 	if args.initial_extractor != "":
 		loaded_state = torch.load(args.initial_extractor, map_location=device)
-		state_a = s.encoder_a.state_dict()
-		state_p = s.encoder_p.state_dict()
-		for name, param in loaded_state.items():
-			origname = name
-			name = remove_prefix(origname, 'speaker_encoder.')
-			if name in state_a:
-				if state_a[name].size() == loaded_state[origname].size():
-					state_a[name].copy_(loaded_state[origname])
-					state_p[name].copy_(loaded_state[origname])
-		s.encoder_a.load_state_dict(state_a)
-		s.encoder_p.load_state_dict(state_p)
-
+		copied = 0
+		if args.shared_encoder:
+			## the views encoder_a / encoder_p have the keys of the shared encoder, build its state as from two copies of the extractor
+			extractor = {remove_prefix(name, 'speaker_encoder.'): param for name, param in loaded_state.items()}
+			s.encoder.load_state_dict(convert_two_encoder_state(extractor, extractor, s.encoder.state_dict()))
+			copied = len(extractor)
+		else:
+			state_a = s.encoder_a.state_dict()
+			state_p = s.encoder_p.state_dict()
+			for name, param in loaded_state.items():
+				origname = name
+				name = remove_prefix(origname, 'speaker_encoder.')
+				if name in state_a:
+					if state_a[name].size() == loaded_state[origname].size():
+						state_a[name].copy_(loaded_state[origname])
+						copied += 1
+					## a narrower piezo encoder or another front-end only takes the tensors of matching shape
+					if name in state_p and state_p[name].size() == loaded_state[origname].size():
+						state_p[name].copy_(loaded_state[origname])
+						copied += 1
+			s.encoder_a.load_state_dict(state_a)
+			s.encoder_p.load_state_dict(state_p)
+		if copied == 0:
+			raise ValueError("No tensor of %s matches the encoders"%args.initial_extractor)
+
+
+## The training step, under DistributedDataParallel (which starts every rank from the parameters of rank 0) with torchrun
+step = wrap_training_step(s, device_ids = [local_rank] if args.device.startswith("cuda") and world_size > 1 else None)
 
 EERs = []
-score_file = open(args.score_save_path, "a+")
+score_file = open(args.score_save_path, "a+") if is_main_process() else None
 
 while(1):
 	## Training for one epoch
-	loss, lr, acc = s.train_network(epoch = epoch, loader = trainLoader)
+	if sampler is not None:
+		sampler.set_epoch(epoch)
+	loss, lr, acc = s.train_network(epoch = epoch, loader = trainLoader, step = step)
 
-	## Evaluation every [test_step] epochs
+	## Evaluation every [test_step] epochs, the evaluated users are shared out over the ranks, rank 0 saves and logs
 	if epoch % args.test_step == 0:
-		s.save_parameters(args.model_save_path + "/model_%04d.model"%epoch)
+		if is_main_process():
+			s.save_parameters(args.model_save_path + "/model_%04d.model"%epoch)
 		EER, minDCF, thres, FAR_replay = s.eval_network(eval_list = args.eval_list, eval_path = args.eval_path, eval_user_total=args.eval_user_total,
 							 eval_user=args.eval_user, eval_uttr_enroll=args.eval_uttr_enroll, 
-							 eval_uttr_verify=args.eval_uttr_verify, veri_usr_lst=veri_list)
+							 eval_uttr_verify=args.eval_uttr_verify, veri_usr_lst=veri_list,
+							 eval_noise_type=args.eval_noise_type, eval_noise_path=args.eval_noise_path,
+							 eval_motion_type=args.eval_motion_type, eval_motion_path=args.eval_motion_path,
+							 eval_times=args.eval_times)[:4]
 		EERs.append(EER)
-		print(time.strftime("%Y-%m-%d %H:%M:%S"), "%d epoch, ACC %2.2f%%, EER %2.2f%%, threshold %2.5f, bestEER %2.2f%%, FAR_replay %.6f"%(epoch, acc, EERs[-1] * 100, thres, min(EERs) * 100, FAR_replay))
-		score_file.write("%d epoch, LR %f, LOSS %f, ACC %2.2f%%, EER %2.2f%%, FAR_replay %.6f, bestEER %2.2f%%\n"%(epoch, lr, loss, acc, EERs[-1] * 100, FAR_replay, min(EERs) * 100))
-		score_file.flush()
+		if is_main_process():
+			print(time.strftime("%Y-%m-%d %H:%M:%S"), "%d epoch, ACC %2.2f%%, EER %2.2f%%, threshold %2.5f, bestEER %2.2f%%, FAR_replay %.6f"%(epoch, acc, EERs[-1] * 100, thres, min(EERs) * 100, FAR_replay))
+			score_file.write("%d epoch, LR %f, LOSS %f, ACC %2.2f%%, EER %2.2f%%, FAR_replay %.6f, bestEER %2.2f%%\n"%(epoch, lr, loss, acc, EERs[-1] * 100, FAR_replay, min(EERs) * 100))
+			score_file.flush()
 
 	if epoch >= args.max_epoch:
 		quit()
@@ -21,6 +21,9 @@ import matplotlib.pyplot as plt
 from sklearn.manifold import MDS
 from sklearn.cluster import KMeans
 from scipy.signal import hilbert
+from tools import compute_EER
+from similarity import ge2e_cossim, modal_cossim, pairwise_cossim
+import ge2e_loss
 
 
 def extract_envelope(signal, kernel_size=51):
@@ -177,92 +180,17 @@ def cosine_similarity(tensor1, tensor2):
     return similarity
 
 def get_cossim(embeddings, centroids):
-    # number of utterances per speaker
-    num_utterances = embeddings.shape[1]
-    utterance_centroids = get_utterance_centroids(embeddings)
-
-    # flatten the embeddings and utterance centroids to just utterance,
-    # so we can do cosine similarity
-    utterance_centroids_flat = utterance_centroids.view(
-        utterance_centroids.shape[0] * utterance_centroids.shape[1],
-        -1
-    )
-    embeddings_flat = embeddings.view(
-        embeddings.shape[0] * num_utterances,
-        -1
-    )
-    # the cosine distance between utterance and the associated centroids
-    # for that utterance
-    # this is each speaker's utterances against his own centroid, but each
-    # comparison centroid has the current utterance removed
-    cos_same = F.cosine_similarity(embeddings_flat, utterance_centroids_flat)
-
-    # now we get the cosine distance between each utterance and the other speakers'
-    # centroids
-    # to do so requires comparing each utterance to each centroid. To keep the
-    # operation fast, we vectorize by using matrices L (embeddings) and
-    # R (centroids) where L has each utterance repeated sequentially for all
-    # comparisons and R has the entire centroids frame repeated for each utterance
-    centroids_expand = centroids.repeat((num_utterances * embeddings.shape[0], 1))
-    embeddings_expand = embeddings_flat.unsqueeze(1).repeat(1, embeddings.shape[0], 1)
-    embeddings_expand = embeddings_expand.view(
-        embeddings_expand.shape[0] * embeddings_expand.shape[1],
-        embeddings_expand.shape[-1]
-    )
-    cos_diff = F.cosine_similarity(embeddings_expand, centroids_expand)
-    cos_diff = cos_diff.view(
-        embeddings.size(0),
-        num_utterances,
-        centroids.size(0)
-    )
-    # assign the cosine distance for same speakers to the proper idx
-    same_idx = list(range(embeddings.size(0)))
-    cos_diff[same_idx, :, same_idx] = cos_same.view(embeddings.shape[0], num_utterances)
-    cos_diff = cos_diff + 1e-6
-    return cos_diff
+    # GE2E similarity matrix (N, M, N): each utterance against every centroid, and against the
+    # centroid of its own speaker computed without it, see similarity.ge2e_cossim
+    return ge2e_cossim(embeddings, centroids)
 
 def get_modal_cossim_revised(embeddings, centroids):
-    num_user = embeddings.shape[0]
-    num_utterances = embeddings.shape[1]
-
-    # Flatten the embeddings for manipulation
-    embeddings_flat = embeddings.view(num_user * num_utterances, -1)
-
-    # Expand embeddings to match each against every centroid
-    embeddings_expand = embeddings_flat.unsqueeze(1).repeat(1, num_user, 1)
-    embeddings_expand = embeddings_expand.view(-1, embeddings_flat.shape[-1])
-
-    # Repeat centroids to align with the expanded embeddings for comparison
-    centroids_expand = centroids.repeat(num_utterances * num_user, 1)
-
-    # Calculate the cosine similarities between embedding vectors and centroids
-    # Specify the dimension along which to compute similarity
-    cossim_modal = F.cosine_similarity(embeddings_expand, centroids_expand, dim=1)
-    cossim_modal = cossim_modal.view(num_user, num_utterances, -1)
-    cossim_modal = cossim_modal + 1e-6  # Prevent division by zero or NaN issues
-
-    return cossim_modal
+    # (N, M, D) embeddings against (N, D) centroids -> (N, M, N), + 1e-6 to prevent division by zero or NaN issues
+    return modal_cossim(embeddings, centroids)
 
 def get_modal_cossim(embeddings, centroids):
-    num_user = embeddings.shape[0]
-    num_utterances = embeddings.shape[1]
-
-    embeddings_flat = embeddings.view(
-        embeddings.shape[0] * num_utterances,
-        -1
-    )
-
-    embeddings_expand = embeddings_flat.unsqueeze(1).repeat((1, num_user, 1))
-    embeddings_expand = embeddings_expand.view(embeddings_expand.shape[0] * embeddings_expand.shape[1], -1)
-
-    centriods_expand = centroids.repeat((num_utterances * num_user, 1))
-
-    # calculate the consine similarites between embedding vectors and centroids
-    cossim_modal = F.cosine_similarity(embeddings_expand, centriods_expand)
-    cossim_modal = cossim_modal.view(num_user, num_utterances, -1)
-    cossim_modal = cossim_modal + 1e-6
-
-    return cossim_modal
+    # calculate the consine similarites between embedding vectors and centroids, (N, M, N) + 1e-6
+    return modal_cossim(embeddings, centroids)
 
 def calc_loss_prior(sim_matrix):
     # Calculates loss from (N, M, K) similarity matrix
@@ -274,15 +202,8 @@ def calc_loss_prior(sim_matrix):
     return loss, per_embedding_loss
 
 def calc_loss(sim_matrix):
-    same_idx = list(range(sim_matrix.size(0)))
-    pos = sim_matrix[same_idx, :, same_idx]
-    neg = (torch.exp(sim_matrix).sum(dim=2) + 1e-6).log_()
-    per_embedding_loss = -1 * (pos - neg)
-    loss = per_embedding_loss.sum()
-    pos = (torch.exp(pos).sum(dim=1) + 1e-6).log_()
-    # add the neg to the output 
-    # neg = (torch.exp(neg).sum() + 1e-6).log_()
-    return loss, per_embedding_loss, -pos.sum(), neg.sum()
+    # loss, per_embedding_loss, -sum of log sum exp(pos) per speaker, sum of log sum exp over centroids
+    return ge2e_loss.softmax_loss_terms(sim_matrix)
 
 
 def loss_ft(f_tensor, device, is_cossim=False):
@@ -308,35 +229,16 @@ def loss_ft(f_tensor, device, is_cossim=False):
 
 
 def cal_contrast_loss(sim_matrix, device):
-    same_idx = list(range(sim_matrix.size(0)))
-    sig_sim_matrix = 1 / (1 + torch.exp(-sim_matrix))
-    pos = sig_sim_matrix[same_idx, :, same_idx]
-    neg = torch.zeros((sim_matrix.size(0), sim_matrix.size(1))).to(device=device)
-    for i in range(sim_matrix.size(0)):
-        inf_matrix = torch.full((sim_matrix.size(1), sim_matrix.size(0)), float('-inf'))
-        temp_tensor = sig_sim_matrix[i, :, :].clone()
-        temp_tensor[:, i] = inf_matrix[:, i]
-        max_vals, _ = torch.max(temp_tensor, dim=-1)
-        neg[i, :] = max_vals
-
-    per_embedding_loss = torch.ones((sim_matrix.size(0), sim_matrix.size(1))).to(device=device) - pos + neg
-    loss = per_embedding_loss.sum()
-
+    # 1 - sigmoid(own speaker) + max sigmoid(other speakers), see ge2e_loss.contrast_loss
+    loss, per_embedding_loss = ge2e_loss.contrast_loss(sim_matrix.to(device))
     return loss, per_embedding_loss
 
 def cal_intra_loss(sim_matrix, device):
     # calculate the intra loss between the centroid of modality A and the embedding vectors of modality B
     # only applicable when the sim matrix is calculated based on different modalities
-    n_users = sim_matrix.size(0)
-    n_utterance = sim_matrix.size(1)
-    same_idx = list(range(n_users))
-    per_user_sim = sim_matrix[same_idx, :, same_idx] 
-    per_user_loss = torch.ones((n_users, n_utterance)).to(device=device) - torch.sigmoid(per_user_sim)
-    loss = per_user_loss.sum()
-
+    loss, per_user_loss = ge2e_loss.intra_loss(sim_matrix.to(device))
     return loss, per_user_loss
 
-
 def normalize_0_1(values, max_value, min_value):
     normalized = np.clip((values - min_value) / (max_value - min_value), 0, 1)
     return normalized
@@ -457,19 +359,8 @@ def normalize_tensors_based_audio(tensor_p, tensor_a):
 
 
 def pairwise_cos_sim(tensor_a, tensor_b):
-    tensor_a = tensor_a.contiguous()
-    b, u, _ = tensor_a.shape
-    tensor_b = tensor_b.contiguous()
-
-    tensor_a = tensor_a.repeat((1, b*u, 1))
-    tensor_b = tensor_b.repeat((b*u, 1, 1))
-
-    tensor_a = tensor_a.view(b * b * u * u, -1)
-    tensor_b = tensor_b.view(b * b * u * u, -1)
-    cos_sim = F.cosine_similarity(tensor_a, tensor_b)
-    cos_sim = cos_sim.contiguous()
-    cos_sim = cos_sim.view(b*u, b*u)
-    return cos_sim
+    # (b, u, D) x (b, u, D) -> (b*u, b*u), every utterance of tensor_a against every utterance of tensor_b
+    return pairwise_cossim(tensor_a, tensor_b)
 
 
 def random_split_tensor(input_tensor, split_n, device):
@@ -502,18 +393,8 @@ def softmax_loss(input_tensor, device):
     N, M = input_tensor.shape
     if N != M:
         raise ValueError("The input tensor doesn't have identical length on different dims.")
-    pos = torch.diag(input_tensor)
-
-    # create a mask with ones everywhere except the diagonal elements
-    mask = torch.ones_like(input_tensor).to(device) - torch.eye(N, requires_grad=True).to(device)
-    mask.to(device)
-
-    masked_tensor = input_tensor * mask.to(device)
-    neg = (torch.exp(masked_tensor).sum(dim=1) + 1e-6).log_()
-    loss_per_user_utter = -1 * (pos - neg)
-    loss = loss_per_user_utter.mean()
-
-    return loss, loss_per_user_utter
+    # the diagonal is masked (set to 0) in the negative term
+    return ge2e_loss.pairwise_softmax_loss(input_tensor.to(device))
 
 def cal_EER_coverter(sim_matrix):
     '''
@@ -522,32 +403,9 @@ def cal_EER_coverter(sim_matrix):
     N, M = sim_matrix.shape
     if N != M:
         raise ValueError("The input tensor doesn't have identical length on different dims.")
-    
-    # Initialize values
-    diff = float('inf')
-    EER = 0.0
-    threshold = None
-    EER_FAR = 0.0
-    EER_FRR = 0.0
-
-    # Iterate over potential thresholds
-    for thres in torch.linspace(0.01, 1.0, 101):
-        sim_matrix_thresh = sim_matrix > thres
-
-        # Compute FAR and FRR
-        FRR = 1 - torch.diag(sim_matrix_thresh).sum() / N
-        
-        FAR = (sim_matrix_thresh.sum() - torch.diag(sim_matrix_thresh).sum()) / N / (N - 1)
-
-        # Update if this is the closest FAR and FRR we've seen so far
-        if diff > abs(FAR - FRR):
-            diff = abs(FAR - FRR)
-            EER = ((FAR + FRR) / 2).item()
-            threshold = thres.item()
-            EER_FAR = FAR.item()
-            EER_FRR = FRR.item()
 
-    return EER, threshold, EER_FAR, EER_FRR
+    # an (N, N) matrix is a (speakers, 1 utterance, speakers) similarity matrix
+    return compute_EER(sim_matrix.view(N, 1, N), thresholds=torch.linspace(0.01, 1.0, 101))
 
 def softmax_per_user_loss(input_tensor, device, n_user):
     '''
@@ -558,30 +416,8 @@ def softmax_per_user_loss(input_tensor, device, n_user):
     if N != M:
         raise ValueError("The input tensor doesn't have identical length on different dims.")
 
-    n_utter = N // n_user
-
-    # Create a list of UxU identity matrix
-    blocks = [torch.ones(n_utter, n_utter) for _ in range(n_user)]
-    block_matrix = torch.block_diag(*blocks)
-    block_matrix = block_matrix.to(device)
-
-    # calculate the pos and neg part
-    pos = input_tensor * block_matrix.to(device)
-    # pos_reshaped = pos.view(n_user, n_utter, n_user, n_utter)
-    # pos_sums = pos_reshaped.sum(dim=1).sum(dim=2)
-    # pos_sums_diag = torch.diag(pos_sums)
-    pos_diag = torch.diag(pos)
-    pos_reshaped = pos_diag.view(n_user, n_utter)
-    pos_sums_diag = pos_reshaped.sum(dim=1)
-    neg = input_tensor * (torch.ones_like(input_tensor).to(device) - block_matrix)
-    neg_reshaped = neg.view(n_user * n_utter * n_user, n_utter)
-    neg_sums = (torch.exp(neg_reshaped).sum(dim=1) + 1e-6).log_() # get a 1-D tensor with size of n_user * n_utter * n_user
-    neg_sums_reshaped = neg_sums.view(n_user, n_user * n_utter)
-    neg_sums_reshaped = neg_sums_reshaped.sum(dim=1)
-    loss_per_user = -1 * (pos_sums_diag - neg_sums_reshaped) / n_utter
-    loss = loss_per_user.mean()
-
-    return loss, loss_per_user
+    # the (cached) block-diagonal user mask is zeroed in the negative term
+    return ge2e_loss.per_user_softmax_loss(input_tensor.to(device), n_user)
 
 if __name__ == "__main__":
     tensor_a = torch.randn(10, 20, 192)